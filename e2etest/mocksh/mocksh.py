@@ -1,5 +1,6 @@
 import asyncio
 import logging
+import math
 import os
 import time
 from typing import List, Optional
@@ -122,6 +123,33 @@ async def post_refill_buckets(request: Request):
     )
 
 
+def consume_buckets(processing_units: float) -> Optional[Response]:
+    """
+    Checks buckets to determine if 429 should be returned (and returns it), otherwise decrements buckets.
+    """
+    # check if any policy is depleted - if so, return 429 (and tell the client when it can retry, in ms):
+    retry_after_ms = 0.0
+    for bucket_value, policy in zip(app.state.buckets_rq, app.state.POLICIES_RQ):
+        if bucket_value < 1.0:
+            retry_after_ms = max(retry_after_ms, (1.0 - bucket_value) * policy.nanosBetweenRefills / 10 ** 6)
+    for bucket_value, policy in zip(app.state.buckets_pu, app.state.POLICIES_PU):
+        if bucket_value < processing_units:
+            retry_after_ms = max(
+                retry_after_ms, (processing_units - bucket_value) * policy.nanosBetweenRefills / 10 ** 6
+            )
+    if retry_after_ms > 0.0:
+        return Response(
+            content="Rate limit reached", status_code=429, headers={"Retry-After": str(int(math.ceil(retry_after_ms)))}
+        )
+
+    # otherwise decrement all of the buckets appropriately:
+    for i in range(len(app.state.buckets_rq)):
+        app.state.buckets_rq[i] -= 1.0
+    for i in range(len(app.state.buckets_pu)):
+        app.state.buckets_pu[i] -= processing_units
+    return None
+
+
 @app.get("/data")
 async def get_data(processing_units: int, delay: float = None, request: Request = None):
     """
@@ -130,24 +158,29 @@ async def get_data(processing_units: int, delay: float = None, request: Request
     - decrements buckets
     - sleeps for some time (if delay is specified), then returns response 200
     """
-    # check if any policy is depleted - if so, return 429:
-    for bucket_value in request.app.state.buckets_rq:
-        if bucket_value < 1.0:
-            return Response(content="Rate limit reached", status_code=429)
-    for bucket_value in request.app.state.buckets_pu:
-        if bucket_value < processing_units:
-            return Response(content="Rate limit reached", status_code=429)
-
-    # otherwise decrement all of the buckets appropriately:
-    for i in range(len(request.app.state.buckets_rq)):
-        request.app.state.buckets_rq[i] -= 1.0
-    for i in range(len(request.app.state.buckets_pu)):
-        request.app.state.buckets_pu[i] -= processing_units
+    rate_limited_response = consume_buckets(processing_units)
+    if rate_limited_response is not None:
+        return rate_limited_response
 
     # sleep for some time and return response 200:
     if delay:
         await asyncio.sleep(delay)
-    return Response(content="", status_code=200)
+    return Response(content="", status_code=200, headers={"x-processingunits-spent": str(processing_units)})
+
+
+@app.post("/api/v1/process")
+async def post_process(request: Request):
+    """
+    Mocks Process API, charging the PUs for the requested output size only (3 input bands are assumed).
+    """
+    body = await request.json()
+    output = body.get("output", {})
+    processing_units = max(output.get("width", 256) * output.get("height", 256) / (512.0 * 512.0), 0.01)
+
+    rate_limited_response = consume_buckets(processing_units)
+    if rate_limited_response is not None:
+        return rate_limited_response
+    return Response(content="", status_code=200, headers={"x-processingunits-spent": str(processing_units)})
 
 
 if __name__ == "__main__":
@@ -1,8 +1,10 @@
 import concurrent.futures
+import contextlib
 import os
 import random
 import subprocess
 import sys
+import threading
 import time
 
 import pytest
@@ -14,11 +16,15 @@ currentdir = os.path.dirname(os.path.realpath(__file__))
 parentdir = os.path.dirname(currentdir)
 sys.path.append(parentdir)
 from lib.rlguard import apply_for_request, SyncerDownException
+from lib.rlguard.backends.permitserver import PermitServerRepository
 from lib.rlguard.repository import RedisRepository
+from lib.rlguard.requests_adapter import RateLimitedSession
 
 
 MOCKSH_ROOT_URL = "http://127.0.0.1:8000"
 SYNCER_CONTAINER_NAME = "e2etest_syncer"
+PERMIT_SERVER_CONTAINER_NAME = "e2etest_permitserver"
+PERMIT_SERVER_PORT = int(os.environ.get("PERMIT_SERVER_PORT", 8001))
 
 REDIS_HOST = os.environ.get("REDIS_HOST", "127.0.0.1")
 REDIS_PORT = int(os.environ.get("REDIS_PORT", 6379))
@@ -55,10 +61,33 @@ def restart_syncer():
     time.sleep(2)
 
 
+def restart_permit_server():
+    subprocess.call(["docker", "restart", "-t", "1", PERMIT_SERVER_CONTAINER_NAME])
+    time.sleep(2)
+
+
 def stop_syncer():
     subprocess.call(["docker", "stop", SYNCER_CONTAINER_NAME])
 
 
+@contextlib.contextmanager
+def refilling_buckets(interval_s=0.1):
+    # mocksh only refills its buckets when asked to, and the adapters send (and retry) requests on their own:
+    stop = threading.Event()
+
+    def refill():
+        while not stop.wait(interval_s):
+            requests.post(f"{MOCKSH_ROOT_URL}/refill_buckets").raise_for_status()
+
+    thread = threading.Thread(target=refill, daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
 def calculate_ideal_time(policies, total_requests, pu_per_request):
     ideal_time = 0
     for policy_type, capacity, refill_time in policies:
@@ -226,3 +255,49 @@ def test_ratelimiting(
         print(f"Successfully completed: {count_success} / {total_requests}")
         print(f"{'=' * 35}\n")
     assert True
+
+
+def test_rate_limited_session(set_policies, capsys):
+    policies = [("RQ", 10, 5), ("PU", 20, 10)]
+    set_policies(policies)
+    restart_syncer()
+
+    n_requests = 30
+    start_time = time.monotonic()
+    with refilling_buckets(), RateLimitedSession(repository) as session:
+        responses = [
+            session.post(f"{MOCKSH_ROOT_URL}/api/v1/process", json={"output": {"width": 512, "height": 512}})
+            for _ in range(n_requests)
+        ]
+    total_time = time.monotonic() - start_time
+
+    with capsys.disabled():
+        print(f"\nRate limited session: {n_requests} requests in {total_time:.1f}s")
+        print(f"Expected test time: > {calculate_ideal_time(policies, n_requests, 1):.1f}s")
+    assert all(r.status_code == 200 for r in responses)
+
+
+def test_permit_server(set_policies, capsys):
+    policies = [("RQ", 10, 5), ("PU", 20, 10)]
+    set_policies(policies)
+    restart_permit_server()
+
+    permit_server = PermitServerRepository("127.0.0.1", PERMIT_SERVER_PORT)
+    n_requests = 30
+    pu_per_request = 1
+    count_429 = 0
+    start_time = time.monotonic()
+    for _ in range(n_requests):
+        delay = apply_for_request(pu_per_request, permit_server)
+        if delay > 0:
+            time.sleep(delay)
+        requests.post(f"{MOCKSH_ROOT_URL}/refill_buckets").raise_for_status()
+        r = requests.get(f"{MOCKSH_ROOT_URL}/data", params={"processing_units": pu_per_request})
+        if r.status_code == 429:
+            count_429 += 1
+    total_time = time.monotonic() - start_time
+
+    with capsys.disabled():
+        print(f"\nPermit server: {n_requests} requests in {total_time:.1f}s, {count_429} 429 responses")
+        print(f"Expected test time: > {calculate_ideal_time(policies, n_requests, pu_per_request):.1f}s")
+    assert count_429 <= 5
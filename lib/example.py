@@ -7,8 +7,9 @@ import redis
 import requests
 import requests.exceptions
 
-from rlguard import calculate_processing_units, OutputFormat, apply_for_request, SyncerDownException
-from rlguard.repository import Repository, RedisRepository
+from rlguard import calculate_processing_units, OutputFormat, acquire_permit, report_response, SyncerDownException
+from rlguard.backends.redis import RedisRepository
+from rlguard.repository import Repository
 
 
 logging.basicConfig(level=os.environ.get("LOGLEVEL", "INFO").upper())
@@ -44,16 +45,18 @@ def get_map(auth_token, repository: Repository, output_filename=None):
 
     # now apply for permission to make a request:
     try:
-        delay = apply_for_request(pu, repository)
+        permit = acquire_permit(pu, repository)
     except SyncerDownException:
-        delay = 0
+        permit = None
         # If this happens, retries should be handled manually, with exponential backoff (but limited to the
         # time it takes to fill the offending bucket from empty to full).
 
-    # if `apply_for_request` tells us to wait for some time before issuing the request, we should sleep a bit:
-    if delay > 0.0:
-        logging.info(f"Rate limited, sleeping for {delay}s...")
-        time.sleep(delay)
+    # if the permit tells us to wait for some time before issuing the request, we should wait (precisely) until
+    # its deadline:
+    if permit is not None and permit.delay > 0.0:
+        logging.info(f"Rate limited, waiting for {permit.delay}s...")
+        overshoot = permit.wait()
+        logging.debug(f"...waited {overshoot * 1000:.3f}ms too long.")
 
     # note that sentinelhub-py could also be used here instead of performing the request directly:
     logging.info("Performing request...")
@@ -96,6 +99,9 @@ def get_map(auth_token, repository: Repository, output_filename=None):
             """,
         },
     )
+    # let the other workers know about the PUs actually spent (or about the 429 response):
+    if permit is not None:
+        report_response(permit, r, repository)
     r.raise_for_status()
 
     if output_filename:
@@ -1,16 +1,53 @@
 from enum import Enum
+import functools
 import logging
+import time
+import uuid
+from typing import Dict, List, Optional
 
+from .backlog import PolicyBacklog, get_backlog
+from .permit import SPIN_S, Permit, wait_until
 from .repository import Repository
+from .tracing import get_trace_recorder
+
+
+# Sentinel Hub reports the actual number of PUs spent by the request, and (on 429) the time in milliseconds
+# after which the request can be retried:
+PROCESSING_UNITS_SPENT_HEADER = "x-processingunits-spent"
+RETRY_AFTER_HEADER = "retry-after"
+
+# All workers share a rate multiplier which scales the refill rates (and thus the delays). It is decreased
+# multiplicatively when Sentinel Hub responds with 429 (at most once per cooldown period, so that a burst of
+# 429s counts as a single event) and increased additively with each successful request, up to 1:
+RATE_MULTIPLIER_DECREASE_FACTOR = 0.7
+RATE_MULTIPLIER_DECREASE_COOLDOWN_MS = 1000
+RATE_MULTIPLIER_INCREASE_STEP = 0.005
+RATE_MULTIPLIER_MIN = 0.05
+
+# waiting for capacity events only makes sense if the delay is long enough:
+WAKE_ON_CAPACITY_MIN_DELAY_S = 0.5
+
+# Leases in concurrency semaphores expire if the worker doesn't complete (or renew) them in time, so that
+# crashed workers don't hold the slots forever. While waiting for a slot, workers check it again at least
+# this often (even if they are not notified about a released lease):
+LEASE_TTL_S = 120.0
+LEASE_POLL_S = 1.0
 
 
 class SyncerDownException(Exception):
     pass
 
 
+class ConcurrencyLimitException(Exception):
+    # raised by `apply_for_request`, which can't apply the concurrency limits:
+    pass
+
+
 class PolicyType(Enum):
     PROCESSING_UNITS = "PU"
     REQUESTS = "RQ"
+    # limit of requests in flight (not a bucket, see `Repository.init_semaphores`):
+    CONCURRENCY = "CC"
 
 
 class OutputFormat(Enum):
@@ -66,41 +103,486 @@ def calculate_processing_units(
     return pu
 
 
-def apply_for_request(processing_units: float, repository: Repository) -> float:
+def job_bucket_id(policy_id: str, job_id: str) -> str:
+    """
+    Returns the id of the counter which holds the sub-quota of the job for the given policy.
+    """
+    return f"{policy_id}@{job_id}"
+
+
+def is_job_bucket_id(counter_id: str, job_id: str) -> bool:
+    """
+    Tells whether the counter holds the sub-quota of the job (for any of the policies), see `job_bucket_id`.
+    """
+    # policy ids never contain "@", so everything after the first one is the job id:
+    _, separator, counter_job_id = counter_id.partition("@")
+    return separator == "@" and counter_job_id == job_id
+
+
+def set_job_quota(
+    job_id: str,
+    refill_fraction: float,
+    repository: Repository,
+    capacity_fraction: Optional[float] = None,
+    max_concurrent: Optional[int] = None,
+):
+    """
+    Limits the job (or tenant) to a fraction of the account's rate limits.
+
+    The job's sub-buckets are refilled at `refill_fraction` of the parent policies' rate and can hold at
+    most `capacity_fraction` (by default the same as `refill_fraction`) of their capacity. Requests made
+    on behalf of the job must then pass `job_id` to `apply_for_request`; once the job exceeds its cap,
+    it is delayed instead of the rest of the account. Sub-quota which is not used by a full job is
+    redistributed by syncer to the other jobs.
+
+    If `max_concurrent` is given, at most that many requests of the job can be in flight at the same time.
+    """
+    if capacity_fraction is None:
+        capacity_fraction = refill_fraction
+    if not 0.0 < refill_fraction <= 1.0 or not 0.0 < capacity_fraction <= 1.0:
+        raise ValueError("Job quota fractions must be within (0, 1].")
+
+    is_new_job = repository.get_job_quota(job_id) is None
+    quota = {"refill_fraction": refill_fraction, "capacity_fraction": capacity_fraction}
+    if max_concurrent is not None:
+        quota["max_concurrent"] = max_concurrent
+    repository.save_job_quota(job_id, quota)
+
+    # newly registered jobs start with full sub-buckets, the same as the account's buckets do:
+    if is_new_job:
+        policy_capacities = repository.get_policy_capacities()
+        repository.increment_counters(
+            {
+                job_bucket_id(policy_id, job_id): float(capacity) * capacity_fraction
+                for policy_id, capacity in policy_capacities.items()
+            }
+        )
+
+
+def remove_job_quota(job_id: str, repository: Repository):
+    """
+    Removes the job's quota together with its sub-buckets; requests made on behalf of the job are then only
+    limited by the account's buckets.
+    """
+    repository.delete_job_quota(job_id)
+
+
+def apply_for_request(processing_units: float, repository: Repository, job_id: Optional[str] = None) -> float:
     """
     Decrements & fetches the Redis counters, calculates the delay and returns it.
 
+    See `acquire_permit` for details. Concurrency limits (`MAX_CONCURRENT_REQUESTS` of syncer, `max_concurrent`
+    of job quotas) can't be applied, because the caller waits by itself and there is no permit to complete. If
+    the request is subject to them, the charges are returned and `ConcurrencyLimitException` is raised - use
+    `acquire_permit`, `permit.wait()` (or `wait_for_capacity`) and `report_response` (or `complete`) instead.
+    """
+    permit = acquire_permit(processing_units, repository, job_id=job_id)
+    if permit.semaphore_limits:
+        release(permit, repository)
+        raise ConcurrencyLimitException(
+            f"Requests are subject to concurrency limits {permit.semaphore_limits}, use acquire_permit instead."
+        )
+    return permit.delay
+
+
+def acquire_permit(
+    processing_units: float, repository: Repository, job_id: Optional[str] = None, lease_ttl_s: float = LEASE_TTL_S
+) -> Permit:
+    """
+    Decrements & fetches the Redis counters, calculates the delay and returns it as a part of `Permit`.
+
+    Besides the relative delay, the permit holds the deadline at which the request may be performed. Worker
+    should use `permit.wait()` to wait for it precisely (instead of sleeping for `permit.delay` after the
+    reply has arrived, which would make it oversleep by the network latency).
+
+    If concurrency is limited (for the account or for the job), the permit only records the semaphores; a lease
+    in them is taken once the permit has been waited for (by `permit.wait()` and `wait_for_capacity`, see
+    `take_lease`), so that the slots are held by the requests in flight and not by the waiting ones. The lease is
+    held until the request is reported as completed (see `complete` and `report_response`) or until it expires
+    after `lease_ttl_s`.
+
+    If `job_id` is given and the job has a quota set (see `set_job_quota`), the job's sub-buckets are
+    decremented in the same step as the account's buckets and can only make the delay longer.
+
     If syncer service is down (detected by self-expiring key not being in Redis), raises
     `SyncerDownException`. If this exception is caught, worker should handle retries in
     conventional way (ideally exponential backoff, limited to the time it takes for the
     offending bucket to refill itself from 0 to full).
     """
+    # some backends (e.g. permit server) calculate the whole permit on their side, in a single round trip:
+    permit = repository.issue_permit(processing_units, job_id, lease_ttl_s)
+    if permit is None:
+        permit = _acquire_permit(processing_units, repository, job_id, lease_ttl_s)
+    permit._take_lease = functools.partial(take_lease, repository=repository)
+    return permit
+
+
+def _acquire_permit(
+    processing_units: float, repository: Repository, job_id: Optional[str], lease_ttl_s: float
+) -> Permit:
     # figure out the types of the buckets so we know how much to decrement them:
     policy_refills = repository.get_policy_refills()
     policy_types = repository.get_policy_types()
+    rate_multiplier = repository.get_rate_multiplier()
     syncer_alive = repository.is_syncer_alive()
+    job_quota = repository.get_job_quota(job_id) if job_id is not None else None
+    semaphores = repository.get_semaphore_limits()
+    if job_quota is not None and job_quota.get("max_concurrent") is not None:
+        semaphores[job_bucket_id(PolicyType.CONCURRENCY.value, job_id)] = job_quota["max_concurrent"]
 
     logging.debug(f"Policy types: {policy_types}")
-    logging.debug(f"Policy bucket refills: {policy_refills}ns")
+    logging.debug(f"Policy bucket refills: {policy_refills}ns, rate multiplier: {rate_multiplier}")
 
     if not syncer_alive:
         raise SyncerDownException("Syncer service is down - revert to manual retries.")
 
-    # decrement buckets according to their type:
-    buckets_types_items = policy_types.items()
-    new_remaining = []
-    for policy_id, policy_type in buckets_types_items:
-        new_value = repository.increment_counter(
-            policy_id, -float(processing_units) if policy_type == PolicyType.PROCESSING_UNITS.value else -1.0
-        )
+    # decrement buckets according to their type (job sub-buckets refill slower, so waiting on them takes longer):
+    charges = {}
+    types = {}
+    refills_ns = {}
+    for policy_id, policy_type in policy_types.items():
+        charge = float(processing_units) if policy_type == PolicyType.PROCESSING_UNITS.value else 1.0
+        charges[policy_id] = charge
+        types[policy_id] = policy_type
+        # syncer fills the buckets slower when the rate multiplier is lowered:
+        refills_ns[policy_id] = float(policy_refills[policy_id]) / rate_multiplier
+        if job_quota is not None:
+            charges[job_bucket_id(policy_id, job_id)] = charge
+            types[job_bucket_id(policy_id, job_id)] = policy_type
+            refills_ns[job_bucket_id(policy_id, job_id)] = refills_ns[policy_id] / job_quota["refill_fraction"]
 
-        new_remaining.append(new_value)
-    new_remaining = dict(zip([policy_id for policy_id, _ in buckets_types_items], new_remaining))
+    amounts = {counter_id: -charge for counter_id, charge in charges.items()}
+    sent_at = time.monotonic()
+    new_remaining, server_time_ns = repository.increment_counters_timed(amounts)
+    decremented_at = (sent_at + time.monotonic()) / 2.0
 
     logging.debug(f"Bucket values after decrementing them: {new_remaining}")
-    wait_times_ns = [-new_remaining[policy_id] * float(policy_refills[policy_id]) for policy_id in new_remaining.keys()]
-    logging.debug(f"Wait times in s for each policy: {[0 if ns < 0 else ns / 1000000000. for ns in wait_times_ns]}")
-    delay_ns = max(wait_times_ns)
-    if delay_ns < 0:
-        return 0
+    wait_times_ns = {counter_id: -value * refills_ns[counter_id] for counter_id, value in new_remaining.items()}
+    logging.debug(
+        f"Wait times in s for each policy: {[0 if ns < 0 else ns / 1000000000. for ns in wait_times_ns.values()]}"
+    )
+    delay_ns = max(wait_times_ns.values())
+    delay = 0 if delay_ns <= 0 else delay_ns / 1000000000.0
+    recorder = get_trace_recorder()
+    if recorder is not None:
+        recorder.record(
+            "permit",
+            processing_units=float(processing_units),
+            job_id=job_id,
+            before={counter_id: value - amounts[counter_id] for counter_id, value in new_remaining.items()},
+            after=new_remaining,
+            rate_multiplier=rate_multiplier,
+            delay=delay,
+        )
+    return Permit(
+        delay=delay,
+        processing_units=float(processing_units),
+        charges=charges,
+        types=types,
+        job_id=job_id,
+        deadline=decremented_at + delay,
+        server_deadline_ns=server_time_ns + int(delay * 1000000000),
+        issued_at=decremented_at,
+        waits_ns=wait_times_ns,
+        refills_ns=refills_ns,
+        semaphore_limits=semaphores,
+        lease_ttl_s=lease_ttl_s,
+    )
+
+
+def acquire_permits(
+    processing_units: List[float],
+    repository: Repository,
+    job_id: Optional[str] = None,
+    lease_ttl_s: float = LEASE_TTL_S,
+) -> List[Permit]:
+    """
+    Acquires permits for several requests (with given PUs) at once, in a single round trip if the backend
+    supports it (see `Repository.issue_permits`). Otherwise it is the same as calling `acquire_permit` for each.
+    """
+    permits = repository.issue_permits(list(processing_units), job_id, lease_ttl_s)
+    if permits is not None:
+        for permit in permits:
+            permit._take_lease = functools.partial(take_lease, repository=repository)
+        return permits
+    return [acquire_permit(pu, repository, job_id=job_id, lease_ttl_s=lease_ttl_s) for pu in processing_units]
+
+
+def acquire_permit_any(
+    processing_units: float,
+    repositories: Dict[str, Repository],
+    job_id: Optional[str] = None,
+    lease_ttl_s: float = LEASE_TTL_S,
+) -> Permit:
+    """
+    Acquires a permit on the endpoint (Sentinel Hub deployment) with the shortest delay, for requests whose
+    data is available on several endpoints. `repositories` maps endpoints to the repositories holding their
+    buckets (see `SENTINELHUB_ROOT_URLS` in syncer); the chosen endpoint is set in `permit.endpoint`.
+
+    The delays are predicted from the current bucket values (a single read per endpoint) and the permit is
+    then acquired on the best endpoint as usual. Endpoints whose store can't be reached or whose syncer is down
+    are skipped; if that is the case for all of them, `SyncerDownException` is raised.
+    """
+    predicted_delays = {}
+    for endpoint, repository in repositories.items():
+        try:
+            predicted_delays[endpoint] = _predict_delay(processing_units, repository)
+        except Exception:
+            logging.warning(f"Could not predict the delay for {endpoint}, skipping it", exc_info=True)
+    logging.debug(f"Predicted delays in s for each endpoint: {predicted_delays}")
+    for endpoint in sorted(predicted_delays, key=predicted_delays.get):
+        try:
+            permit = acquire_permit(processing_units, repositories[endpoint], job_id=job_id, lease_ttl_s=lease_ttl_s)
+        except SyncerDownException:
+            logging.debug(f"Syncer for {endpoint} is down, trying the next endpoint")
+            continue
+        permit.endpoint = endpoint
+        return permit
+    raise SyncerDownException("All endpoints are unreachable or their syncers are down - revert to manual retries.")
+
+
+def _predict_delay(processing_units: float, repository: Repository) -> float:
+    # the delay the worker would get if it decremented the buckets now (job sub-quotas are not considered):
+    state = repository.get_backlog_state()
+    delay_ns = 0.0
+    for policy_id, policy_type in state["types"].items():
+        charge = float(processing_units) if policy_type == PolicyType.PROCESSING_UNITS.value else 1.0
+        refill_ns = float(state["refills"][policy_id]) / state["rate_multiplier"]
+        delay_ns = max(delay_ns, (charge - state["remaining"].get(policy_id, 0.0)) * refill_ns)
     return delay_ns / 1000000000.0
+
+
+def take_lease(permit: Permit, repository: Repository, lease_ttl_s: Optional[float] = None):
+    """
+    Takes a lease in the concurrency semaphores the permit is subject to (if any), blocking until there is a free
+    slot in each of them. It should be called once the permit has been waited for, right before the request is
+    performed (`permit.wait()` and `wait_for_capacity` do that). Taking a lease more than once has no effect.
+    """
+    if not permit.semaphore_limits or permit.lease_id is not None:
+        return
+    if lease_ttl_s is None:
+        lease_ttl_s = permit.lease_ttl_s if permit.lease_ttl_s is not None else LEASE_TTL_S
+    lease_id = uuid.uuid4().hex
+    _acquire_lease(permit.semaphore_limits, lease_id, lease_ttl_s, repository)
+    permit.lease_id = lease_id
+    permit.semaphores = list(permit.semaphore_limits.keys())
+
+
+def _acquire_lease(semaphores: Dict[str, int], lease_id: str, lease_ttl_s: float, repository: Repository):
+    subscription = None
+    try:
+        while True:
+            wait_ms = repository.acquire_lease(semaphores, lease_id, int(lease_ttl_s * 1000))
+            if wait_ms is None:
+                return
+
+            # all slots are taken - wait until a lease is released (or until one of them expires):
+            logging.debug(f"No free slot in semaphores {list(semaphores.keys())}, waiting...")
+            if subscription is None:
+                subscription = repository.subscribe_capacity()
+            poll_at = time.monotonic() + min(wait_ms / 1000.0, LEASE_POLL_S)
+            while time.monotonic() < poll_at:
+                credits = subscription.get(poll_at - time.monotonic())
+                if credits is not None and any(semaphore_id in credits for semaphore_id in semaphores):
+                    break
+    finally:
+        if subscription is not None:
+            subscription.close()
+
+
+def wait_for_capacity(permit: Permit, repository: Repository) -> float:
+    """
+    Waits until the permit's deadline, but wakes up earlier if capacity is returned to the buckets in the
+    meantime (by `release`, `refund` or by syncer correcting the buckets upwards). If concurrency is limited,
+    a lease is then taken (see `take_lease`).
+
+    Returns the overshoot, the same as `permit.wait()`. Waiting this way needs a subscription to the backing
+    store, so it only pays off for longer delays; shorter ones are simply slept through.
+    """
+    if permit.deadline - time.monotonic() >= WAKE_ON_CAPACITY_MIN_DELAY_S:
+        _wait_for_credits(permit, repository)
+    overshoot = permit.wait()
+    # permits which were not acquired with `acquire_permit` don't take the lease by themselves:
+    take_lease(permit, repository)
+    return overshoot
+
+
+def _wait_for_credits(permit: Permit, repository: Repository):
+    subscription = repository.subscribe_capacity()
+    try:
+        while True:
+            remaining = permit.deadline - time.monotonic()
+            if remaining <= SPIN_S:
+                break
+            credits = subscription.get(remaining - SPIN_S)
+            if credits is not None:
+                permit.apply_credits(credits)
+                logging.debug(f"Capacity was added, deadline moved to {permit.deadline - time.monotonic():.3f}s")
+    finally:
+        subscription.close()
+
+
+def _return_capacity(credits: Dict[str, float], repository: Repository):
+    # waiting workers can start earlier by the amount of capacity that was returned:
+    repository.return_capacity(credits)
+
+
+def release(permit: Permit, repository: Repository):
+    """
+    Returns everything the permit has charged, for example when the request was not performed after all.
+
+    The capacity is immediately available to other workers. Releasing a permit more than once has no effect.
+    """
+    if permit.released:
+        return
+    _return_capacity(permit.charges, repository)
+    permit.charges = {counter_id: 0.0 for counter_id in permit.charges}
+    permit.released = True
+    complete(permit, repository)
+
+
+def complete(permit: Permit, repository: Repository):
+    """
+    Marks the permitted request as completed, releasing the permit's slot in the concurrency semaphores.
+
+    Completing a permit more than once (or a permit without a lease) has no effect.
+    """
+    if permit.lease_id is None:
+        return
+    repository.release_lease(permit.semaphores, permit.lease_id)
+    # workers waiting for a free slot are notified the same way as those waiting for capacity:
+    repository.publish_capacity({semaphore_id: 1.0 for semaphore_id in permit.semaphores})
+    permit.lease_id = None
+
+
+def renew(permit: Permit, repository: Repository, lease_ttl_s: float = LEASE_TTL_S):
+    """
+    Extends the permit's lease, for requests which take longer than the lease TTL.
+    """
+    if permit.lease_id is not None:
+        repository.renew_lease(permit.semaphores, permit.lease_id, int(lease_ttl_s * 1000))
+
+
+def refund(permit: Permit, actual_processing_units: float, repository: Repository):
+    """
+    Corrects the PU charged by the permit when the request used a different number of PUs than estimated.
+
+    The difference is returned to (or, if the request used more than estimated, taken from) the PU buckets;
+    request buckets are not affected because the request was performed.
+    """
+    if permit.released:
+        return
+    corrections = {}
+    for counter_id, policy_type in permit.types.items():
+        if policy_type != PolicyType.PROCESSING_UNITS.value:
+            continue
+        corrections[counter_id] = permit.charges[counter_id] - float(actual_processing_units)
+        permit.charges[counter_id] = float(actual_processing_units)
+    permit.processing_units = float(actual_processing_units)
+    if corrections:
+        _return_capacity(corrections, repository)
+
+
+def report_response(permit: Permit, response, repository: Repository):
+    """
+    Corrects the buckets using the information Sentinel Hub returned with the response to the permitted request.
+
+    `response` is expected to have `status_code` and `headers` attributes (as `requests` and `httpx`
+    responses do). On success the PU buckets are corrected by the actually spent PUs (see `refund`). On
+    429 the request was not performed, so the permit's charges are returned, but all of the buckets are
+    pushed into debt so that nobody is allowed to make a request before the time Sentinel Hub asked for.
+    The response is also reported to the shared rate multiplier (see `report_429` and `report_success`),
+    and the request is marked as completed (see `complete`).
+    """
+    complete(permit, repository)
+    recorder = get_trace_recorder()
+    if recorder is not None:
+        recorder.record(
+            "response",
+            status_code=response.status_code,
+            processing_units=permit.processing_units,
+            processing_units_spent=_parse_header_float(response.headers.get(PROCESSING_UNITS_SPENT_HEADER)),
+            retry_after_ms=_parse_header_float(response.headers.get(RETRY_AFTER_HEADER)),
+        )
+    if response.status_code == 429:
+        retry_after_ms = _parse_header_float(response.headers.get(RETRY_AFTER_HEADER)) or 0.0
+        _apply_retry_after(permit, retry_after_ms, repository)
+        report_429(repository)
+        return
+    if response.status_code < 400:
+        report_success(repository)
+
+    processing_units_spent = _parse_header_float(response.headers.get(PROCESSING_UNITS_SPENT_HEADER))
+    if processing_units_spent is not None:
+        refund(permit, processing_units_spent, repository)
+
+
+def _parse_header_float(value: Optional[str]) -> Optional[float]:
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        logging.warning(f"Could not parse header value: {value}")
+        return None
+
+
+def _apply_retry_after(permit: Permit, retry_after_ms: float, repository: Repository):
+    policy_refills = repository.get_policy_refills()
+    bucket_values = repository.get_counters(list(policy_refills.keys()))
+
+    # the buckets are out of sync - the debt we set is the amount the syncer will need to fill the buckets
+    # with before the delay (for the next worker) reaches 0:
+    corrections = {}
+    for policy_id, refill_ns in policy_refills.items():
+        if policy_id not in bucket_values:
+            continue
+        bucket_value = bucket_values[policy_id] + permit.charges.get(policy_id, 0.0)
+        target_value = min(bucket_value, -retry_after_ms * 1000000.0 / float(refill_ns))
+        corrections[policy_id] = target_value - bucket_values[policy_id]
+    # job sub-buckets are not out of sync, we just give back what the permit has taken:
+    for counter_id, charge in permit.charges.items():
+        if counter_id not in corrections:
+            corrections[counter_id] = charge
+
+    logging.debug(f"Got 429, retry after {retry_after_ms}ms - correcting buckets by {corrections}")
+    _return_capacity(corrections, repository)
+    permit.charges = {counter_id: 0.0 for counter_id in permit.charges}
+    permit.released = True
+
+
+def report_429(repository: Repository) -> float:
+    """
+    Lowers the rate multiplier shared by all workers, because Sentinel Hub responded with 429.
+
+    Returns the new rate multiplier.
+    """
+
+    def decrease(value: float, decreased_at_ms: float):
+        now_ms = time.time() * 1000
+        if now_ms - decreased_at_ms < RATE_MULTIPLIER_DECREASE_COOLDOWN_MS:
+            return None
+        return max(value * RATE_MULTIPLIER_DECREASE_FACTOR, RATE_MULTIPLIER_MIN), now_ms
+
+    rate_multiplier = repository.update_rate_multiplier(decrease)
+    logging.debug(f"Reported 429, rate multiplier is {rate_multiplier}")
+    return rate_multiplier
+
+
+def report_success(repository: Repository) -> float:
+    """
+    Raises the rate multiplier shared by all workers (if it was lowered), because a request has succeeded.
+
+    Returns the new rate multiplier.
+    """
+    # most of the time the multiplier is at its maximum, in which case there is no need to write anything:
+    rate_multiplier = repository.get_rate_multiplier()
+    if rate_multiplier >= 1.0:
+        return rate_multiplier
+
+    def increase(value: float, decreased_at_ms: float):
+        if value >= 1.0:
+            return None
+        return min(value + RATE_MULTIPLIER_INCREASE_STEP, 1.0), decreased_at_ms
+
+    return repository.update_rate_multiplier(increase)
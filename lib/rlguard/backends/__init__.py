@@ -0,0 +1,67 @@
+"""
+Registry of repository backends, used by `Repository.from_url`.
+
+Each backend is a function which creates the repository from the URL. Built-in backends (and the client libraries
+they use) are only imported when their scheme is requested; other packages can provide backends through the
+`rlguard.backends` entry point group (e.g. `myscheme = mypackage.backend:from_url`) or by calling
+`register_backend`.
+"""
+import importlib
+import logging
+from typing import Callable, Dict
+
+logger = logging.getLogger(__name__)
+
+ENTRY_POINT_GROUP = "rlguard.backends"
+
+# URL scheme -> "module:function" (relative to this package) which creates the repository:
+BUILTIN_BACKENDS = {
+    "redis": ".redis:from_url",
+    "rediss": ".redis:from_url",
+    "unix": ".redis:from_url",
+    "zk": ".zookeeper:from_url",
+    "zookeeper": ".zookeeper:from_url",
+    "memory": ".memory:from_url",
+    "permit": ".permitserver:from_url",
+}
+
+_backends: Dict[str, Callable] = {}
+
+
+def register_backend(scheme: str, factory: Callable):
+    """
+    Registers the function which creates the repository (from the URL) for the given URL scheme.
+    """
+    _backends[scheme] = factory
+
+
+def get_backend(scheme: str) -> Callable:
+    """
+    Returns the function which creates the repository for the given URL scheme, importing its module if needed.
+    """
+    if scheme in _backends:
+        return _backends[scheme]
+
+    if scheme in BUILTIN_BACKENDS:
+        module_name, function_name = BUILTIN_BACKENDS[scheme].split(":")
+        factory = getattr(importlib.import_module(module_name, __name__), function_name)
+    else:
+        # entry points are only looked up as a last resort (it means reading the metadata of all packages):
+        entry_point = next((ep for ep in _entry_points() if ep.name == scheme), None)
+        if entry_point is None:
+            raise ValueError(f"No repository backend for URL scheme {scheme!r}.")
+        logger.debug(f"Loading repository backend {entry_point.value} for URL scheme {scheme!r}")
+        factory = entry_point.load()
+
+    _backends[scheme] = factory
+    return factory
+
+
+def _entry_points():
+    from importlib.metadata import entry_points
+
+    eps = entry_points()
+    # `select` is only available since Python 3.10:
+    if hasattr(eps, "select"):
+        return eps.select(group=ENTRY_POINT_GROUP)
+    return eps.get(ENTRY_POINT_GROUP, [])
@@ -0,0 +1,288 @@
+"""
+Repository which keeps everything in the memory of the process - for tests, simulations, and for workers and syncer
+which run in the same process.
+"""
+import queue
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+from .. import is_job_bucket_id
+from ..repository import CapacitySubscription, Repository
+
+# named repositories (`memory://<name>`), so that the same one can be created from the URL more than once:
+_instances: Dict[str, "MemoryRepository"] = {}
+_instances_lock = threading.Lock()
+
+
+class MemoryCapacitySubscription(CapacitySubscription):
+    def __init__(self, subscriptions: List["MemoryCapacitySubscription"], lock: threading.RLock):
+        self._credits = queue.Queue()
+        self._subscriptions = subscriptions
+        self._lock = lock
+        with self._lock:
+            self._subscriptions.append(self)
+
+    def put(self, credits: Dict[str, float]):
+        self._credits.put(dict(credits))
+
+    def get(self, timeout_s: float) -> Optional[Dict[str, float]]:
+        try:
+            return self._credits.get(timeout=max(timeout_s, 0.0))
+        except queue.Empty:
+            return None
+
+    def close(self):
+        with self._lock:
+            if self in self._subscriptions:
+                self._subscriptions.remove(self)
+
+
+class MemoryRepository(Repository):
+    def __init__(self):
+        super().__init__()
+
+        # all of the state is guarded by a single lock, so the increments (and leases) are atomic:
+        self._lock = threading.RLock()
+        self._remaining: Dict[str, float] = {}
+        self._refills: Dict[str, int] = {}
+        self._types: Dict[str, str] = {}
+        self._capacities: Dict[str, float] = {}
+        self._job_quotas: Dict[str, dict] = {}
+        self._rate_multiplier = {"value": 1.0, "decreased_at_ms": 0.0}
+        self._semaphores: Dict[str, int] = {}
+        # semaphore id -> lease id -> expiry time in ms:
+        self._leases: Dict[str, Dict[str, int]] = {}
+        self._permit_rates: Dict[str, float] = {}
+        # signature -> (cost, expiry time in ms):
+        self._learned_costs: Dict[str, Tuple[dict, int]] = {}
+        self._alive_until_ms = 0
+        self._access_token: Optional[dict] = None
+        self._subscriptions: List[MemoryCapacitySubscription] = []
+
+    @staticmethod
+    def _now_ms():
+        return int(time.time() * 1000)
+
+    def init_rate_limits(self, rate_limits: List[dict], expires_within_ms: int):
+        with self._lock:
+            self._remaining = {policy["id"]: float(policy["initial"]) for policy in rate_limits}
+            self._refills = {policy["id"]: policy["nanos_between_refills"] for policy in rate_limits}
+            self._types = {policy["id"]: policy["type"] for policy in rate_limits}
+            self._capacities = {policy["id"]: float(policy["capacity"]) for policy in rate_limits}
+            self.signal_syncer_alive(expires_within_ms)
+
+    def increment_counter(self, policy_id: str, amount: float) -> float:
+        with self._lock:
+            self._remaining[policy_id] = self._remaining.get(policy_id, 0.0) + float(amount)
+            return self._remaining[policy_id]
+
+    def increment_counters(self, amounts: Dict[str, float]) -> Dict[str, float]:
+        with self._lock:
+            return {counter_id: self.increment_counter(counter_id, amount) for counter_id, amount in amounts.items()}
+
+    def increment_counters_timed(self, amounts: Dict[str, float]) -> Tuple[Dict[str, float], int]:
+        with self._lock:
+            return self.increment_counters(amounts), time.time_ns()
+
+    def acquire_lease(self, semaphores: Dict[str, int], lease_id: str, lease_ttl_ms: int) -> Optional[float]:
+        with self._lock:
+            now_ms = self._now_ms()
+            wait_ms = -1.0
+            for semaphore_id, limit in semaphores.items():
+                leases = self._active_leases(semaphore_id, now_ms)
+                if len(leases) >= limit:
+                    semaphore_wait_ms = min(leases.values()) - now_ms if leases else lease_ttl_ms
+                    wait_ms = max(wait_ms, semaphore_wait_ms)
+            if wait_ms >= 0:
+                return wait_ms
+
+            for semaphore_id in semaphores:
+                self._leases[semaphore_id][lease_id] = now_ms + lease_ttl_ms
+            return None
+
+    def _active_leases(self, semaphore_id: str, now_ms: int) -> Dict[str, int]:
+        leases = self._leases.setdefault(semaphore_id, {})
+        for lease_id in [lease_id for lease_id, expires_at_ms in leases.items() if expires_at_ms <= now_ms]:
+            del leases[lease_id]
+        return leases
+
+    def renew_lease(self, semaphore_ids: List[str], lease_id: str, lease_ttl_ms: int):
+        with self._lock:
+            expires_at_ms = self._now_ms() + lease_ttl_ms
+            for semaphore_id in semaphore_ids:
+                leases = self._leases.get(semaphore_id, {})
+                if lease_id in leases:
+                    leases[lease_id] = expires_at_ms
+
+    def release_lease(self, semaphore_ids: List[str], lease_id: str):
+        with self._lock:
+            for semaphore_id in semaphore_ids:
+                self._leases.get(semaphore_id, {}).pop(lease_id, None)
+
+    def init_semaphores(self, semaphore_limits: Dict[str, int]):
+        with self._lock:
+            self._semaphores = dict(semaphore_limits)
+
+    def get_semaphore_limits(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._semaphores)
+
+    def get_counters(self, counter_ids: List[str]) -> Dict[str, float]:
+        with self._lock:
+            remaining = self._remaining
+            return {counter_id: remaining[counter_id] for counter_id in counter_ids if counter_id in remaining}
+
+    def get_policy_types(self) -> dict:
+        with self._lock:
+            return dict(self._types)
+
+    def get_policy_refills(self) -> dict:
+        with self._lock:
+            return dict(self._refills)
+
+    def set_policy_refills(self, policy_refills: Dict[str, int]):
+        with self._lock:
+            self._refills.update(policy_refills)
+
+    def get_policy_capacities(self) -> dict:
+        with self._lock:
+            return dict(self._capacities)
+
+    def set_policy_capacities(self, policy_capacities: Dict[str, float]):
+        with self._lock:
+            self._capacities.update({k: float(v) for k, v in policy_capacities.items()})
+
+    def get_buckets_state(self) -> dict:
+        with self._lock:
+            return dict(self._remaining)
+
+    def get_job_quota(self, job_id: str) -> Optional[dict]:
+        with self._lock:
+            quota = self._job_quotas.get(job_id)
+            return dict(quota) if quota is not None else None
+
+    def get_job_quotas(self) -> Dict[str, dict]:
+        with self._lock:
+            return {job_id: dict(quota) for job_id, quota in self._job_quotas.items()}
+
+    def save_job_quota(self, job_id: str, quota: dict):
+        with self._lock:
+            self._job_quotas[job_id] = dict(quota)
+
+    def delete_job_quota(self, job_id: str):
+        with self._lock:
+            self._job_quotas.pop(job_id, None)
+            for counter_id in [counter_id for counter_id in self._remaining if is_job_bucket_id(counter_id, job_id)]:
+                del self._remaining[counter_id]
+
+    def get_learned_cost(self, signature: str) -> Optional[dict]:
+        with self._lock:
+            cost, expires_at_ms = self._learned_costs.get(signature, (None, 0))
+            if expires_at_ms <= self._now_ms():
+                self._learned_costs.pop(signature, None)
+                return None
+            return dict(cost)
+
+    def save_learned_cost(self, signature: str, cost: dict, ttl_s: float):
+        with self._lock:
+            self._learned_costs[signature] = (dict(cost), self._now_ms() + int(ttl_s * 1000))
+
+    def purge_learned_costs(self):
+        with self._lock:
+            now_ms = self._now_ms()
+            for signature, (_, expires_at_ms) in list(self._learned_costs.items()):
+                if expires_at_ms <= now_ms:
+                    del self._learned_costs[signature]
+
+    def get_rate_multiplier(self) -> float:
+        with self._lock:
+            return self._rate_multiplier["value"]
+
+    def update_rate_multiplier(self, update: Callable[[float, float], Optional[Tuple[float, float]]]) -> float:
+        with self._lock:
+            updated = update(self._rate_multiplier["value"], self._rate_multiplier["decreased_at_ms"])
+            if updated is not None:
+                self._rate_multiplier = {"value": updated[0], "decreased_at_ms": updated[1]}
+            return self._rate_multiplier["value"]
+
+    def publish_capacity(self, credits: Dict[str, float]):
+        with self._lock:
+            for subscription in self._subscriptions:
+                subscription.put(credits)
+
+    def subscribe_capacity(self) -> CapacitySubscription:
+        return MemoryCapacitySubscription(self._subscriptions, self._lock)
+
+    def save_permit_rates(self, permit_rates: Dict[str, float]):
+        with self._lock:
+            self._permit_rates = dict(permit_rates)
+
+    def get_backlog_state(self) -> dict:
+        with self._lock:
+            return {
+                "types": dict(self._types),
+                "refills": {k: float(v) for k, v in self._refills.items()},
+                "capacities": dict(self._capacities),
+                "remaining": dict(self._remaining),
+                "permit_rates": dict(self._permit_rates),
+                "rate_multiplier": self._rate_multiplier["value"],
+            }
+
+    def is_syncer_alive(self) -> bool:
+        return self._now_ms() <= self._alive_until_ms
+
+    def signal_syncer_alive(self, expires_within_ms: int):
+        self._alive_until_ms = self._now_ms() + expires_within_ms
+
+    def get_access_token(self) -> Optional[dict]:
+        return self._access_token
+
+    def save_access_token(self, token: str, expires_at_s: int):
+        self._access_token = {"token": token, "expires_at": expires_at_s * 1000}
+
+    def snapshot(self) -> dict:
+        """
+        Returns the state of the buckets (JSON-serializable), so that it can be saved and restored later (see
+        `restore`). Subscriptions, the access token, liveness of syncer and the learned costs (which are relearned
+        from the responses anyway) are not included.
+        """
+        with self._lock:
+            return {
+                "remaining": dict(self._remaining),
+                "refills": dict(self._refills),
+                "types": dict(self._types),
+                "capacities": dict(self._capacities),
+                "job_quotas": {job_id: dict(quota) for job_id, quota in self._job_quotas.items()},
+                "rate_multiplier": dict(self._rate_multiplier),
+                "semaphores": dict(self._semaphores),
+                "leases": {semaphore_id: dict(leases) for semaphore_id, leases in self._leases.items()},
+                "permit_rates": dict(self._permit_rates),
+            }
+
+    def restore(self, snapshot: dict):
+        with self._lock:
+            self._remaining = {k: float(v) for k, v in snapshot["remaining"].items()}
+            self._refills = dict(snapshot["refills"])
+            self._types = dict(snapshot["types"])
+            self._capacities = {k: float(v) for k, v in snapshot["capacities"].items()}
+            self._job_quotas = {job_id: dict(quota) for job_id, quota in snapshot["job_quotas"].items()}
+            self._rate_multiplier = dict(snapshot["rate_multiplier"])
+            self._semaphores = dict(snapshot["semaphores"])
+            self._leases = {semaphore_id: dict(leases) for semaphore_id, leases in snapshot["leases"].items()}
+            self._permit_rates = dict(snapshot["permit_rates"])
+
+
+def from_url(url: str) -> Repository:
+    """
+    `memory://` creates a new repository, while `memory://<name>` returns the same repository for the same name
+    (within the process).
+    """
+    name = urlsplit(url).netloc
+    if not name:
+        return MemoryRepository()
+    with _instances_lock:
+        if name not in _instances:
+            _instances[name] = MemoryRepository()
+        return _instances[name]
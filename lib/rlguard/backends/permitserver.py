@@ -0,0 +1,287 @@
+"""
+Client of the permit server (`syncer/permitserver.py`), which keeps the buckets in its memory and issues the permits
+itself, so that acquiring a permit costs a single round trip.
+"""
+import http.client
+import json
+import queue
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+from urllib.parse import unquote, urlsplit
+
+from .. import SyncerDownException
+from ..permit import Permit
+from ..repository import CapacitySubscription, Repository
+
+DEFAULT_PORT = 8001
+POOL_SIZE = 16
+TIMEOUT_S = 10.0
+
+
+class PermitServerError(Exception):
+    pass
+
+
+class PermitServerCapacitySubscription(CapacitySubscription):
+    def __init__(self, repository: "PermitServerRepository"):
+        self._repository = repository
+        self._subscription_id = repository._request("POST", "/subscriptions")["id"]
+
+    def get(self, timeout_s: float) -> Optional[Dict[str, float]]:
+        timeout_s = max(timeout_s, 0.0)
+        reply = self._repository._request(
+            "POST",
+            f"/subscriptions/{self._subscription_id}",
+            {"timeout_s": timeout_s},
+            timeout_s=self._repository.timeout_s + timeout_s,
+        )
+        return reply["credits"]
+
+    def close(self):
+        self._repository._request("DELETE", f"/subscriptions/{self._subscription_id}")
+
+
+class PermitServerRepository(Repository):
+    """
+    Talks to the permit server over pooled keep-alive HTTP connections. `acquire_permit` (and `apply_for_request`)
+    get the whole permit from the server; the other methods of `Repository` are forwarded to the server's
+    in-memory repository one by one. The server syncs its buckets itself, so the methods which only syncer uses
+    raise `PermitServerError`.
+
+    `token` is the shared secret of the server (its `PERMIT_SERVER_TOKEN`), if it has one.
+    """
+
+    def __init__(
+        self,
+        host: str,
+        port: int = DEFAULT_PORT,
+        pool_size: int = POOL_SIZE,
+        timeout_s: float = TIMEOUT_S,
+        token: Optional[str] = None,
+    ):
+        super().__init__()
+        self.host = host
+        self.port = port
+        self.timeout_s = timeout_s
+        self.token = token
+        # the most recently used connections are reused first, so the idle ones can time out:
+        self._pool = queue.LifoQueue(maxsize=pool_size)
+
+    def _request(
+        self,
+        method: str,
+        path: str,
+        body: Optional[dict] = None,
+        timeout_s: Optional[float] = None,
+        idempotent: bool = False,
+    ):
+        payload = json.dumps(body or {}).encode()
+        headers = {"Content-Type": "application/json", "Content-Length": str(len(payload))}
+        if self.token is not None:
+            headers["Authorization"] = f"Bearer {self.token}"
+        timeout_s = self.timeout_s if timeout_s is None else timeout_s
+        for attempt in range(2):
+            try:
+                connection, reused = self._pool.get_nowait(), True
+            except queue.Empty:
+                connection, reused = http.client.HTTPConnection(self.host, self.port, timeout=timeout_s), False
+            sent = False
+            try:
+                connection.timeout = timeout_s
+                if connection.sock is not None:
+                    connection.sock.settimeout(timeout_s)
+                connection.request(method, path, body=payload, headers=headers)
+                sent = True
+                response = connection.getresponse()
+                reply = json.loads(response.read() or b"null")
+            except (ConnectionError, http.client.HTTPException):
+                connection.close()
+                # the server might have closed the idle connection in the meantime - try once more on a new one, but
+                # only if the server can't have handled the request already (a repeated permit would be charged twice):
+                if reused and attempt == 0 and (idempotent or not sent):
+                    continue
+                raise
+            except Exception:
+                connection.close()
+                raise
+            if response.will_close:
+                connection.close()
+            else:
+                try:
+                    self._pool.put_nowait(connection)
+                except queue.Full:
+                    connection.close()
+            break
+
+        if response.status == 401:
+            raise PermitServerError(f"{method} {path} was refused, check the token of the permit server: {reply}")
+        if response.status == 503:
+            raise SyncerDownException(reply.get("message", "Syncer service is down - revert to manual retries."))
+        if response.status != 200:
+            raise PermitServerError(f"{method} {path} failed with {response.status}: {reply}")
+        return reply
+
+    def _call(self, method: str, *args):
+        idempotent = method.startswith(("get_", "is_"))
+        return self._request("POST", f"/call/{method}", {"args": list(args)}, idempotent=idempotent)["result"]
+
+    @staticmethod
+    def _syncer_only(method: str):
+        raise PermitServerError(f"{method} is not available, the permit server syncs its buckets itself")
+
+    @staticmethod
+    def _permit(permit_json: dict, sent_at: float, received_at: float) -> Permit:
+        # the permit was issued `age_s` before the reply was sent; the reply is assumed to take half of the round
+        # trip to arrive (the round trip includes the time the server took to issue the permit, e.g. waiting for
+        # the lock of its repository, so this is only an upper bound of the latency):
+        age_s = permit_json.pop("age_s")
+        latency_s = max(received_at - sent_at - age_s, 0.0) / 2.0
+        permit = Permit(**permit_json)
+        permit.issued_at = received_at - latency_s - age_s
+        permit.deadline = permit.issued_at + permit.delay
+        return permit
+
+    def issue_permit(self, processing_units: float, job_id: Optional[str], lease_ttl_s: float) -> Optional[Permit]:
+        sent_at = time.monotonic()
+        permit_json = self._request(
+            "POST",
+            "/acquire",
+            {"processing_units": float(processing_units), "job_id": job_id, "lease_ttl_s": lease_ttl_s},
+        )
+        return self._permit(permit_json, sent_at, time.monotonic())
+
+    def issue_permits(
+        self, processing_units: List[float], job_id: Optional[str], lease_ttl_s: float
+    ) -> Optional[List[Permit]]:
+        sent_at = time.monotonic()
+        reply = self._request(
+            "POST",
+            "/acquire_batch",
+            {"processing_units": [float(pu) for pu in processing_units], "job_id": job_id, "lease_ttl_s": lease_ttl_s},
+        )
+        received_at = time.monotonic()
+        return [self._permit(permit_json, sent_at, received_at) for permit_json in reply["permits"]]
+
+    def return_capacity(self, credits: Dict[str, float]):
+        self._request("POST", "/refund", {"credits": credits})
+
+    def init_rate_limits(self, rate_limits: List[dict], expires_within_ms: int):
+        self._syncer_only("init_rate_limits")
+
+    def increment_counter(self, policy_id: str, amount: float) -> float:
+        return self._call("increment_counter", policy_id, amount)
+
+    def increment_counters(self, amounts: Dict[str, float]) -> Dict[str, float]:
+        return self._call("increment_counters", amounts)
+
+    def increment_counters_timed(self, amounts: Dict[str, float]) -> Tuple[Dict[str, float], int]:
+        new_values, server_time_ns = self._call("increment_counters_timed", amounts)
+        return new_values, server_time_ns
+
+    def acquire_lease(self, semaphores: Dict[str, int], lease_id: str, lease_ttl_ms: int) -> Optional[float]:
+        return self._call("acquire_lease", semaphores, lease_id, lease_ttl_ms)
+
+    def renew_lease(self, semaphore_ids: List[str], lease_id: str, lease_ttl_ms: int):
+        self._call("renew_lease", semaphore_ids, lease_id, lease_ttl_ms)
+
+    def release_lease(self, semaphore_ids: List[str], lease_id: str):
+        self._call("release_lease", semaphore_ids, lease_id)
+
+    def init_semaphores(self, semaphore_limits: Dict[str, int]):
+        self._syncer_only("init_semaphores")
+
+    def get_semaphore_limits(self) -> Dict[str, int]:
+        return self._call("get_semaphore_limits")
+
+    def get_counters(self, counter_ids: List[str]) -> Dict[str, float]:
+        return self._call("get_counters", counter_ids)
+
+    def get_policy_types(self) -> dict:
+        return self._call("get_policy_types")
+
+    def get_policy_refills(self) -> dict:
+        return self._call("get_policy_refills")
+
+    def set_policy_refills(self, policy_refills: Dict[str, int]):
+        self._syncer_only("set_policy_refills")
+
+    def get_policy_capacities(self) -> dict:
+        return self._call("get_policy_capacities")
+
+    def set_policy_capacities(self, policy_capacities: Dict[str, float]):
+        self._syncer_only("set_policy_capacities")
+
+    def get_buckets_state(self) -> dict:
+        return self._call("get_buckets_state")
+
+    def get_job_quota(self, job_id: str) -> Optional[dict]:
+        return self._call("get_job_quota", job_id)
+
+    def get_job_quotas(self) -> Dict[str, dict]:
+        return self._call("get_job_quotas")
+
+    def save_job_quota(self, job_id: str, quota: dict):
+        self._call("save_job_quota", job_id, quota)
+
+    def delete_job_quota(self, job_id: str):
+        self._call("delete_job_quota", job_id)
+
+    def get_learned_cost(self, signature: str) -> Optional[dict]:
+        return self._call("get_learned_cost", signature)
+
+    def save_learned_cost(self, signature: str, cost: dict, ttl_s: float):
+        self._call("save_learned_cost", signature, cost, ttl_s)
+
+    def purge_learned_costs(self):
+        self._call("purge_learned_costs")
+
+    def get_rate_multiplier(self) -> float:
+        return self._call("get_rate_multiplier")
+
+    def update_rate_multiplier(self, update: Callable[[float, float], Optional[Tuple[float, float]]]) -> float:
+        # `update` can't be sent to the server, so it is applied here and stored with compare-and-set:
+        while True:
+            state = self._request("GET", "/rate_multiplier", idempotent=True)
+            updated = update(state["value"], state["decreased_at_ms"])
+            if updated is None:
+                return state["value"]
+            reply = self._request(
+                "POST",
+                "/rate_multiplier",
+                {"expected": [state["value"], state["decreased_at_ms"]], "new": list(updated)},
+            )
+            if reply["updated"]:
+                return reply["value"]
+
+    def publish_capacity(self, credits: Dict[str, float]):
+        self._call("publish_capacity", credits)
+
+    def subscribe_capacity(self) -> CapacitySubscription:
+        return PermitServerCapacitySubscription(self)
+
+    def save_permit_rates(self, permit_rates: Dict[str, float]):
+        self._syncer_only("save_permit_rates")
+
+    def get_backlog_state(self) -> dict:
+        return self._call("get_backlog_state")
+
+    def is_syncer_alive(self) -> bool:
+        return self._call("is_syncer_alive")
+
+    def signal_syncer_alive(self, expires_within_ms: int):
+        self._syncer_only("signal_syncer_alive")
+
+    def get_access_token(self) -> Optional[dict]:
+        self._syncer_only("get_access_token")
+
+    def save_access_token(self, token: str, expires_at_s: int):
+        self._syncer_only("save_access_token")
+
+
+def from_url(url: str) -> Repository:
+    """
+    `permit://host:port`, e.g. `permit://127.0.0.1:8001`, or `permit://token@host:port` if the server has a token.
+    """
+    parts = urlsplit(url)
+    token = unquote(parts.username) if parts.username else None
+    return PermitServerRepository(parts.hostname or "127.0.0.1", parts.port or DEFAULT_PORT, token=token)
@@ -0,0 +1,307 @@
+"""
+Repository backed by Redis (install `rlguard-lib[redis]`).
+"""
+import json
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+from redis import Redis
+from redis.exceptions import WatchError
+
+from .. import is_job_bucket_id
+from ..repository import CapacitySubscription, Repository
+
+
+class RedisCapacitySubscription(CapacitySubscription):
+    def __init__(self, rds: Redis, channel: str):
+        self._pubsub = rds.pubsub(ignore_subscribe_messages=True)
+        self._pubsub.subscribe(channel)
+
+    def get(self, timeout_s: float) -> Optional[Dict[str, float]]:
+        deadline = time.monotonic() + timeout_s
+        while True:
+            # `get_message` returns None for (ignored) subscribe confirmations too, so we might need to retry:
+            message = self._pubsub.get_message(timeout=max(deadline - time.monotonic(), 0.0))
+            if message is not None:
+                return json.loads(message["data"])
+            if time.monotonic() >= deadline:
+                return None
+
+    def close(self):
+        self._pubsub.close()
+
+
+# Takes a lease in each of the semaphores (sorted sets of lease ids, scored by expiry time), but only if none
+# of them is full. Time is taken from Redis so that the leases of all workers expire consistently (scripts are
+# replicated by their effects since Redis 5, so calling TIME before writing is allowed).
+#   KEYS: semaphore sorted sets...
+#   ARGV: lease id, lease TTL in ms, limits of semaphores...
+ACQUIRE_LEASE_SCRIPT = """
+local time = redis.call('TIME')
+local now_ms = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+local wait_ms = -1
+for i = 1, #KEYS do
+    redis.call('ZREMRANGEBYSCORE', KEYS[i], '-inf', now_ms)
+    if redis.call('ZCARD', KEYS[i]) >= tonumber(ARGV[2 + i]) then
+        local first = redis.call('ZRANGE', KEYS[i], 0, 0, 'WITHSCORES')
+        local semaphore_wait_ms = first[2] and (tonumber(first[2]) - now_ms) or tonumber(ARGV[2])
+        wait_ms = math.max(wait_ms, semaphore_wait_ms)
+    end
+end
+if wait_ms >= 0 then
+    return tostring(wait_ms)
+end
+for i = 1, #KEYS do
+    redis.call('ZADD', KEYS[i], now_ms + tonumber(ARGV[2]), ARGV[1])
+end
+return false
+"""
+
+# Extends the lease in each of the semaphores (if it still exists).
+#   KEYS: semaphore sorted sets...
+#   ARGV: lease id, lease TTL in ms
+RENEW_LEASE_SCRIPT = """
+local time = redis.call('TIME')
+local now_ms = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+for i = 1, #KEYS do
+    redis.call('ZADD', KEYS[i], 'XX', now_ms + tonumber(ARGV[2]), ARGV[1])
+end
+return 1
+"""
+
+
+class RedisRepository(Repository):
+    def __init__(self, rds: Redis, key_prefix: str = ""):
+        """
+        `key_prefix` allows several sets of buckets (e.g. one per Sentinel Hub deployment) in the same Redis.
+        """
+        super().__init__()
+
+        self._rds = rds
+        self._remaining_key = f"{key_prefix}remaining"
+        self._refills_key = f"{key_prefix}refill_ns"
+        self._types_key = f"{key_prefix}types"
+        self._capacities_key = f"{key_prefix}capacities"
+        self._job_quotas_key = f"{key_prefix}job_quotas"
+        self._rate_multiplier_key = f"{key_prefix}rate_multiplier"
+        self._capacity_channel = f"{key_prefix}capacity"
+        self._semaphores_key = f"{key_prefix}semaphores"
+        self._leases_key_prefix = f"{key_prefix}leases:"
+        self._permit_rates_key = f"{key_prefix}permit_rates"
+        self._learned_cost_key_prefix = f"{key_prefix}learned_cost:"
+        self._alive_key = f"{key_prefix}syncer_alive"
+        self._alive_value = b"1"
+
+    @staticmethod
+    def _decode(value):
+        # the client may or may not be created with `decode_responses=True`:
+        return value.decode() if isinstance(value, bytes) else value
+
+    def _decode_hash(self, data: dict) -> dict:
+        return {self._decode(k): self._decode(v) for k, v in data.items()}
+
+    def init_rate_limits(self, rate_limits: List[dict], expires_within_ms: int):
+        with self._rds.pipeline() as pipe:
+            pipe.delete(self._remaining_key, self._refills_key, self._types_key, self._capacities_key)
+            for policy in rate_limits:
+                pipe.hset(self._remaining_key, policy["id"], policy["initial"])
+                pipe.hset(self._refills_key, policy["id"], policy["nanos_between_refills"])
+                pipe.hset(self._types_key, policy["id"], policy["type"])
+                pipe.hset(self._capacities_key, policy["id"], policy["capacity"])
+
+            pipe.set(self._alive_key, self._alive_value, px=expires_within_ms)
+            pipe.execute()
+
+    def increment_counter(self, policy_id: str, amount: float) -> float:
+        return self._rds.hincrbyfloat(self._remaining_key, policy_id, amount)
+
+    def increment_counters(self, amounts: Dict[str, float]) -> Dict[str, float]:
+        # pipelines are wrapped in MULTI / EXEC, so the increments are applied atomically:
+        with self._rds.pipeline() as pipe:
+            for counter_id, amount in amounts.items():
+                pipe.hincrbyfloat(self._remaining_key, counter_id, amount)
+            new_values = pipe.execute()
+        return dict(zip(amounts.keys(), new_values))
+
+    def increment_counters_timed(self, amounts: Dict[str, float]) -> Tuple[Dict[str, float], int]:
+        with self._rds.pipeline() as pipe:
+            for counter_id, amount in amounts.items():
+                pipe.hincrbyfloat(self._remaining_key, counter_id, amount)
+            pipe.time()
+            *new_values, (server_time_s, server_time_us) = pipe.execute()
+        return dict(zip(amounts.keys(), new_values)), int(server_time_s) * 1000000000 + int(server_time_us) * 1000
+
+    def _leases_key(self, semaphore_id: str) -> str:
+        return f"{self._leases_key_prefix}{semaphore_id}"
+
+    def acquire_lease(self, semaphores: Dict[str, int], lease_id: str, lease_ttl_ms: int) -> Optional[float]:
+        keys = [self._leases_key(semaphore_id) for semaphore_id in semaphores]
+        wait_ms = self._rds.eval(ACQUIRE_LEASE_SCRIPT, len(keys), *keys, lease_id, lease_ttl_ms, *semaphores.values())
+        # Lua's false is returned as nil:
+        return float(wait_ms) if wait_ms is not None else None
+
+    def renew_lease(self, semaphore_ids: List[str], lease_id: str, lease_ttl_ms: int):
+        keys = [self._leases_key(semaphore_id) for semaphore_id in semaphore_ids]
+        self._rds.eval(RENEW_LEASE_SCRIPT, len(keys), *keys, lease_id, lease_ttl_ms)
+
+    def release_lease(self, semaphore_ids: List[str], lease_id: str):
+        with self._rds.pipeline() as pipe:
+            for semaphore_id in semaphore_ids:
+                pipe.zrem(self._leases_key(semaphore_id), lease_id)
+            pipe.execute()
+
+    def init_semaphores(self, semaphore_limits: Dict[str, int]):
+        with self._rds.pipeline() as pipe:
+            pipe.delete(self._semaphores_key)
+            for semaphore_id, limit in semaphore_limits.items():
+                pipe.hset(self._semaphores_key, semaphore_id, limit)
+            pipe.execute()
+
+    def get_semaphore_limits(self) -> Dict[str, int]:
+        return {k: int(v) for k, v in self._decode_hash(self._rds.hgetall(self._semaphores_key)).items()}
+
+    def get_counters(self, counter_ids: List[str]) -> Dict[str, float]:
+        if not counter_ids:
+            return {}
+        values = self._rds.hmget(self._remaining_key, counter_ids)
+        return {counter_id: float(value) for counter_id, value in zip(counter_ids, values) if value is not None}
+
+    def get_policy_types(self) -> dict:
+        return self._decode_hash(self._rds.hgetall(self._types_key))
+
+    def get_policy_refills(self) -> dict:
+        return self._decode_hash(self._rds.hgetall(self._refills_key))
+
+    def set_policy_refills(self, policy_refills: Dict[str, int]):
+        self._rds.hset(self._refills_key, mapping=policy_refills)
+
+    def get_policy_capacities(self) -> dict:
+        return {k: float(v) for k, v in self._decode_hash(self._rds.hgetall(self._capacities_key)).items()}
+
+    def set_policy_capacities(self, policy_capacities: Dict[str, float]):
+        self._rds.hset(self._capacities_key, mapping=policy_capacities)
+
+    def get_buckets_state(self) -> dict:
+        return self._decode_hash(self._rds.hgetall(self._remaining_key))
+
+    def get_job_quota(self, job_id: str) -> Optional[dict]:
+        data = self._rds.hget(self._job_quotas_key, job_id)
+        return json.loads(self._decode(data)) if data is not None else None
+
+    def get_job_quotas(self) -> Dict[str, dict]:
+        return {k: json.loads(v) for k, v in self._decode_hash(self._rds.hgetall(self._job_quotas_key)).items()}
+
+    def save_job_quota(self, job_id: str, quota: dict):
+        self._rds.hset(self._job_quotas_key, job_id, json.dumps(quota))
+
+    def delete_job_quota(self, job_id: str):
+        counter_ids = [
+            counter_id
+            for counter_id in map(self._decode, self._rds.hkeys(self._remaining_key))
+            if is_job_bucket_id(counter_id, job_id)
+        ]
+        with self._rds.pipeline() as pipe:
+            pipe.hdel(self._job_quotas_key, job_id)
+            if counter_ids:
+                pipe.hdel(self._remaining_key, *counter_ids)
+            pipe.execute()
+
+    def get_learned_cost(self, signature: str) -> Optional[dict]:
+        data = self._rds.get(f"{self._learned_cost_key_prefix}{signature}")
+        return json.loads(data) if data is not None else None
+
+    def save_learned_cost(self, signature: str, cost: dict, ttl_s: float):
+        # each signature has its own key, so that the costs which are not used anymore expire:
+        self._rds.set(f"{self._learned_cost_key_prefix}{signature}", json.dumps(cost), px=int(ttl_s * 1000))
+
+    def get_rate_multiplier(self) -> float:
+        value = self._rds.hget(self._rate_multiplier_key, "value")
+        return float(value) if value is not None else 1.0
+
+    def update_rate_multiplier(self, update: Callable[[float, float], Optional[Tuple[float, float]]]) -> float:
+        with self._rds.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(self._rate_multiplier_key)
+                    data = self._decode_hash(pipe.hgetall(self._rate_multiplier_key))
+                    value = float(data.get("value", 1.0))
+                    updated = update(value, float(data.get("decreased_at_ms", 0.0)))
+                    if updated is None:
+                        pipe.unwatch()
+                        return value
+                    pipe.multi()
+                    pipe.hset(self._rate_multiplier_key, mapping={"value": updated[0], "decreased_at_ms": updated[1]})
+                    pipe.execute()
+                    return updated[0]
+                except WatchError:
+                    continue
+
+    def publish_capacity(self, credits: Dict[str, float]):
+        self._rds.publish(self._capacity_channel, json.dumps(credits))
+
+    def subscribe_capacity(self) -> CapacitySubscription:
+        return RedisCapacitySubscription(self._rds, self._capacity_channel)
+
+    def save_permit_rates(self, permit_rates: Dict[str, float]):
+        with self._rds.pipeline() as pipe:
+            pipe.delete(self._permit_rates_key)
+            if permit_rates:
+                pipe.hset(self._permit_rates_key, mapping=permit_rates)
+            pipe.execute()
+
+    def get_backlog_state(self) -> dict:
+        # a single round trip:
+        with self._rds.pipeline() as pipe:
+            pipe.hgetall(self._types_key)
+            pipe.hgetall(self._refills_key)
+            pipe.hgetall(self._capacities_key)
+            pipe.hgetall(self._remaining_key)
+            pipe.hgetall(self._permit_rates_key)
+            pipe.hget(self._rate_multiplier_key, "value")
+            types, refills, capacities, remaining, permit_rates, rate_multiplier = pipe.execute()
+        return {
+            "types": self._decode_hash(types),
+            "refills": {k: float(v) for k, v in self._decode_hash(refills).items()},
+            "capacities": {k: float(v) for k, v in self._decode_hash(capacities).items()},
+            "remaining": {k: float(v) for k, v in self._decode_hash(remaining).items()},
+            "permit_rates": {k: float(v) for k, v in self._decode_hash(permit_rates).items()},
+            "rate_multiplier": float(rate_multiplier) if rate_multiplier is not None else 1.0,
+        }
+
+    def is_syncer_alive(self) -> bool:
+        return self._rds.get(self._alive_key)
+
+    def signal_syncer_alive(self, expires_within_ms: int):
+        self._rds.set(self._alive_key, self._alive_value, px=expires_within_ms)
+
+    def get_access_token(self) -> Optional[dict]:
+        return None
+
+    def save_access_token(self, token: str, expires_at_s: int):
+        pass
+
+
+# query parameters of the URL which are not passed to the Redis client:
+_REPOSITORY_PARAMETERS = ("key_prefix", "shards")
+
+
+def from_url(url: str) -> Repository:
+    """
+    Creates the repository from a Redis URL (see `redis.Redis.from_url`). Keys can be prefixed with `key_prefix`
+    parameter, and the buckets can be split into shards with `shards` parameter (see `rlguard.sharding`), e.g.
+    `redis://localhost:6379/0?key_prefix=services.sentinel-hub.com:&shards=4`.
+    """
+    parts = urlsplit(url)
+    query = parse_qsl(parts.query)
+    parameters = {name: value for name, value in query if name in _REPOSITORY_PARAMETERS}
+    client_query = urlencode([(name, value) for name, value in query if name not in _REPOSITORY_PARAMETERS])
+    rds = Redis.from_url(urlunsplit(parts._replace(query=client_query)))
+
+    key_prefix = parameters.get("key_prefix", "")
+    n_shards = int(parameters.get("shards", 1))
+    if n_shards > 1:
+        from ..sharding import ShardedRepository, redis_shards
+
+        return ShardedRepository(redis_shards(rds, n_shards, key_prefix=key_prefix))
+    return RedisRepository(rds, key_prefix=key_prefix)
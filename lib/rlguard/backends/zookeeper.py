@@ -0,0 +1,414 @@
+"""
+Repository backed by ZooKeeper (install `rlguard-lib[zookeeper]`).
+"""
+import json
+import logging
+import queue
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+from kazoo.client import KazooClient
+from kazoo.exceptions import BadVersionError, NodeExistsError, NoNodeError
+from kazoo.recipe.counter import Counter
+
+from .. import is_job_bucket_id
+from ..repository import CapacitySubscription, Repository
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_KEY_BASE = "/openeo/rlguard"
+
+
+class ZooKeeperCapacitySubscription(CapacitySubscription):
+    """
+    The node holds the total credits ever published; we watch it and return the differences.
+    """
+
+    def __init__(self, client: KazooClient, path: str):
+        self._credits = queue.Queue()
+        self._totals = None
+        self._closed = False
+        client.ensure_path(path)
+        client.DataWatch(path, self._on_change)
+
+    def _on_change(self, data, stat):
+        if self._closed:
+            return False  # stops the watch
+        totals = json.loads(data.decode()) if data else {}
+        if self._totals is not None:
+            credits = {k: v - self._totals.get(k, 0.0) for k, v in totals.items() if v != self._totals.get(k, 0.0)}
+            if credits:
+                self._credits.put(credits)
+        self._totals = totals
+
+    def get(self, timeout_s: float) -> Optional[Dict[str, float]]:
+        try:
+            return self._credits.get(timeout=max(timeout_s, 0.0))
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self._closed = True
+
+
+class ZooKeeperRepository(Repository):
+    def __init__(self, client: KazooClient, key_base: str):
+        super().__init__()
+
+        self._client = client
+        self._remaining_key = f"{key_base}/remaining"
+        self._refills_key = f"{key_base}/refill_ns"
+        self._types_key = f"{key_base}/types"
+        self._capacities_key = f"{key_base}/capacities"
+        self._job_quotas_key = f"{key_base}/job_quotas"
+        self._rate_multiplier_key = f"{key_base}/rate_multiplier"
+        self._capacity_key = f"{key_base}/capacity"
+        self._semaphores_key = f"{key_base}/semaphores"
+        self._leases_key = f"{key_base}/leases"
+        self._permit_rates_key = f"{key_base}/permit_rates"
+        self._learned_costs_key = f"{key_base}/learned_costs"
+        self._alive_key = f"{key_base}/syncer_alive"
+        self._access_token_key = f"{key_base}/access_token"
+
+    def _counter(self, policy_id: str) -> Counter:
+        return self._client.Counter(f"{self._remaining_key}/{policy_id}", default=0.0)
+
+    def init_rate_limits(self, rate_limits: List[dict], expires_within_ms: int):
+        # TODO: mimic counter structure instead? (/openeo/rlguard/remaining/some_policy_id)
+        policy_refills = {}
+        policy_types = {}
+        policy_capacities = {}
+
+        for policy in rate_limits:
+            policy_refills[policy["id"]] = policy["nanos_between_refills"]
+            policy_types[policy["id"]] = policy["type"]
+            policy_capacities[policy["id"]] = policy["capacity"]
+
+            policy_remaining = self._counter(policy["id"])
+            try:
+                self._client.delete(policy_remaining.path)
+            except NoNodeError:
+                pass
+            policy_remaining += float(policy["initial"])
+
+        self._client.ensure_path(self._refills_key)
+        self._client.set(self._refills_key, json.dumps(policy_refills).encode())
+
+        self._client.ensure_path(self._types_key)
+        self._client.set(self._types_key, json.dumps(policy_types).encode())
+
+        self._client.ensure_path(self._capacities_key)
+        self._client.set(self._capacities_key, json.dumps(policy_capacities).encode())
+
+        self._client.ensure_path(self._alive_key)
+        self.signal_syncer_alive(expires_within_ms)
+
+    def increment_counter(self, policy_id: str, amount: float) -> float:
+        counter = self._counter(policy_id)
+        counter += amount
+        return counter.value
+
+    def increment_counters(self, amounts: Dict[str, float]) -> Dict[str, float]:
+        # ZooKeeper counters are updated one by one (each of them atomically):
+        return {counter_id: self.increment_counter(counter_id, amount) for counter_id, amount in amounts.items()}
+
+    def increment_counters_timed(self, amounts: Dict[str, float]) -> Tuple[Dict[str, float], int]:
+        # ZooKeeper doesn't expose its clock, so the local one is used instead:
+        new_values = self.increment_counters(amounts)
+        return new_values, time.time_ns()
+
+    def acquire_lease(self, semaphores: Dict[str, int], lease_id: str, lease_ttl_ms: int) -> Optional[float]:
+        # leases are ephemeral nodes (so they disappear with the session of a crashed worker) which hold their
+        # expiry time; semaphores are locked (in a consistent order, to avoid deadlocks) while we count them:
+        locks = [self._client.Lock(f"{self._leases_key}/{semaphore_id}_lock") for semaphore_id in sorted(semaphores)]
+        for lock in locks:
+            lock.acquire()
+        try:
+            now_ms = self._now_ms()
+            wait_ms = -1.0
+            for semaphore_id, limit in semaphores.items():
+                expiries_ms = self._lease_expiries_ms(semaphore_id, now_ms)
+                if len(expiries_ms) >= limit:
+                    semaphore_wait_ms = min(expiries_ms) - now_ms if expiries_ms else lease_ttl_ms
+                    wait_ms = max(wait_ms, semaphore_wait_ms)
+            if wait_ms >= 0:
+                return wait_ms
+
+            for semaphore_id in semaphores:
+                self._client.create(
+                    f"{self._leases_key}/{semaphore_id}/{lease_id}",
+                    repr(now_ms + lease_ttl_ms).encode(),
+                    ephemeral=True,
+                    makepath=True,
+                )
+            return None
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+    def _lease_expiries_ms(self, semaphore_id: str, now_ms: int) -> List[int]:
+        path = f"{self._leases_key}/{semaphore_id}"
+        self._client.ensure_path(path)
+        expiries_ms = []
+        for lease_id in self._client.get_children(path):
+            try:
+                data, _ = self._client.get(f"{path}/{lease_id}")
+            except NoNodeError:
+                continue
+            expires_at_ms = int(data.decode())
+            if expires_at_ms <= now_ms:
+                self._client.delete(f"{path}/{lease_id}")
+            else:
+                expiries_ms.append(expires_at_ms)
+        return expiries_ms
+
+    def renew_lease(self, semaphore_ids: List[str], lease_id: str, lease_ttl_ms: int):
+        expires_at_ms = self._now_ms() + lease_ttl_ms
+        for semaphore_id in semaphore_ids:
+            try:
+                self._client.set(f"{self._leases_key}/{semaphore_id}/{lease_id}", repr(expires_at_ms).encode())
+            except NoNodeError:
+                pass
+
+    def release_lease(self, semaphore_ids: List[str], lease_id: str):
+        for semaphore_id in semaphore_ids:
+            try:
+                self._client.delete(f"{self._leases_key}/{semaphore_id}/{lease_id}")
+            except NoNodeError:
+                pass
+
+    def init_semaphores(self, semaphore_limits: Dict[str, int]):
+        self._client.ensure_path(self._semaphores_key)
+        self._client.set(self._semaphores_key, json.dumps(semaphore_limits).encode())
+
+    def get_semaphore_limits(self) -> Dict[str, int]:
+        try:
+            return self._get_object(self._semaphores_key)
+        except NoNodeError:
+            return {}
+
+    def get_counters(self, counter_ids: List[str]) -> Dict[str, float]:
+        counters = {}
+        for counter_id in counter_ids:
+            if self._client.exists(f"{self._remaining_key}/{counter_id}"):
+                counters[counter_id] = self._counter(counter_id).value
+        return counters
+
+    def get_policy_types(self) -> dict:
+        return self._get_object(self._types_key)
+
+    def get_policy_refills(self) -> dict:
+        return self._get_object(self._refills_key)
+
+    def set_policy_refills(self, policy_refills: Dict[str, int]):
+        # only syncer changes the refills, so there are no concurrent updates:
+        refills = self.get_policy_refills()
+        refills.update(policy_refills)
+        self._client.set(self._refills_key, json.dumps(refills).encode())
+
+    def get_policy_capacities(self) -> dict:
+        return self._get_object(self._capacities_key)
+
+    def set_policy_capacities(self, policy_capacities: Dict[str, float]):
+        # the same as the refills, only syncer changes the capacities:
+        capacities = self.get_policy_capacities()
+        capacities.update(policy_capacities)
+        self._client.set(self._capacities_key, json.dumps(capacities).encode())
+
+    def get_buckets_state(self) -> dict:
+        # the counters of the policies and of their job sub-buckets (see `job_bucket_id`), the same as the other
+        # backends return; they are read directly, because reading a `Counter` would recreate a deleted one:
+        policy_ids = set(self.get_policy_types().keys())
+        try:
+            counter_ids = self._client.get_children(self._remaining_key)
+        except NoNodeError:
+            return {}
+        state = {}
+        for counter_id in counter_ids:
+            if counter_id.partition("@")[0] not in policy_ids:
+                continue
+            try:
+                data, _ = self._client.get(f"{self._remaining_key}/{counter_id}")
+            except NoNodeError:
+                continue
+            state[counter_id] = float(data.decode()) if data else 0.0
+        return state
+
+    def get_job_quota(self, job_id: str) -> Optional[dict]:
+        return self.get_job_quotas().get(job_id)
+
+    def get_job_quotas(self) -> Dict[str, dict]:
+        try:
+            return self._get_object(self._job_quotas_key)
+        except NoNodeError:
+            return {}
+
+    def save_job_quota(self, job_id: str, quota: dict):
+        # job quotas are rarely changed, so a lock is good enough to keep concurrent updates consistent:
+        with self._client.Lock(f"{self._job_quotas_key}_lock"):
+            job_quotas = self.get_job_quotas()
+            job_quotas[job_id] = quota
+            self._client.ensure_path(self._job_quotas_key)
+            self._client.set(self._job_quotas_key, json.dumps(job_quotas).encode())
+
+    def delete_job_quota(self, job_id: str):
+        with self._client.Lock(f"{self._job_quotas_key}_lock"):
+            job_quotas = self.get_job_quotas()
+            if job_quotas.pop(job_id, None) is not None:
+                self._client.set(self._job_quotas_key, json.dumps(job_quotas).encode())
+            for counter_id in self._client.get_children(self._remaining_key):
+                if is_job_bucket_id(counter_id, job_id):
+                    try:
+                        self._client.delete(f"{self._remaining_key}/{counter_id}")
+                    except NoNodeError:
+                        pass
+
+    def _get_object(self, key: str) -> dict:
+        data, _ = self._client.get(key)
+        return json.loads(data.decode())
+
+    def get_learned_cost(self, signature: str) -> Optional[dict]:
+        path = f"{self._learned_costs_key}/{signature}"
+        try:
+            entry = self._get_object(path)
+        except NoNodeError:
+            return None
+        # nodes don't expire by themselves, so the stale ones are removed when they are read (and by
+        # `purge_learned_costs`):
+        if entry["expires_at"] <= time.time():
+            try:
+                self._client.delete(path)
+            except NoNodeError:
+                pass
+            return None
+        return entry["cost"]
+
+    def save_learned_cost(self, signature: str, cost: dict, ttl_s: float):
+        path = f"{self._learned_costs_key}/{signature}"
+        self._client.ensure_path(path)
+        self._client.set(path, json.dumps({"cost": cost, "expires_at": time.time() + ttl_s}).encode())
+
+    def purge_learned_costs(self):
+        try:
+            signatures = self._client.get_children(self._learned_costs_key)
+        except NoNodeError:
+            return
+        now = time.time()
+        for signature in signatures:
+            path = f"{self._learned_costs_key}/{signature}"
+            try:
+                if self._get_object(path)["expires_at"] <= now:
+                    self._client.delete(path)
+            except NoNodeError:
+                pass
+
+    def get_rate_multiplier(self) -> float:
+        try:
+            return self._get_object(self._rate_multiplier_key)["value"]
+        except NoNodeError:
+            return 1.0
+
+    def update_rate_multiplier(self, update: Callable[[float, float], Optional[Tuple[float, float]]]) -> float:
+        # optimistic concurrency - the node is only written if nobody has changed it since we've read it:
+        while True:
+            try:
+                data, stat = self._client.get(self._rate_multiplier_key)
+                current = json.loads(data.decode())
+            except NoNodeError:
+                stat, current = None, {"value": 1.0, "decreased_at_ms": 0.0}
+
+            updated = update(current["value"], current["decreased_at_ms"])
+            if updated is None:
+                return current["value"]
+            data = json.dumps({"value": updated[0], "decreased_at_ms": updated[1]}).encode()
+            try:
+                if stat is None:
+                    self._client.create(self._rate_multiplier_key, data, makepath=True)
+                else:
+                    self._client.set(self._rate_multiplier_key, data, version=stat.version)
+                return updated[0]
+            except (BadVersionError, NodeExistsError):
+                continue
+
+    def publish_capacity(self, credits: Dict[str, float]):
+        self._client.ensure_path(self._capacity_key)
+        while True:
+            data, stat = self._client.get(self._capacity_key)
+            totals = json.loads(data.decode()) if data else {}
+            for counter_id, units in credits.items():
+                totals[counter_id] = totals.get(counter_id, 0.0) + units
+            try:
+                self._client.set(self._capacity_key, json.dumps(totals).encode(), version=stat.version)
+                return
+            except BadVersionError:
+                continue
+
+    def subscribe_capacity(self) -> CapacitySubscription:
+        return ZooKeeperCapacitySubscription(self._client, self._capacity_key)
+
+    def save_permit_rates(self, permit_rates: Dict[str, float]):
+        self._client.ensure_path(self._permit_rates_key)
+        self._client.set(self._permit_rates_key, json.dumps(permit_rates).encode())
+
+    def get_backlog_state(self) -> dict:
+        try:
+            permit_rates = self._get_object(self._permit_rates_key)
+        except NoNodeError:
+            permit_rates = {}
+        return {
+            "types": self.get_policy_types(),
+            "refills": {k: float(v) for k, v in self.get_policy_refills().items()},
+            "capacities": {k: float(v) for k, v in self.get_policy_capacities().items()},
+            "remaining": {k: float(v) for k, v in self.get_buckets_state().items()},
+            "permit_rates": permit_rates,
+            "rate_multiplier": self.get_rate_multiplier(),
+        }
+
+    def signal_syncer_alive(self, expires_within_ms: int):
+        expires_at_ms = self._now_ms() + expires_within_ms
+        self._client.set(self._alive_key, repr(expires_at_ms).encode())
+
+    def is_syncer_alive(self) -> bool:
+        now_ms = self._now_ms()
+
+        data, _ = self._client.get(self._alive_key)
+        expires_at_ms = int(data.decode())
+
+        alive = now_ms <= expires_at_ms
+
+        if not alive:
+            logger.debug(f"{now_ms}: syncer expired at {expires_at_ms}")
+
+        return alive
+
+    @staticmethod
+    def _now_ms():
+        return int(time.time() * 1000)
+
+    def get_access_token(self) -> Optional[dict]:
+        try:
+            return self._get_object(self._access_token_key)
+        except NoNodeError:
+            logger.warning(f"no access token at {self._access_token_key}", exc_info=True)
+            return None
+
+    def save_access_token(self, token: str, expires_at_s: int):
+        access_token = {
+            "token": token,
+            "expires_at": expires_at_s * 1000
+        }
+
+        self._client.ensure_path(self._access_token_key)
+        self._client.set(self._access_token_key, json.dumps(access_token).encode())
+
+
+def from_url(url: str) -> Repository:
+    """
+    Creates the repository from a ZooKeeper URL with comma-separated hosts and the base path of the nodes, e.g.
+    `zk://zk1:2181,zk2:2181/openeo/rlguard`. The client is started (and connected) right away.
+    """
+    parts = urlsplit(url)
+    client = KazooClient(hosts=parts.netloc)
+    client.start()
+    return ZooKeeperRepository(client, key_base=parts.path.rstrip("/") or DEFAULT_KEY_BASE)
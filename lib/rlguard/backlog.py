@@ -0,0 +1,49 @@
+from dataclasses import dataclass
+from typing import Dict
+
+from .repository import Repository
+
+# the backlog is projected this far into the future, assuming the permit rate doesn't change:
+PROJECTION_S = 60.0
+
+
+@dataclass
+class PolicyBacklog:
+    policy_type: str
+    # how long a worker asking for a permit now would have to wait (because of this policy):
+    backlog_s: float
+    # units (PUs or requests) per second which are added to the bucket (rate multiplier included):
+    refill_rate: float
+    # units per second which were recently taken from the bucket (as measured by syncer):
+    permit_rate: float
+    # permit rate relative to the refill rate - above 1 the backlog is growing:
+    saturation: float
+    # backlog in `PROJECTION_S` seconds:
+    projected_backlog_s: float
+
+
+def get_backlog(repository: Repository) -> Dict[str, PolicyBacklog]:
+    """
+    Returns the backlog of each of the policies (policy id -> `PolicyBacklog`).
+
+    Negative bucket values tell how long the workers which got their permits are waiting, so saturation can
+    be estimated without asking Sentinel Hub. Autoscalers can use it to decide whether adding workers makes
+    sense (it doesn't if they would only wait) or whether capacity is left unused.
+    """
+    state = repository.get_backlog_state()
+    backlog = {}
+    for policy_id, policy_type in state["types"].items():
+        refill_rate = 1000000000.0 / state["refills"][policy_id] * state["rate_multiplier"]
+        permit_rate = state["permit_rates"].get(policy_id, 0.0)
+        backlog_s = max(-state["remaining"].get(policy_id, 0.0), 0.0) / refill_rate
+        # without a backlog, the bucket first has to be emptied before the workers start waiting:
+        projected_units = -state["remaining"].get(policy_id, 0.0) + (permit_rate - refill_rate) * PROJECTION_S
+        backlog[policy_id] = PolicyBacklog(
+            policy_type=policy_type,
+            backlog_s=backlog_s,
+            refill_rate=refill_rate,
+            permit_rate=permit_rate,
+            saturation=permit_rate / refill_rate,
+            projected_backlog_s=max(projected_units, 0.0) / refill_rate,
+        )
+    return backlog
@@ -0,0 +1,141 @@
+"""
+Costs (PUs) of Process API requests, learned from what Sentinel Hub has actually charged for them.
+
+The formula (see `calculate_processing_units`) is only an estimate - for some evalscripts and data collections the
+actual costs differ, so the buckets are over- or underbooked. `CostEstimator` learns the costs per request signature
+(see `request_signature`) from the PUs reported in the responses, and falls back to the formula for the signatures
+it hasn't seen yet.
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Optional, Tuple
+
+from . import PROCESSING_UNITS_SPENT_HEADER
+from .process_api import estimate_process_request_pu, request_signature
+from .repository import Repository
+
+logger = logging.getLogger(__name__)
+
+# costs of the signatures which were not seen for this long are forgotten:
+COST_TTL_S = 24 * 3600.0
+MAX_ENTRIES = 10000
+# weight of each new observation in the (exponentially) smoothed cost:
+SMOOTHING = 0.3
+# the cost of a signature is shared with the other workers at most this often:
+SHARE_INTERVAL_S = 10.0
+# signatures which the other workers haven't learned either are not looked up again for this long:
+UNKNOWN_TTL_S = 60.0
+
+
+class CostEstimator:
+    """
+    Keeps the learned costs of the recently used request signatures in a local LRU cache (with a TTL), and shares
+    them with the other workers through the repository (if given), so that a signature learned by one worker is
+    known to all of them. Concurrent updates by several workers simply overwrite each other, which is good enough
+    for smoothed values.
+
+    The rate-limited adapters (see `RateLimitedSession` and `RateLimitedTransport`) use it when they are given
+    `cost_estimator`; otherwise use `estimate` to get the PUs (and the signature) for a permit, and `observe` (or
+    `observe_response`) to report what the request has actually cost.
+    """
+
+    def __init__(
+        self,
+        repository: Optional[Repository] = None,
+        ttl_s: float = COST_TTL_S,
+        max_entries: int = MAX_ENTRIES,
+        smoothing: float = SMOOTHING,
+    ):
+        self._repository = repository
+        self._ttl_s = ttl_s
+        self._max_entries = max_entries
+        self._smoothing = smoothing
+        self._lock = threading.Lock()
+        # signature -> {"pu" (None if not known), "n", "expires_at", "shared_at"}, least recently used first:
+        self._entries: "OrderedDict[str, dict]" = OrderedDict()
+
+    def _get(self, signature: str) -> Optional[dict]:
+        entry = self._entries.get(signature)
+        if entry is None:
+            return None
+        if entry["expires_at"] <= time.monotonic():
+            del self._entries[signature]
+            return None
+        self._entries.move_to_end(signature)
+        return entry
+
+    def _put(self, signature: str, entry: dict):
+        self._entries[signature] = entry
+        self._entries.move_to_end(signature)
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+
+    def learned_cost(self, signature: str) -> Optional[float]:
+        """
+        Returns the learned cost of the requests with the given signature, or `None` if it is not known yet.
+        """
+        with self._lock:
+            entry = self._get(signature)
+        if entry is not None:
+            return entry["pu"]
+        if self._repository is None:
+            return None
+
+        cost = self._repository.get_learned_cost(signature)
+        now = time.monotonic()
+        with self._lock:
+            if cost is None:
+                self._put(signature, {"pu": None, "n": 0, "expires_at": now + UNKNOWN_TTL_S, "shared_at": now})
+                return None
+            self._put(signature, {"pu": cost["pu"], "n": cost["n"], "expires_at": now + self._ttl_s, "shared_at": now})
+        return cost["pu"]
+
+    def estimate(
+        self, body: Optional[bytes], estimate_pu: Callable[[Optional[bytes]], float] = estimate_process_request_pu
+    ) -> Tuple[float, Optional[str]]:
+        """
+        Returns the PUs the Process API request with the given body will use (the learned cost if there is one,
+        `estimate_pu` otherwise) and the signature of the request.
+        """
+        signature = request_signature(body)
+        learned = self.learned_cost(signature) if signature is not None else None
+        if learned is None:
+            return estimate_pu(body), signature
+        return learned, signature
+
+    def observe(self, signature: str, processing_units_spent: float):
+        """
+        Learns from the PUs which Sentinel Hub has charged for the request with the given signature.
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._get(signature)
+            if entry is None or entry["pu"] is None:
+                entry = {"pu": float(processing_units_spent), "n": 1, "shared_at": 0.0}
+            else:
+                pu = entry["pu"] * (1.0 - self._smoothing) + float(processing_units_spent) * self._smoothing
+                entry = {"pu": pu, "n": entry["n"] + 1, "shared_at": entry["shared_at"]}
+            entry["expires_at"] = now + self._ttl_s
+            share = self._repository is not None and now - entry["shared_at"] >= SHARE_INTERVAL_S
+            if share:
+                entry["shared_at"] = now
+            self._put(signature, entry)
+        if share:
+            self._repository.save_learned_cost(signature, {"pu": entry["pu"], "n": entry["n"]}, self._ttl_s)
+
+    def observe_response(self, signature: Optional[str], response):
+        """
+        Learns from the PUs reported in the response (`x-processingunits-spent` header) to the request with the
+        given signature. Unsuccessful responses are not charged, so they are ignored.
+        """
+        if signature is None or response.status_code >= 400:
+            return
+        value = response.headers.get(PROCESSING_UNITS_SPENT_HEADER)
+        if value is None:
+            return
+        try:
+            self.observe(signature, float(value))
+        except ValueError:
+            logger.warning(f"Could not parse header value: {value}")
@@ -0,0 +1,105 @@
+"""
+Rate-limited transports for `httpx` (sync and async).
+"""
+import asyncio
+import functools
+from typing import Callable, Optional
+
+import httpx
+
+from .costs import CostEstimator
+from .process_api import (
+    MAX_RETRIES,
+    async_send_with_permits,
+    estimate_process_request_pu,
+    is_process_api_request,
+    send_with_permits,
+)
+from .repository import Repository
+
+
+class RateLimitedTransport(httpx.HTTPTransport):
+    """
+    Coordinates Process API requests through the repository, see `RateLimitedHTTPAdapter` for details.
+    """
+
+    def __init__(
+        self,
+        repository: Repository,
+        job_id: Optional[str] = None,
+        estimate_pu: Callable[[Optional[bytes]], float] = estimate_process_request_pu,
+        max_rate_limit_retries: int = MAX_RETRIES,
+        cost_estimator: Optional[CostEstimator] = None,
+        **kwargs,
+    ):
+        super().__init__(**kwargs)
+        self._repository = repository
+        self._job_id = job_id
+        self._estimate_pu = estimate_pu
+        self._max_rate_limit_retries = max_rate_limit_retries
+        self._cost_estimator = cost_estimator
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        if not is_process_api_request(request.method, str(request.url)):
+            return super().handle_request(request)
+
+        if self._cost_estimator is not None:
+            processing_units, signature = self._cost_estimator.estimate(request.read(), self._estimate_pu)
+            on_response = functools.partial(self._cost_estimator.observe_response, signature)
+        else:
+            processing_units, on_response = self._estimate_pu(request.read()), None
+        return send_with_permits(
+            send=lambda: super(RateLimitedTransport, self).handle_request(request),
+            close=lambda response: response.close(),
+            processing_units=processing_units,
+            repository=self._repository,
+            job_id=self._job_id,
+            max_retries=self._max_rate_limit_retries,
+            on_response=on_response,
+        )
+
+
+class AsyncRateLimitedTransport(httpx.AsyncHTTPTransport):
+    """
+    Async version of `RateLimitedTransport` (see `async_send_with_permits`).
+    """
+
+    def __init__(
+        self,
+        repository: Repository,
+        job_id: Optional[str] = None,
+        estimate_pu: Callable[[Optional[bytes]], float] = estimate_process_request_pu,
+        max_rate_limit_retries: int = MAX_RETRIES,
+        cost_estimator: Optional[CostEstimator] = None,
+        **kwargs,
+    ):
+        super().__init__(**kwargs)
+        self._repository = repository
+        self._job_id = job_id
+        self._estimate_pu = estimate_pu
+        self._max_rate_limit_retries = max_rate_limit_retries
+        self._cost_estimator = cost_estimator
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        if not is_process_api_request(request.method, str(request.url)):
+            return await super().handle_async_request(request)
+
+        loop = asyncio.get_running_loop()
+        body = await request.aread()
+        if self._cost_estimator is not None:
+            # the learned cost might have to be looked up in the repository:
+            processing_units, signature = await loop.run_in_executor(
+                None, self._cost_estimator.estimate, body, self._estimate_pu
+            )
+            on_response = functools.partial(self._cost_estimator.observe_response, signature)
+        else:
+            processing_units, on_response = self._estimate_pu(body), None
+        return await async_send_with_permits(
+            send=lambda: super(AsyncRateLimitedTransport, self).handle_async_request(request),
+            close=lambda response: response.aclose(),
+            processing_units=processing_units,
+            repository=self._repository,
+            job_id=self._job_id,
+            max_retries=self._max_rate_limit_retries,
+            on_response=on_response,
+        )
@@ -0,0 +1,88 @@
+from dataclasses import dataclass, field
+import time
+from typing import Dict, List, Optional
+
+# the last part of the wait is spent spinning, because `time.sleep` might oversleep by a millisecond or more:
+SPIN_S = 0.002
+
+
+@dataclass
+class Permit:
+    """
+    Permission to perform a single request, as returned by `acquire_permit`.
+
+    Besides the delay the worker should wait for, it records which counters were charged and by how
+    much, so that unused capacity can be returned with `release` or `refund`.
+    """
+
+    delay: float
+    processing_units: float
+    # counter id -> amount which was taken from the counter (and was not yet returned):
+    charges: Dict[str, float] = field(default_factory=dict)
+    # counter id -> policy type (`PolicyType` value) of the counter:
+    types: Dict[str, str] = field(default_factory=dict)
+    job_id: Optional[str] = None
+    released: bool = False
+    # `time.monotonic()` at which the request may be performed; the delay is counted from the moment the
+    # counters were decremented (estimated as the middle of the round trip), not from the moment the reply
+    # has arrived:
+    deadline: float = 0.0
+    # the same deadline, in ns since epoch according to the clock of the backing store:
+    server_deadline_ns: Optional[int] = None
+    # how late (in s) the worker started the request, once it has waited for the permit:
+    overshoot: Optional[float] = None
+    # `time.monotonic()` at which the counters were decremented:
+    issued_at: float = 0.0
+    # counter id -> time (in ns after `issued_at`) at which the counter becomes non-negative again:
+    waits_ns: Dict[str, float] = field(default_factory=dict)
+    # counter id -> time (in ns) it takes to refill a single unit of the counter:
+    refills_ns: Dict[str, float] = field(default_factory=dict)
+    # semaphore id -> limit of the concurrency semaphores in which a lease is to be taken once the permit has been
+    # waited for (see `take_lease`), and the TTL of the lease:
+    semaphore_limits: Dict[str, int] = field(default_factory=dict)
+    lease_ttl_s: Optional[float] = None
+    # lease held in the concurrency semaphores (until the request is completed or the lease expires):
+    lease_id: Optional[str] = None
+    semaphores: List[str] = field(default_factory=list)
+    # the endpoint (Sentinel Hub deployment) the permit is for, if it was chosen by `acquire_permit_any`:
+    endpoint: Optional[str] = None
+
+    # function which takes the lease once the permit has been waited for, set by `acquire_permit` (deliberately not
+    # a field: it refers to the repository, while the permit server serializes the permits):
+    _take_lease = None
+
+    def wait(self) -> float:
+        """
+        Waits until the permit's deadline and returns the overshoot. If concurrency is limited, a lease is then
+        taken in the semaphores (see `take_lease`), which might take longer if all of their slots are in use.
+        """
+        self.overshoot = wait_until(self.deadline)
+        if self._take_lease is not None:
+            self._take_lease(self)
+        return self.overshoot
+
+    def apply_credits(self, credits: Dict[str, float]):
+        """
+        Moves the deadline forward because capacity was added to the counters out of schedule.
+
+        Everybody who is waiting on a counter moves forward by the same amount of units, so the order in
+        which the workers were permitted is kept.
+        """
+        for counter_id, units in credits.items():
+            if counter_id in self.waits_ns:
+                self.waits_ns[counter_id] -= units * self.refills_ns[counter_id]
+        delay_ns = max(list(self.waits_ns.values()) + [0.0])
+        # the capacity can't be used before it has arrived:
+        self.deadline = max(min(self.deadline, self.issued_at + delay_ns / 1000000000.0), time.monotonic())
+
+
+def wait_until(deadline: float, spin_s: float = SPIN_S) -> float:
+    """
+    Sleeps until the given `time.monotonic()` deadline and returns how late (in s) it has woken up.
+    """
+    remaining = deadline - time.monotonic()
+    if remaining > spin_s:
+        time.sleep(remaining - spin_s)
+    while time.monotonic() < deadline:
+        pass
+    return time.monotonic() - deadline
@@ -0,0 +1,159 @@
+"""
+Vectorized PU calculation and planning of jobs with many requests.
+
+Requires `numpy` (install `rlguard-lib[planning]`).
+"""
+from dataclasses import dataclass, field
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+from . import OutputFormat, PolicyType, job_bucket_id
+from .repository import Repository
+
+
+def calculate_processing_units_array(
+    batch_processing,
+    width,
+    height,
+    n_input_bands_without_datamask,
+    output_format,
+    n_data_samples=1,
+    s1_orthorectification=False,
+) -> np.ndarray:
+    """
+    Same as `calculate_processing_units`, but each of the parameters can be an array (or a scalar which
+    applies to all requests). Output format can be given as `OutputFormat` members or their values.
+    """
+    batch_processing, width, height, n_input_bands_without_datamask, n_data_samples = np.broadcast_arrays(
+        np.asarray(batch_processing, dtype=bool),
+        np.asarray(width, dtype=np.float64),
+        np.asarray(height, dtype=np.float64),
+        np.asarray(n_input_bands_without_datamask, dtype=np.float64),
+        np.asarray(n_data_samples, dtype=np.float64),
+    )
+    # see `calculate_processing_units` for explanation of the factors:
+    pu = np.where(batch_processing, 1.0 / 3.0, 1.0)
+    pu = pu * np.maximum((width * height) / (512.0 * 512.0), 0.01)
+    pu = pu * (n_input_bands_without_datamask / 3.0)
+    pu = pu * _output_format_factors(output_format)
+    pu = pu * n_data_samples
+    # orthorectification rule is not applied at the moment (the same as in `calculate_processing_units`)
+    return np.maximum(pu, 0.001)
+
+
+def _output_format_factors(output_format):
+    if isinstance(output_format, OutputFormat) or output_format is None:
+        output_format = OutputFormat(output_format)
+        if output_format == OutputFormat.IMAGE_TIFF_DEPTH_32:
+            return 2.0
+        if output_format == OutputFormat.APPLICATION_OCTET_STREAM:
+            return 1.4
+        return 1.0
+
+    formats = np.asarray(output_format)
+    if formats.dtype == object:
+        formats = np.array([f.value if isinstance(f, OutputFormat) else f for f in formats.ravel()], dtype=object)
+        formats = formats.reshape(np.shape(output_format))
+    return np.where(
+        formats == OutputFormat.IMAGE_TIFF_DEPTH_32.value,
+        2.0,
+        np.where(formats == OutputFormat.APPLICATION_OCTET_STREAM.value, 1.4, 1.0),
+    )
+
+
+def tile_grid(width: int, height: int, tile_width: int, tile_height: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Splits the area of `width` x `height` pixels into tiles and returns arrays of tile widths and heights
+    (tiles on the right and bottom edges might be smaller). An empty area has no tiles.
+    """
+    if width < 0 or height < 0:
+        raise ValueError(f"Area must not have a negative size, got {width} x {height}.")
+    if tile_width <= 0 or tile_height <= 0:
+        raise ValueError(f"Tiles must have a positive size, got {tile_width} x {tile_height}.")
+    if width == 0 or height == 0:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+
+    widths = np.full(int(np.ceil(width / tile_width)), tile_width)
+    widths[-1] = width - tile_width * (len(widths) - 1)
+    heights = np.full(int(np.ceil(height / tile_height)), tile_height)
+    heights[-1] = height - tile_height * (len(heights) - 1)
+    tile_widths, tile_heights = np.meshgrid(widths, heights)
+    return tile_widths.ravel(), tile_heights.ravel()
+
+
+@dataclass
+class JobPlan:
+    n_requests: int
+    total_processing_units: float
+    # estimated time it will take to perform all of the requests under the current limits:
+    duration_s: float
+    # the policy which limits the job the most (None if there are no policies):
+    bottleneck_policy_id: Optional[str]
+    # policy id -> time it would take if that was the only policy:
+    policy_durations_s: Dict[str, float] = field(default_factory=dict)
+
+
+def plan_job(processing_units, repository: Repository, job_id: Optional[str] = None) -> JobPlan:
+    """
+    Estimates how long it will take to perform the requests with given PUs, using the policies, the
+    current bucket values and the rate multiplier from the repository. If `job_id` is given, the job's
+    sub-quota (if any) is taken into account too.
+
+    The PUs can be calculated with `calculate_processing_units_array` for any set of requests; for jobs
+    which split an area into a grid of tiles, `plan_tile_grid` does that.
+    """
+    processing_units = np.asarray(processing_units, dtype=np.float64).ravel()
+    n_requests = len(processing_units)
+    total_processing_units = float(processing_units.sum())
+
+    policy_types = repository.get_policy_types()
+    policy_refills = repository.get_policy_refills()
+    rate_multiplier = repository.get_rate_multiplier()
+    job_quota = repository.get_job_quota(job_id) if job_id is not None else None
+    counter_ids = list(policy_types.keys())
+    if job_quota is not None:
+        counter_ids += [job_bucket_id(policy_id, job_id) for policy_id in policy_types]
+    bucket_values = repository.get_counters(counter_ids)
+
+    policy_durations_s = {}
+    for policy_id, policy_type in policy_types.items():
+        demand = total_processing_units if policy_type == PolicyType.PROCESSING_UNITS.value else float(n_requests)
+        refill_ns = float(policy_refills[policy_id]) / rate_multiplier
+        durations_ns = [(demand - bucket_values.get(policy_id, 0.0)) * refill_ns]
+        if job_quota is not None:
+            job_value = bucket_values.get(job_bucket_id(policy_id, job_id), 0.0)
+            durations_ns.append((demand - job_value) * refill_ns / job_quota["refill_fraction"])
+        policy_durations_s[policy_id] = max(max(durations_ns) / 1000000000.0, 0.0)
+
+    bottleneck_policy_id = max(policy_durations_s, key=policy_durations_s.get) if policy_durations_s else None
+    return JobPlan(
+        n_requests=n_requests,
+        total_processing_units=total_processing_units,
+        duration_s=policy_durations_s[bottleneck_policy_id] if bottleneck_policy_id is not None else 0.0,
+        bottleneck_policy_id=bottleneck_policy_id,
+        policy_durations_s=policy_durations_s,
+    )
+
+
+def plan_tile_grid(
+    width: int,
+    height: int,
+    tile_width: int,
+    tile_height: int,
+    n_input_bands_without_datamask: int,
+    output_format,
+    repository: Repository,
+    job_id: Optional[str] = None,
+    n_data_samples: int = 1,
+    batch_processing: bool = False,
+) -> JobPlan:
+    """
+    Plans a job which requests the area of `width` x `height` pixels in tiles (see `tile_grid`), each of them
+    with the same bands, output format and number of data samples (see `plan_job`).
+    """
+    tile_widths, tile_heights = tile_grid(width, height, tile_width, tile_height)
+    processing_units = calculate_processing_units_array(
+        batch_processing, tile_widths, tile_heights, n_input_bands_without_datamask, output_format, n_data_samples
+    )
+    return plan_job(processing_units, repository, job_id=job_id)
@@ -0,0 +1,252 @@
+"""
+Helpers for rate-limited clients of Sentinel Hub Process API (see `requests_adapter` and `httpx_transport`).
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import math
+import random
+import re
+import time
+from typing import Callable, Optional
+from urllib.parse import urlsplit
+
+from . import (
+    WAKE_ON_CAPACITY_MIN_DELAY_S,
+    OutputFormat,
+    SyncerDownException,
+    acquire_permit,
+    calculate_processing_units,
+    release,
+    report_response,
+    take_lease,
+    wait_for_capacity,
+)
+from .repository import Repository
+
+# https://docs.sentinel-hub.com/api/latest/reference/#operation/process
+PROCESS_API_PATH = "/api/v1/process"
+# when neither the size nor the resolution of the output is given, Process API returns 256 x 256 pixels:
+DEFAULT_OUTPUT_SIZE = 256
+DEFAULT_N_INPUT_BANDS = 3
+
+# retries of requests which got 429, or which couldn't be coordinated because syncer is down:
+MAX_RETRIES = 5
+MAX_BACKOFF_S = 60.0
+
+_INPUT_RE = re.compile(r"input\s*:\s*\[(.*?)\]\s*,?\s*output\s*:", re.DOTALL)
+_BANDS_RE = re.compile(r"bands\s*:\s*\[(.*?)\]", re.DOTALL)
+_QUOTED_RE = re.compile(r"[\"']([^\"']+)[\"']")
+_FLOAT32_RE = re.compile(r"sampleType\s*:\s*[\"']?(SampleType\.)?FLOAT32", re.IGNORECASE)
+
+
+def is_process_api_request(method: str, url: str) -> bool:
+    return method.upper() == "POST" and urlsplit(url).path.rstrip("/").endswith(PROCESS_API_PATH)
+
+
+def estimate_process_request_pu(body: Optional[bytes]) -> float:
+    """
+    Estimates the number of PUs the Process API request with the given (JSON) body will use.
+
+    The output size, the number of input bands (parsed from the evalscript), the output format and the
+    number of data collections are taken into account; whatever can't be determined falls back to the
+    defaults (e.g. multipart requests are estimated as a default 256 x 256 request with 3 bands).
+    """
+    try:
+        request = json.loads(body) if body else {}
+    except (TypeError, ValueError):
+        logging.debug("Process API request body is not JSON, using defaults to estimate PU")
+        request = {}
+
+    try:
+        return _estimate_pu(request if isinstance(request, dict) else {})
+    except (AttributeError, IndexError, TypeError, ValueError):
+        logging.debug("Process API request body has an unexpected shape, using defaults to estimate PU")
+        return _estimate_pu({})
+
+
+def _estimate_pu(request: dict) -> float:
+    width, height = _output_size(request)
+    evalscript = request.get("evalscript", "")
+    pu = calculate_processing_units(
+        batch_processing=False,
+        width=width,
+        height=height,
+        n_input_bands_without_datamask=_n_input_bands(evalscript),
+        output_format=_output_format(request, evalscript),
+    )
+    # data fusion requests are charged for each of the data collections:
+    n_data_collections = max(len(request.get("input", {}).get("data", [])), 1)
+    return pu * n_data_collections
+
+
+def request_signature(body: Optional[bytes]) -> Optional[str]:
+    """
+    Returns the signature of the Process API request - the properties which determine its cost: the evalscript
+    (hashed), the data collections (with their processing options, e.g. orthorectification), the output size and
+    the output formats. Requests whose body is not JSON (or is JSON of an unexpected shape) have no signature.
+    """
+    try:
+        request = json.loads(body) if body else None
+    except (TypeError, ValueError):
+        return None
+    if not isinstance(request, dict):
+        return None
+
+    try:
+        data = request.get("input", {}).get("data", [])
+        shape = {
+            "evalscript": hashlib.sha1(request.get("evalscript", "").encode()).hexdigest(),
+            "collections": [[collection.get("type"), collection.get("processing")] for collection in data],
+            "size": _output_size(request),
+            "formats": [
+                response.get("format", {}).get("type") for response in request.get("output", {}).get("responses", [])
+            ],
+        }
+    except (AttributeError, IndexError, TypeError, ValueError):
+        return None
+    return hashlib.sha1(json.dumps(shape, sort_keys=True).encode()).hexdigest()
+
+
+def _output_size(request: dict):
+    output = request.get("output", {})
+    if "width" in output and "height" in output:
+        return int(output["width"]), int(output["height"])
+
+    bbox = request.get("input", {}).get("bounds", {}).get("bbox")
+    if "resx" in output and "resy" in output and bbox:
+        width = math.ceil(abs(bbox[2] - bbox[0]) / float(output["resx"]))
+        height = math.ceil(abs(bbox[3] - bbox[1]) / float(output["resy"]))
+        return width, height
+
+    return DEFAULT_OUTPUT_SIZE, DEFAULT_OUTPUT_SIZE
+
+
+def _n_input_bands(evalscript: str) -> int:
+    match = _INPUT_RE.search(evalscript)
+    if match is None:
+        return DEFAULT_N_INPUT_BANDS
+    inputs = match.group(1)
+    # inputs are either a list of band names or a list of objects with `bands` (and other properties):
+    bands_lists = _BANDS_RE.findall(inputs)
+    names = _QUOTED_RE.findall(" ".join(bands_lists) if bands_lists else inputs)
+    # dataMask is not counted:
+    n_bands = len(set(name for name in names if name != "dataMask"))
+    return n_bands or DEFAULT_N_INPUT_BANDS
+
+
+def _output_format(request: dict, evalscript: str) -> OutputFormat:
+    formats = [response.get("format", {}).get("type") for response in request.get("output", {}).get("responses", [])]
+    if "application/octet-stream" in formats:
+        return OutputFormat.APPLICATION_OCTET_STREAM
+    if "image/tiff" in formats and _FLOAT32_RE.search(evalscript):
+        return OutputFormat.IMAGE_TIFF_DEPTH_32
+    return OutputFormat.OTHER
+
+
+def backoff_s(attempt: int) -> float:
+    """
+    Exponential backoff with 25% jitter, so that the workers don't all retry at the same time.
+    """
+    jitter = 0.75 + (0.5 * random.random())
+    return min((2**attempt) * jitter, MAX_BACKOFF_S)
+
+
+def send_with_permits(
+    send: Callable,
+    close: Callable,
+    processing_units: float,
+    repository: Repository,
+    job_id: Optional[str] = None,
+    max_retries: int = MAX_RETRIES,
+    on_response: Optional[Callable] = None,
+):
+    """
+    Obtains a permit, waits for it, sends the request (by calling `send`) and reports the response; if
+    the response is 429, it is closed (by calling `close`) and the whole process is repeated. Each
+    response is also passed to `on_response` (if given), e.g. to learn the cost of the request.
+
+    If syncer is down, the requests are retried with exponential backoff instead. The last response is
+    returned even if it is 429. If `send` raises, the permit is released (see `release`) before the exception
+    is propagated.
+    """
+    for attempt in range(max_retries + 1):
+        try:
+            permit = acquire_permit(processing_units, repository, job_id=job_id)
+        except SyncerDownException:
+            permit = None
+            if attempt > 0:
+                time.sleep(backoff_s(attempt - 1))
+        try:
+            if permit is not None:
+                wait_for_capacity(permit, repository)
+            response = send()
+        except BaseException:
+            # the request has failed (or waiting for it was interrupted), its lease and charges must not leak:
+            if permit is not None:
+                release(permit, repository)
+            raise
+        if permit is not None:
+            report_response(permit, response, repository)
+        if on_response is not None:
+            on_response(response)
+        if response.status_code != 429 or attempt == max_retries:
+            return response
+        logging.debug(f"Got 429 (attempt {attempt + 1}), retrying...")
+        close(response)
+
+
+async def async_send_with_permits(
+    send: Callable,
+    close: Callable,
+    processing_units: float,
+    repository: Repository,
+    job_id: Optional[str] = None,
+    max_retries: int = MAX_RETRIES,
+    on_response: Optional[Callable] = None,
+):
+    """
+    Async version of `send_with_permits`: `send` and `close` are coroutine functions. The repository is
+    synchronous, so it is accessed (together with `on_response`) from the default executor to keep the
+    event loop responsive.
+    """
+    loop = asyncio.get_running_loop()
+    for attempt in range(max_retries + 1):
+        try:
+            permit = await loop.run_in_executor(
+                None, lambda: acquire_permit(processing_units, repository, job_id=job_id)
+            )
+        except SyncerDownException:
+            permit = None
+            if attempt > 0:
+                await asyncio.sleep(backoff_s(attempt - 1))
+        try:
+            if permit is not None:
+                await _async_wait_for_capacity(permit, repository)
+            response = await send()
+        except BaseException:
+            # the same as in `send_with_permits`; the task might have been cancelled as well:
+            if permit is not None:
+                await loop.run_in_executor(None, release, permit, repository)
+            raise
+        if permit is not None:
+            await loop.run_in_executor(None, report_response, permit, response, repository)
+        if on_response is not None:
+            await loop.run_in_executor(None, on_response, response)
+        if response.status_code != 429 or attempt == max_retries:
+            return response
+        logging.debug(f"Got 429 (attempt {attempt + 1}), retrying...")
+        await close(response)
+
+
+async def _async_wait_for_capacity(permit, repository: Repository):
+    if permit.deadline - time.monotonic() >= WAKE_ON_CAPACITY_MIN_DELAY_S:
+        # waiting for the capacity events blocks on the subscription, so it occupies a thread of the executor:
+        await asyncio.get_running_loop().run_in_executor(None, wait_for_capacity, permit, repository)
+        return
+    # spinning would block the event loop, so shorter delays are just slept through:
+    await asyncio.sleep(max(permit.deadline - time.monotonic(), 0.0))
+    permit.overshoot = time.monotonic() - permit.deadline
+    if permit.semaphore_limits:
+        await asyncio.get_running_loop().run_in_executor(None, take_lease, permit, repository)
@@ -1,18 +1,59 @@
-import json
-import logging
-import time
+import importlib
 from abc import ABC, abstractmethod
-from typing import List, Optional
+from typing import Callable, Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
 
-from kazoo.client import KazooClient
-from kazoo.exceptions import NoNodeError
-from kazoo.recipe.counter import Counter
-from redis import Redis
+from .permit import Permit
 
-logger = logging.getLogger(__name__)
+# the backends are in separate modules (see `rlguard.backends`), so that their client libraries are only imported
+# when they are used; they can still be imported from here:
+_BACKEND_CLASSES = {
+    "RedisRepository": ".backends.redis",
+    "RedisCapacitySubscription": ".backends.redis",
+    "ZooKeeperRepository": ".backends.zookeeper",
+    "ZooKeeperCapacitySubscription": ".backends.zookeeper",
+    "MemoryRepository": ".backends.memory",
+}
+
+
+def __getattr__(name):
+    if name in _BACKEND_CLASSES:
+        return getattr(importlib.import_module(_BACKEND_CLASSES[name], __package__), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+class CapacitySubscription(ABC):
+    """
+    Receives the capacity that was added to the counters out of schedule (see `Repository.publish_capacity`).
+    """
+
+    @abstractmethod
+    def get(self, timeout_s: float) -> Optional[Dict[str, float]]:
+        """
+        Waits for at most `timeout_s` and returns the credits (counter id -> units) published in the meantime,
+        or `None` if nothing was published.
+        """
+        pass
+
+    @abstractmethod
+    def close(self):
+        pass
 
 
 class Repository(ABC):
+    @classmethod
+    def from_url(cls, url: str) -> "Repository":
+        """
+        Creates the repository described by the URL, e.g. `redis://localhost:6379/0`,
+        `zk://localhost:2181/openeo/rlguard` or `memory://`.
+
+        The backend is chosen by the scheme of the URL (see `rlguard.backends`); only its module (and the client
+        library it uses) is imported.
+        """
+        from .backends import get_backend
+
+        return get_backend(urlsplit(url).scheme)(url)
+
     @abstractmethod
     def init_rate_limits(self, rate_limits: List[dict], expires_within_ms: int):
         pass
@@ -22,171 +63,187 @@ class Repository(ABC):
         pass
 
     @abstractmethod
-    def get_policy_types(self) -> dict:
+    def increment_counters(self, amounts: Dict[str, float]) -> Dict[str, float]:
+        """
+        Increments several counters in a single step and returns their new values. Implementations
+        should apply all of the increments atomically if the backing store allows it.
+        """
         pass
 
     @abstractmethod
-    def get_policy_refills(self) -> dict:
+    def increment_counters_timed(self, amounts: Dict[str, float]) -> Tuple[Dict[str, float], int]:
+        """
+        Same as `increment_counters`, but also returns the time (in ns since epoch) at which the increments
+        were applied, as measured by the clock of the backing store if possible.
+        """
         pass
 
     @abstractmethod
-    def get_buckets_state(self) -> dict:
+    def acquire_lease(self, semaphores: Dict[str, int], lease_id: str, lease_ttl_ms: int) -> Optional[float]:
+        """
+        Takes a lease (with given TTL) in each of the semaphores (semaphore id -> limit of concurrent leases),
+        but only if none of them is full; the leases are taken atomically.
+
+        Returns `None` if the leases were taken. Otherwise nothing is changed, and the time (in ms) until a lease
+        in each of the full semaphores expires is returned.
+        """
         pass
 
     @abstractmethod
-    def is_syncer_alive(self) -> bool:
+    def renew_lease(self, semaphore_ids: List[str], lease_id: str, lease_ttl_ms: int):
         pass
 
     @abstractmethod
-    def signal_syncer_alive(self, expires_within_ms: int):
+    def release_lease(self, semaphore_ids: List[str], lease_id: str):
         pass
 
     @abstractmethod
-    def get_access_token(self) -> Optional[dict]:
+    def init_semaphores(self, semaphore_limits: Dict[str, int]):
         pass
 
     @abstractmethod
-    def save_access_token(self, token: str, expires_at_s: int):
+    def get_semaphore_limits(self) -> Dict[str, int]:
         pass
 
+    @abstractmethod
+    def get_counters(self, counter_ids: List[str]) -> Dict[str, float]:
+        pass
 
-class RedisRepository(Repository):
-    def __init__(self, rds: Redis):
-        super().__init__()
-
-        self._rds = rds
-        self._remaining_key = b"remaining"
-        self._refills_key = b"refill_ns"
-        self._types_key = b"types"
-        self._alive_key = b"syncer_alive"
-        self._alive_value = b"1"
-
-    def init_rate_limits(self, rate_limits: List[dict], expires_within_ms: int):
-        with self._rds.pipeline() as pipe:
-            pipe.delete(self._remaining_key, self._refills_key, self._types_key)
-            for policy in rate_limits:
-                pipe.hset(self._remaining_key, policy["id"], policy["initial"])
-                pipe.hset(self._refills_key, policy["id"], policy["nanos_between_refills"])
-                pipe.hset(self._types_key, policy["id"], policy["type"])
-
-            pipe.set(self._alive_key, self._alive_value, px=expires_within_ms)
-            pipe.execute()
-
-    def increment_counter(self, policy_id: str, amount: float) -> float:
-        return self._rds.hincrbyfloat(self._remaining_key, policy_id, amount)
-
+    @abstractmethod
     def get_policy_types(self) -> dict:
-        return self._rds.hgetall(self._types_key)
+        pass
 
+    @abstractmethod
     def get_policy_refills(self) -> dict:
-        return self._rds.hgetall(self._refills_key)
-
-    def get_buckets_state(self) -> dict:
-        return self._rds.hgetall(self._remaining_key)
-
-    def is_syncer_alive(self) -> bool:
-        return self._rds.get(self._alive_key)
+        pass
 
-    def signal_syncer_alive(self, expires_within_ms: int):
-        self._rds.set(self._alive_key, self._alive_value, px=expires_within_ms)
+    @abstractmethod
+    def set_policy_refills(self, policy_refills: Dict[str, int]):
+        pass
 
-    def get_access_token(self) -> Optional[dict]:
-        return None
+    @abstractmethod
+    def get_policy_capacities(self) -> dict:
+        pass
 
-    def save_access_token(self, token: str, expires_at_s: int):
+    @abstractmethod
+    def set_policy_capacities(self, policy_capacities: Dict[str, float]):
         pass
 
+    @abstractmethod
+    def get_buckets_state(self) -> dict:
+        pass
 
-class ZooKeeperRepository(Repository):
-    def __init__(self, client: KazooClient, key_base: str):
-        super().__init__()
+    @abstractmethod
+    def get_job_quota(self, job_id: str) -> Optional[dict]:
+        pass
 
-        self._client = client
-        self._remaining_key = f"{key_base}/remaining"
-        self._refills_key = f"{key_base}/refill_ns"
-        self._types_key = f"{key_base}/types"
-        self._alive_key = f"{key_base}/syncer_alive"
-        self._access_token_key = f"{key_base}/access_token"
+    @abstractmethod
+    def get_job_quotas(self) -> Dict[str, dict]:
+        pass
 
-    def _counter(self, policy_id: str) -> Counter:
-        return self._client.Counter(f"{self._remaining_key}/{policy_id}", default=0.0)
+    @abstractmethod
+    def save_job_quota(self, job_id: str, quota: dict):
+        pass
 
-    def init_rate_limits(self, rate_limits: List[dict], expires_within_ms: int):
-        # TODO: mimic counter structure instead? (/openeo/rlguard/remaining/some_policy_id)
-        policy_refills = {}
-        policy_types = {}
+    @abstractmethod
+    def delete_job_quota(self, job_id: str):
+        """
+        Deletes the quota of the job together with the counters of its sub-buckets (see `job_bucket_id`).
+        """
+        pass
 
-        for policy in rate_limits:
-            policy_refills[policy["id"]] = policy["nanos_between_refills"]
-            policy_types[policy["id"]] = policy["type"]
+    def get_learned_cost(self, signature: str) -> Optional[dict]:
+        """
+        Returns the cost (PUs) learned for the requests with the given signature (see `rlguard.costs`), or `None`
+        if it is not known (or if the backend doesn't share the learned costs).
+        """
+        return None
 
-            policy_remaining = self._counter(policy["id"])
-            try:
-                self._client.delete(policy_remaining.path)
-            except NoNodeError:
-                pass
-            policy_remaining += float(policy["initial"])
+    def save_learned_cost(self, signature: str, cost: dict, ttl_s: float):
+        """
+        Shares the cost learned for the requests with the given signature with the other workers, for `ttl_s`.
+        """
+        pass
 
-        self._client.ensure_path(self._refills_key)
-        self._client.set(self._refills_key, json.dumps(policy_refills).encode())
+    def purge_learned_costs(self):
+        """
+        Removes the learned costs which have expired. Called periodically by the syncer, for the backends whose
+        entries don't expire by themselves.
+        """
+        pass
 
-        self._client.ensure_path(self._types_key)
-        self._client.set(self._types_key, json.dumps(policy_types).encode())
+    @abstractmethod
+    def get_rate_multiplier(self) -> float:
+        pass
 
-        self._client.ensure_path(self._alive_key)
-        self.signal_syncer_alive(expires_within_ms)
+    @abstractmethod
+    def update_rate_multiplier(self, update: Callable[[float, float], Optional[Tuple[float, float]]]) -> float:
+        """
+        Atomically updates the rate multiplier and returns its new value.
+
+        `update` is called with the current value and the time (in ms) of its last decrease, and should
+        return the new pair, or `None` to leave the multiplier as it is. It might be called more than once
+        if other workers update the multiplier concurrently.
+        """
+        pass
 
-    def increment_counter(self, policy_id: str, amount: float) -> float:
-        counter = self._counter(policy_id)
-        counter += amount
-        return counter.value
+    @abstractmethod
+    def publish_capacity(self, credits: Dict[str, float]):
+        pass
 
-    def get_policy_types(self) -> dict:
-        return self._get_object(self._types_key)
+    def return_capacity(self, credits: Dict[str, float]):
+        """
+        Increments the counters by the returned capacity and lets the waiting workers know about it (positive
+        credits only). Backends can do it in a single step if they are able to.
+        """
+        self.increment_counters(credits)
+        positive_credits = {counter_id: units for counter_id, units in credits.items() if units > 0.0}
+        if positive_credits:
+            self.publish_capacity(positive_credits)
+
+    def issue_permit(self, processing_units: float, job_id: Optional[str], lease_ttl_s: float) -> Optional[Permit]:
+        """
+        Backends which calculate the delays on their side (see `PermitServerRepository`) return the whole permit
+        from a single call. Others return `None`, and the permit is calculated by `acquire_permit`.
+        """
+        return None
 
-    def get_policy_refills(self) -> dict:
-        return self._get_object(self._refills_key)
+    def issue_permits(
+        self, processing_units: List[float], job_id: Optional[str], lease_ttl_s: float
+    ) -> Optional[List[Permit]]:
+        """
+        Same as `issue_permit`, but for several requests at once.
+        """
+        return None
 
-    def get_buckets_state(self) -> dict:
-        return {policy_id: self._counter(policy_id).value for policy_id, _ in self.get_policy_types().items()}
+    @abstractmethod
+    def subscribe_capacity(self) -> CapacitySubscription:
+        pass
 
-    def _get_object(self, key: str) -> dict:
-        data, _ = self._client.get(key)
-        return json.loads(data.decode())
+    @abstractmethod
+    def save_permit_rates(self, permit_rates: Dict[str, float]):
+        pass
 
-    def signal_syncer_alive(self, expires_within_ms: int):
-        expires_at_ms = self._now_ms() + expires_within_ms
-        self._client.set(self._alive_key, repr(expires_at_ms).encode())
+    @abstractmethod
+    def get_backlog_state(self) -> dict:
+        """
+        Returns everything needed to calculate the backlog (policy types, refills, capacities, bucket values,
+        permit rates and the rate multiplier), read at once if the backing store allows it.
+        """
+        pass
 
+    @abstractmethod
     def is_syncer_alive(self) -> bool:
-        now_ms = self._now_ms()
-
-        data, _ = self._client.get(self._alive_key)
-        expires_at_ms = int(data.decode())
-
-        alive = now_ms <= expires_at_ms
-
-        if not alive:
-            logger.debug(f"{now_ms}: syncer expired at {expires_at_ms}")
-
-        return alive
+        pass
 
-    @staticmethod
-    def _now_ms():
-        return int(time.time() * 1000)
+    @abstractmethod
+    def signal_syncer_alive(self, expires_within_ms: int):
+        pass
 
+    @abstractmethod
     def get_access_token(self) -> Optional[dict]:
-        try:
-            return self._get_object(self._access_token_key)
-        except NoNodeError:
-            logger.warning(f"no access token at {self._access_token_key}", exc_info=True)
-            return None
+        pass
 
+    @abstractmethod
     def save_access_token(self, token: str, expires_at_s: int):
-        access_token = {
-            "token": token,
-            "expires_at": expires_at_s * 1000
-        }
-
-        self._client.ensure_path(self._access_token_key)
-        self._client.set(self._access_token_key, json.dumps(access_token).encode())
+        pass
@@ -0,0 +1,73 @@
+"""
+Rate-limited transport adapter for `requests`.
+"""
+import functools
+from typing import Callable, Optional
+
+from requests import Session
+from requests.adapters import HTTPAdapter
+
+from .costs import CostEstimator
+from .process_api import MAX_RETRIES, estimate_process_request_pu, is_process_api_request, send_with_permits
+from .repository import Repository
+
+
+class RateLimitedHTTPAdapter(HTTPAdapter):
+    """
+    Coordinates Process API requests through the repository: their PUs are estimated from the request body,
+    a permit is obtained and waited for, and the response is reported back (429 responses are retried).
+
+    If `cost_estimator` is given, the PUs are the costs it has learned for requests of the same shape (the
+    estimate is only used for the ones it doesn't know yet), and it learns from the PUs the responses report.
+
+    Other requests (e.g. authentication) are sent as they are. Connections are pooled by `HTTPAdapter`, so
+    the adapter should be reused (e.g. by mounting it on a long-lived `Session`).
+    """
+
+    def __init__(
+        self,
+        repository: Repository,
+        job_id: Optional[str] = None,
+        estimate_pu: Callable[[Optional[bytes]], float] = estimate_process_request_pu,
+        max_rate_limit_retries: int = MAX_RETRIES,
+        cost_estimator: Optional[CostEstimator] = None,
+        **kwargs,
+    ):
+        super().__init__(**kwargs)
+        self._repository = repository
+        self._job_id = job_id
+        self._estimate_pu = estimate_pu
+        self._max_rate_limit_retries = max_rate_limit_retries
+        self._cost_estimator = cost_estimator
+
+    def send(self, request, **kwargs):
+        if not is_process_api_request(request.method, request.url):
+            return super().send(request, **kwargs)
+
+        body = request.body.encode() if isinstance(request.body, str) else request.body
+        if self._cost_estimator is not None:
+            processing_units, signature = self._cost_estimator.estimate(body, self._estimate_pu)
+            on_response = functools.partial(self._cost_estimator.observe_response, signature)
+        else:
+            processing_units, on_response = self._estimate_pu(body), None
+        return send_with_permits(
+            send=lambda: super(RateLimitedHTTPAdapter, self).send(request, **kwargs),
+            close=lambda response: response.close(),
+            processing_units=processing_units,
+            repository=self._repository,
+            job_id=self._job_id,
+            max_retries=self._max_rate_limit_retries,
+            on_response=on_response,
+        )
+
+
+class RateLimitedSession(Session):
+    """
+    `requests.Session` with `RateLimitedHTTPAdapter` mounted for all HTTP(S) requests.
+    """
+
+    def __init__(self, repository: Repository, job_id: Optional[str] = None, **adapter_kwargs):
+        super().__init__()
+        adapter = RateLimitedHTTPAdapter(repository, job_id=job_id, **adapter_kwargs)
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
@@ -0,0 +1,443 @@
+"""
+Resilience to outages of the backing store (Redis, ZooKeeper, permit server).
+
+Calls to a store which is slow or unreachable would otherwise block the workers for as long as the client library's
+timeouts are, so a blip of the store stalls the whole fleet. `ResilientRepository` gives each call a deadline and
+stops calling the store (for a while) once it has failed repeatedly. In the meantime, permits are issued locally.
+"""
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import Callable, Dict, List, Optional, Tuple
+
+from . import PolicyType, SyncerDownException, acquire_permit
+from .permit import Permit
+from .repository import CapacitySubscription, Repository
+
+logger = logging.getLogger(__name__)
+
+CALL_TIMEOUT_S = 1.0
+FAILURE_THRESHOLD = 3
+RESET_TIMEOUT_S = 5.0
+MAX_WORKERS = 32
+# the share of the fleet's rate a worker assumes before it knows better (see `ResilientRepository`):
+DEFAULT_FLEET_SHARE = 0.1
+MIN_FLEET_SHARE = 0.001
+FLEET_SHARE_UPDATE_S = 10.0
+# local buckets allow bursts of at most this many seconds worth of the worker's share:
+LOCAL_BURST_S = 1.0
+# the policies (and the rate multiplier) the local buckets are seeded with are read again this often:
+POLICIES_REFRESH_S = 60.0
+
+_RAISE = object()
+
+
+class RepositoryUnavailableException(SyncerDownException):
+    """
+    The backing store can't be reached and there is nothing to fall back to. It is a `SyncerDownException`, so
+    the workers can handle it the same way (with manual retries).
+    """
+
+    pass
+
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive failures. After `reset_timeout_s` a single call is let through
+    (half-open); if it succeeds, the breaker closes again, otherwise it stays open for another `reset_timeout_s`.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, failure_threshold: int = FAILURE_THRESHOLD, reset_timeout_s: float = RESET_TIMEOUT_S):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout_s = reset_timeout_s
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing_thread = None
+
+    @property
+    def state(self) -> str:
+        return self._state
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._state == self.CLOSED:
+                return True
+            if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout_s:
+                # this thread probes the store, everybody else keeps falling back until it is done:
+                self._state = self.HALF_OPEN
+                self._probing_thread = threading.get_ident()
+                return True
+            return self._state == self.HALF_OPEN and self._probing_thread == threading.get_ident()
+
+    def record_success(self) -> bool:
+        """
+        Returns True if the breaker has just closed (i.e. the store has recovered).
+        """
+        with self._lock:
+            recovered = self._state != self.CLOSED
+            self._state = self.CLOSED
+            self._failures = 0
+            return recovered
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self._state != self.OPEN:
+                    logger.warning("Backing store is unavailable, falling back to local permits")
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
+
+
+class ResilientCapacitySubscription(CapacitySubscription):
+    def __init__(self, repository: "ResilientRepository", subscription: Optional[CapacitySubscription]):
+        self._repository = repository
+        self._subscription = subscription
+
+    def get(self, timeout_s: float) -> Optional[Dict[str, float]]:
+        if self._subscription is not None:
+            try:
+                return self._repository._call_with_deadline(
+                    self._subscription.get, (timeout_s,), max(timeout_s, 0.0) + self._repository.call_timeout_s
+                )
+            except RepositoryUnavailableException:
+                self._subscription = None
+        # nobody can be heard from, so the caller simply waits:
+        time.sleep(max(timeout_s, 0.0))
+        return None
+
+    def close(self):
+        if self._subscription is not None:
+            try:
+                self._repository._call_with_deadline(self._subscription.close, (), self._repository.call_timeout_s)
+            except RepositoryUnavailableException:
+                pass
+
+
+class ResilientRepository(Repository):
+    """
+    Wraps a repository so that each call to the backing store has a deadline (`call_timeout_s`), and a circuit
+    breaker stops calling the store after `failure_threshold` consecutive failures.
+
+    While the breaker is open, `acquire_permit` (and `apply_for_request`) issues the permits from local buckets.
+    They are refilled at the last known rates of the policies (read on construction and then every
+    `POLICIES_REFRESH_S` while the store is available), scaled by the rate multiplier and multiplied by this
+    worker's share of the fleet: either `fleet_share`, or the worker's own permit rate relative to the permit rate
+    of all workers (measured by syncer), which is estimated every `FLEET_SHARE_UPDATE_S` while the store is
+    available. Corrections (`release`, `refund`, `report_response`) are dropped in the meantime, and the rate
+    multiplier is adjusted locally. Concurrency limits are not enforced by the local buckets.
+
+    After `reset_timeout_s` the store is probed again; once it responds, whatever was used up locally is charged
+    to its buckets, so that the fleet doesn't exceed the limits when the workers switch back.
+    """
+
+    def __init__(
+        self,
+        repository: Repository,
+        call_timeout_s: float = CALL_TIMEOUT_S,
+        failure_threshold: int = FAILURE_THRESHOLD,
+        reset_timeout_s: float = RESET_TIMEOUT_S,
+        fleet_share: Optional[float] = None,
+        max_workers: int = MAX_WORKERS,
+    ):
+        super().__init__()
+        self.repository = repository
+        self.call_timeout_s = call_timeout_s
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout_s)
+        self._fleet_share = fleet_share
+        # calls which have timed out keep their threads until the client library gives up on them:
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="rlguard-resilient")
+        self._acquiring = threading.local()
+
+        # the last known state of the store, and the local buckets seeded from it:
+        self._lock = threading.Lock()
+        self._policy_refills: Dict[str, float] = {}
+        self._policy_types: Dict[str, str] = {}
+        self._rate_multiplier = 1.0
+        self._decreased_at_ms = 0.0
+        self._shares: Dict[str, float] = {}
+        # policy id -> `time.monotonic()` at which the local bucket would be full again (GCRA):
+        self._local_tats: Dict[str, float] = {}
+        # units taken from the local buckets, to be charged to the store when it recovers:
+        self._local_used: Dict[str, float] = {}
+        # units taken by this worker from the store, to estimate its share of the fleet:
+        self._used: Dict[str, float] = {}
+        self._used_since = time.monotonic()
+        self._policies_read_at = None
+        self._refresh_policies()
+
+    def _call_with_deadline(self, function: Callable, arguments: tuple, timeout_s: float):
+        if not self.breaker.allow():
+            raise RepositoryUnavailableException("Backing store is unavailable (circuit breaker is open).")
+        future = self._executor.submit(function, *arguments)
+        try:
+            result = future.result(timeout=timeout_s)
+        except SyncerDownException:
+            # the store has answered (e.g. the permit server), it's syncer that is down:
+            self._record_success()
+            raise
+        except FutureTimeoutError as ex:
+            future.cancel()
+            self.breaker.record_failure()
+            raise RepositoryUnavailableException(f"Backing store didn't respond in {timeout_s}s.") from ex
+        except Exception as ex:
+            self.breaker.record_failure()
+            raise RepositoryUnavailableException(f"Backing store call has failed: {ex}") from ex
+        self._record_success()
+        return result
+
+    def _call(self, method: str, *arguments, fallback=_RAISE):
+        try:
+            return self._call_with_deadline(getattr(self.repository, method), arguments, self.call_timeout_s)
+        except RepositoryUnavailableException:
+            # while acquiring a permit from the store, any failure means falling back to the local buckets:
+            if fallback is _RAISE or getattr(self._acquiring, "active", False):
+                raise
+            logger.debug(f"Backing store is unavailable, {method} falls back to {fallback}")
+            return fallback
+
+    def _record_success(self):
+        if self.breaker.record_success():
+            logger.info("Backing store is available again")
+            self._resync()
+
+    def _resync(self):
+        with self._lock:
+            local_used, self._local_used = self._local_used, {}
+            self._local_tats = {}
+        if not local_used:
+            return
+        try:
+            self._call("increment_counters", {policy_id: -units for policy_id, units in local_used.items()})
+            logger.info(f"Charged the units used during the outage: {local_used}")
+        except RepositoryUnavailableException:
+            logger.warning(f"Could not charge the units used during the outage: {local_used}")
+
+    def _refresh_policies(self):
+        # `acquire_permit` reads the policies (through this wrapper) only if the wrapped repository doesn't issue
+        # the whole permits itself (as the permit server does), so they are read explicitly too:
+        try:
+            policy_refills = self._call("get_policy_refills")
+            policy_types = self._call("get_policy_types")
+            rate_multiplier = self._call("get_rate_multiplier")
+        except RepositoryUnavailableException:
+            logger.debug("Backing store is unavailable, the policies of the local buckets were not refreshed")
+            return
+        with self._lock:
+            self._policy_refills = dict(policy_refills)
+            self._policy_types = dict(policy_types)
+            self._rate_multiplier = float(rate_multiplier)
+            # until syncer has initialized the store, there is nothing to seed the local buckets with:
+            if self._policy_refills:
+                self._policies_read_at = time.monotonic()
+
+    def issue_permit(self, processing_units: float, job_id: Optional[str], lease_ttl_s: float) -> Optional[Permit]:
+        if getattr(self._acquiring, "active", False):
+            # called from `acquire_permit` below - the wrapped repository might be able to issue the permit itself:
+            return self._call("issue_permit", processing_units, job_id, lease_ttl_s)
+
+        if self.breaker.state == CircuitBreaker.CLOSED and (
+            self._policies_read_at is None or time.monotonic() - self._policies_read_at >= POLICIES_REFRESH_S
+        ):
+            self._refresh_policies()
+        if self.breaker.allow():
+            self._acquiring.active = True
+            try:
+                permit = acquire_permit(processing_units, self, job_id=job_id, lease_ttl_s=lease_ttl_s)
+            except RepositoryUnavailableException:
+                pass
+            else:
+                self._account_usage(permit)
+                return permit
+            finally:
+                self._acquiring.active = False
+        return self._issue_local_permit(processing_units, job_id)
+
+    def _account_usage(self, permit: Permit):
+        with self._lock:
+            for policy_id in self._policy_types:
+                if policy_id in permit.charges:
+                    self._used[policy_id] = self._used.get(policy_id, 0.0) + permit.charges[policy_id]
+            elapsed_s = time.monotonic() - self._used_since
+            if self._fleet_share is not None or elapsed_s < FLEET_SHARE_UPDATE_S:
+                return
+            own_rates = {policy_id: units / elapsed_s for policy_id, units in self._used.items()}
+            self._used, self._used_since = {}, time.monotonic()
+        try:
+            permit_rates = self._call("get_backlog_state")["permit_rates"]
+        except RepositoryUnavailableException:
+            return
+        shares = {
+            policy_id: min(max(own_rate / permit_rates[policy_id], MIN_FLEET_SHARE), 1.0)
+            for policy_id, own_rate in own_rates.items()
+            if permit_rates.get(policy_id, 0.0) > 0.0
+        }
+        with self._lock:
+            self._shares.update(shares)
+        logger.debug(f"Estimated share of the fleet: {shares}")
+
+    def _issue_local_permit(self, processing_units: float, job_id: Optional[str]) -> Permit:
+        with self._lock:
+            if not self._policy_refills:
+                raise RepositoryUnavailableException(
+                    "Backing store is unavailable and the rate limits are not known yet - revert to manual retries."
+                )
+            now = time.monotonic()
+            delay = 0.0
+            for policy_id, policy_type in self._policy_types.items():
+                if policy_id not in self._policy_refills:
+                    continue
+                charge = float(processing_units) if policy_type == PolicyType.PROCESSING_UNITS.value else 1.0
+                share = self._fleet_share or self._shares.get(policy_id, DEFAULT_FLEET_SHARE)
+                refill_s = float(self._policy_refills[policy_id]) / self._rate_multiplier / share / 1000000000.0
+                tat = max(self._local_tats.get(policy_id, now), now) + charge * refill_s
+                self._local_tats[policy_id] = tat
+                self._local_used[policy_id] = self._local_used.get(policy_id, 0.0) + charge
+                delay = max(delay, tat - now - LOCAL_BURST_S)
+        logger.debug(f"Issued a local permit with delay {delay:.3f}s")
+        # nothing was charged in the store, so there is nothing to return (or correct) later on:
+        return Permit(
+            delay=delay,
+            processing_units=float(processing_units),
+            job_id=job_id,
+            deadline=now + delay,
+            issued_at=now,
+        )
+
+    def issue_permits(
+        self, processing_units: List[float], job_id: Optional[str], lease_ttl_s: float
+    ) -> Optional[List[Permit]]:
+        # permits are issued one by one, so that each of them can fall back to the local buckets:
+        return None
+
+    def return_capacity(self, credits: Dict[str, float]):
+        self._call("return_capacity", credits, fallback=None)
+
+    def init_rate_limits(self, rate_limits: List[dict], expires_within_ms: int):
+        self._call("init_rate_limits", rate_limits, expires_within_ms)
+
+    def increment_counter(self, policy_id: str, amount: float) -> float:
+        return self._call("increment_counter", policy_id, amount)
+
+    def increment_counters(self, amounts: Dict[str, float]) -> Dict[str, float]:
+        return self._call("increment_counters", amounts, fallback={})
+
+    def increment_counters_timed(self, amounts: Dict[str, float]) -> Tuple[Dict[str, float], int]:
+        return self._call("increment_counters_timed", amounts)
+
+    def acquire_lease(self, semaphores: Dict[str, int], lease_id: str, lease_ttl_ms: int) -> Optional[float]:
+        # concurrency limits are not enforced while the store is unavailable, the same as by the local permits:
+        return self._call("acquire_lease", semaphores, lease_id, lease_ttl_ms, fallback=None)
+
+    def renew_lease(self, semaphore_ids: List[str], lease_id: str, lease_ttl_ms: int):
+        self._call("renew_lease", semaphore_ids, lease_id, lease_ttl_ms, fallback=None)
+
+    def release_lease(self, semaphore_ids: List[str], lease_id: str):
+        self._call("release_lease", semaphore_ids, lease_id, fallback=None)
+
+    def init_semaphores(self, semaphore_limits: Dict[str, int]):
+        self._call("init_semaphores", semaphore_limits)
+
+    def get_semaphore_limits(self) -> Dict[str, int]:
+        return self._call("get_semaphore_limits", fallback={})
+
+    def get_counters(self, counter_ids: List[str]) -> Dict[str, float]:
+        return self._call("get_counters", counter_ids, fallback={})
+
+    def get_policy_types(self) -> dict:
+        policy_types = self._call("get_policy_types", fallback=None)
+        with self._lock:
+            if policy_types is not None:
+                self._policy_types = dict(policy_types)
+            return dict(self._policy_types)
+
+    def get_policy_refills(self) -> dict:
+        policy_refills = self._call("get_policy_refills", fallback=None)
+        with self._lock:
+            if policy_refills is not None:
+                self._policy_refills = dict(policy_refills)
+            return dict(self._policy_refills)
+
+    def set_policy_refills(self, policy_refills: Dict[str, int]):
+        self._call("set_policy_refills", policy_refills)
+
+    def get_policy_capacities(self) -> dict:
+        return self._call("get_policy_capacities")
+
+    def set_policy_capacities(self, policy_capacities: Dict[str, float]):
+        self._call("set_policy_capacities", policy_capacities)
+
+    def get_buckets_state(self) -> dict:
+        return self._call("get_buckets_state")
+
+    def get_job_quota(self, job_id: str) -> Optional[dict]:
+        return self._call("get_job_quota", job_id, fallback=None)
+
+    def get_job_quotas(self) -> Dict[str, dict]:
+        return self._call("get_job_quotas")
+
+    def save_job_quota(self, job_id: str, quota: dict):
+        self._call("save_job_quota", job_id, quota)
+
+    def delete_job_quota(self, job_id: str):
+        self._call("delete_job_quota", job_id)
+
+    def get_learned_cost(self, signature: str) -> Optional[dict]:
+        return self._call("get_learned_cost", signature, fallback=None)
+
+    def save_learned_cost(self, signature: str, cost: dict, ttl_s: float):
+        self._call("save_learned_cost", signature, cost, ttl_s, fallback=None)
+
+    def purge_learned_costs(self):
+        self._call("purge_learned_costs", fallback=None)
+
+    def get_rate_multiplier(self) -> float:
+        rate_multiplier = self._call("get_rate_multiplier", fallback=None)
+        with self._lock:
+            if rate_multiplier is not None:
+                self._rate_multiplier = float(rate_multiplier)
+            return self._rate_multiplier
+
+    def update_rate_multiplier(self, update: Callable[[float, float], Optional[Tuple[float, float]]]) -> float:
+        rate_multiplier = self._call("update_rate_multiplier", update, fallback=None)
+        with self._lock:
+            if rate_multiplier is not None:
+                self._rate_multiplier = float(rate_multiplier)
+            else:
+                # the local buckets follow the reported responses until the store is back:
+                updated = update(self._rate_multiplier, self._decreased_at_ms)
+                if updated is not None:
+                    self._rate_multiplier, self._decreased_at_ms = updated
+            return self._rate_multiplier
+
+    def publish_capacity(self, credits: Dict[str, float]):
+        self._call("publish_capacity", credits, fallback=None)
+
+    def subscribe_capacity(self) -> CapacitySubscription:
+        return ResilientCapacitySubscription(self, self._call("subscribe_capacity", fallback=None))
+
+    def save_permit_rates(self, permit_rates: Dict[str, float]):
+        self._call("save_permit_rates", permit_rates)
+
+    def get_backlog_state(self) -> dict:
+        return self._call("get_backlog_state")
+
+    def is_syncer_alive(self) -> bool:
+        return self._call("is_syncer_alive")
+
+    def signal_syncer_alive(self, expires_within_ms: int):
+        self._call("signal_syncer_alive", expires_within_ms)
+
+    def get_access_token(self) -> Optional[dict]:
+        return self._call("get_access_token")
+
+    def save_access_token(self, token: str, expires_at_s: int):
+        self._call("save_access_token", token, expires_at_s)
@@ -0,0 +1,262 @@
+"""
+Sharded buckets, for permit rates which a single hot key of the backing store can't sustain.
+"""
+import logging
+import os
+import socket
+import zlib
+from typing import Callable, Dict, List, Optional, Tuple
+
+from .repository import CapacitySubscription, Repository
+
+logger = logging.getLogger(__name__)
+
+
+def redis_shards(rds, n_shards: int, key_prefix: str = "") -> List[Repository]:
+    """
+    Returns the repositories of `n_shards` shards in the same Redis (or Redis Cluster). Keys of each shard
+    share a hash tag, so in a cluster each shard is kept in a single slot and different shards can be spread
+    across the nodes.
+    """
+    from .backends.redis import RedisRepository
+
+    return [RedisRepository(rds, key_prefix=f"{{{key_prefix}shard-{k}}}:") for k in range(n_shards)]
+
+
+def default_home_shard(n_shards: int) -> int:
+    return zlib.crc32(f"{socket.gethostname()}:{os.getpid()}".encode()) % n_shards
+
+
+class ShardedRepository(Repository):
+    """
+    Splits each bucket evenly across several shards (each of them a separate repository), so that the workers
+    don't all decrement the same counter.
+
+    Each worker decrements the buckets of its home shard; when the home shard runs dry, it tries to take the
+    permit from the sibling shards instead. Syncer fills all of the shards and rebalances them (see `rebalance`)
+    on every tick, so the total capacity stays the same and the shards stay level - which means that the delay
+    computed from the home shard alone is (approximately) the same as it would be with a single bucket.
+
+    To the callers, the repository looks the same as a single one: bucket values, refills and capacities are
+    totals of all shards. Everything that can't be split (concurrency leases, the rate multiplier, access token)
+    is kept in the first (primary) shard and mirrored to the others where it is read on the hot path.
+    """
+
+    def __init__(self, shards: List[Repository], home_shard: Optional[int] = None):
+        super().__init__()
+        if not shards:
+            raise ValueError("At least one shard is needed.")
+        self._shards = shards
+        self._n_shards = len(shards)
+        if home_shard is None:
+            home_shard = default_home_shard(self._n_shards)
+        self._home_shard = home_shard % self._n_shards
+        self._home = shards[self._home_shard]
+        self._primary = shards[0]
+
+    @property
+    def shards(self) -> List[Repository]:
+        return self._shards
+
+    def _scaled(self, values: Dict[str, float]) -> Dict[str, float]:
+        # a shard holds its share of the bucket - with level shards, the total is n times as much:
+        return {counter_id: float(value) * self._n_shards for counter_id, value in values.items()}
+
+    def _summed(self, shard_values: List[Dict[str, float]]) -> Dict[str, float]:
+        totals = {}
+        for values in shard_values:
+            for counter_id, value in values.items():
+                totals[counter_id] = totals.get(counter_id, 0.0) + float(value)
+        return totals
+
+    def init_rate_limits(self, rate_limits: List[dict], expires_within_ms: int):
+        # each shard gets its share of the capacity and is refilled n times slower:
+        shard_rate_limits = [
+            {
+                **policy,
+                "initial": float(policy["initial"]) / self._n_shards,
+                "capacity": float(policy["capacity"]) / self._n_shards,
+                "nanos_between_refills": int(policy["nanos_between_refills"]) * self._n_shards,
+            }
+            for policy in rate_limits
+        ]
+        for shard in self._shards:
+            shard.init_rate_limits(shard_rate_limits, expires_within_ms)
+
+    def increment_counter(self, policy_id: str, amount: float) -> float:
+        """
+        Splits the amount evenly across the shards (used by syncer to fill & correct the buckets) and returns
+        the new total.
+        """
+        return sum(shard.increment_counter(policy_id, amount / self._n_shards) for shard in self._shards)
+
+    def increment_counters(self, amounts: Dict[str, float]) -> Dict[str, float]:
+        """
+        Increments the counters of the home shard; `rebalance` spreads the difference to the other shards.
+        """
+        return self._scaled(self._home.increment_counters(amounts))
+
+    def increment_counters_timed(self, amounts: Dict[str, float]) -> Tuple[Dict[str, float], int]:
+        new_values, server_time_ns = self._home.increment_counters_timed(amounts)
+        if self._n_shards == 1 or not self._just_ran_dry(amounts, new_values):
+            return self._scaled(new_values), server_time_ns
+
+        # the home shard has run dry, but the siblings might still have some capacity left:
+        refund = {counter_id: -amount for counter_id, amount in amounts.items()}
+        for i in range(1, self._n_shards):
+            sibling = self._shards[(self._home_shard + i) % self._n_shards]
+            sibling_values, sibling_time_ns = sibling.increment_counters_timed(amounts)
+            if all(value >= 0.0 for value in sibling_values.values()):
+                self._home.increment_counters(refund)
+                logger.debug(f"Took the permit from shard {(self._home_shard + i) % self._n_shards}")
+                return self._scaled(sibling_values), sibling_time_ns
+            sibling.increment_counters(refund)
+        return self._scaled(new_values), server_time_ns
+
+    @staticmethod
+    def _just_ran_dry(amounts: Dict[str, float], new_values: Dict[str, float]) -> bool:
+        # if some bucket was already empty before, the siblings (which are kept level) are most likely empty too
+        # and stealing would only cost round trips:
+        empty = [counter_id for counter_id, value in new_values.items() if value < 0.0]
+        return bool(empty) and all(new_values[counter_id] - amounts[counter_id] >= 0.0 for counter_id in empty)
+
+    def acquire_lease(self, semaphores: Dict[str, int], lease_id: str, lease_ttl_ms: int) -> Optional[float]:
+        # concurrency limits are global, so the leases are always taken in the primary shard:
+        return self._primary.acquire_lease(semaphores, lease_id, lease_ttl_ms)
+
+    def renew_lease(self, semaphore_ids: List[str], lease_id: str, lease_ttl_ms: int):
+        self._primary.renew_lease(semaphore_ids, lease_id, lease_ttl_ms)
+
+    def release_lease(self, semaphore_ids: List[str], lease_id: str):
+        self._primary.release_lease(semaphore_ids, lease_id)
+
+    def init_semaphores(self, semaphore_limits: Dict[str, int]):
+        for shard in self._shards:
+            shard.init_semaphores(semaphore_limits)
+
+    def get_semaphore_limits(self) -> Dict[str, int]:
+        return self._home.get_semaphore_limits()
+
+    def get_counters(self, counter_ids: List[str]) -> Dict[str, float]:
+        return self._summed([shard.get_counters(counter_ids) for shard in self._shards])
+
+    def get_policy_types(self) -> dict:
+        return self._home.get_policy_types()
+
+    def get_policy_refills(self) -> dict:
+        policy_refills = self._home.get_policy_refills()
+        return {policy_id: float(refill) / self._n_shards for policy_id, refill in policy_refills.items()}
+
+    def set_policy_refills(self, policy_refills: Dict[str, int]):
+        for shard in self._shards:
+            shard.set_policy_refills(
+                {policy_id: int(refill) * self._n_shards for policy_id, refill in policy_refills.items()}
+            )
+
+    def get_policy_capacities(self) -> dict:
+        return self._scaled(self._home.get_policy_capacities())
+
+    def set_policy_capacities(self, policy_capacities: Dict[str, float]):
+        for shard in self._shards:
+            shard.set_policy_capacities(
+                {policy_id: float(capacity) / self._n_shards for policy_id, capacity in policy_capacities.items()}
+            )
+
+    def get_buckets_state(self) -> dict:
+        return self._summed([shard.get_buckets_state() for shard in self._shards])
+
+    def get_job_quota(self, job_id: str) -> Optional[dict]:
+        return self._home.get_job_quota(job_id)
+
+    def get_job_quotas(self) -> Dict[str, dict]:
+        return self._home.get_job_quotas()
+
+    def save_job_quota(self, job_id: str, quota: dict):
+        for shard in self._shards:
+            shard.save_job_quota(job_id, quota)
+
+    def delete_job_quota(self, job_id: str):
+        for shard in self._shards:
+            shard.delete_job_quota(job_id)
+
+    def get_learned_cost(self, signature: str) -> Optional[dict]:
+        return self._primary.get_learned_cost(signature)
+
+    def save_learned_cost(self, signature: str, cost: dict, ttl_s: float):
+        self._primary.save_learned_cost(signature, cost, ttl_s)
+
+    def purge_learned_costs(self):
+        self._primary.purge_learned_costs()
+
+    def get_rate_multiplier(self) -> float:
+        return self._home.get_rate_multiplier()
+
+    def update_rate_multiplier(self, update: Callable[[float, float], Optional[Tuple[float, float]]]) -> float:
+        updated = []
+
+        def record(value, decreased_at_ms):
+            result = update(value, decreased_at_ms)
+            updated[:] = [result]
+            return result
+
+        value = self._primary.update_rate_multiplier(record)
+        # the multiplier is read on every acquire, so its copies are kept in all shards:
+        if updated and updated[0] is not None:
+            for shard in self._shards[1:]:
+                shard.update_rate_multiplier(lambda _value, _decreased_at_ms: updated[0])
+        return value
+
+    def rebalance(self) -> Dict[str, float]:
+        """
+        Levels the counters of all shards (keeping their total), so that the delays computed from any of the
+        shards are the same. Returns the totals of the counters.
+        """
+        shard_values = [
+            {counter_id: float(value) for counter_id, value in shard.get_buckets_state().items()}
+            for shard in self._shards
+        ]
+        totals = self._summed(shard_values)
+        for shard, values in zip(self._shards, shard_values):
+            # increments (instead of setting the values) don't lose the decrements made in the meantime:
+            increments = {
+                counter_id: total / self._n_shards - values.get(counter_id, 0.0) for counter_id, total in totals.items()
+            }
+            increments = {counter_id: amount for counter_id, amount in increments.items() if amount != 0.0}
+            if increments:
+                shard.increment_counters(increments)
+        return totals
+
+    def publish_capacity(self, credits: Dict[str, float]):
+        # workers only listen to their home shard:
+        for shard in self._shards:
+            shard.publish_capacity(credits)
+
+    def subscribe_capacity(self) -> CapacitySubscription:
+        return self._home.subscribe_capacity()
+
+    def save_permit_rates(self, permit_rates: Dict[str, float]):
+        for shard in self._shards:
+            shard.save_permit_rates(permit_rates)
+
+    def get_backlog_state(self) -> dict:
+        shard_states = [shard.get_backlog_state() for shard in self._shards]
+        state = shard_states[self._home_shard]
+        return {
+            **state,
+            "refills": {policy_id: refill / self._n_shards for policy_id, refill in state["refills"].items()},
+            "capacities": self._scaled(state["capacities"]),
+            "remaining": self._summed([shard_state["remaining"] for shard_state in shard_states]),
+        }
+
+    def is_syncer_alive(self) -> bool:
+        return self._home.is_syncer_alive()
+
+    def signal_syncer_alive(self, expires_within_ms: int):
+        for shard in self._shards:
+            shard.signal_syncer_alive(expires_within_ms)
+
+    def get_access_token(self) -> Optional[dict]:
+        return self._primary.get_access_token()
+
+    def save_access_token(self, token: str, expires_at_s: int):
+        self._primary.save_access_token(token, expires_at_s)
@@ -0,0 +1,116 @@
+"""
+Optional recording of the decisions of the guard (permits and their delays, fills and refreshes of the buckets), so
+that they can be inspected and replayed offline (see `syncer/replay.py`).
+
+Events are buffered in memory and appended to a JSON lines file by a background thread, so recording doesn't block
+the workers on I/O. Recording is enabled by `set_trace_recorder` or by setting `RLGUARD_TRACE_PATH` env var
+(`{pid}` and `{host}` in the path are replaced, so that each process can write its own file).
+"""
+import atexit
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from typing import List, Optional
+
+logger = logging.getLogger(__name__)
+
+TRACE_PATH_ENV = "RLGUARD_TRACE_PATH"
+FLUSH_INTERVAL_S = 1.0
+# if the events can't be written fast enough, the newest ones are dropped instead of using more and more memory:
+MAX_BUFFERED_EVENTS = 100000
+
+
+class TraceRecorder:
+    def __init__(
+        self, path: str, flush_interval_s: float = FLUSH_INTERVAL_S, max_buffered_events: int = MAX_BUFFERED_EVENTS
+    ):
+        self.path = path.format(pid=os.getpid(), host=socket.gethostname())
+        self._flush_interval_s = flush_interval_s
+        self._max_buffered_events = max_buffered_events
+        self._buffer: List[dict] = []
+        self._dropped = 0
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._file = open(self.path, "a")
+        self._flusher = threading.Thread(target=self._run, name="rlguard-trace", daemon=True)
+        self._flusher.start()
+        # whatever is buffered when the process exits is still written:
+        atexit.register(self.close)
+
+    def record(self, event: str, **fields):
+        """
+        Adds the event (with the current time, in s since epoch) to the trace.
+        """
+        entry = {"t": time.time(), "event": event, **fields}
+        with self._lock:
+            if len(self._buffer) >= self._max_buffered_events:
+                self._dropped += 1
+                return
+            self._buffer.append(entry)
+
+    def flush(self):
+        with self._lock:
+            buffer, self._buffer = self._buffer, []
+            dropped, self._dropped = self._dropped, 0
+        if dropped:
+            logger.warning(f"Dropped {dropped} trace events, the buffer was full")
+        if buffer:
+            self._file.write("".join(json.dumps(entry) + "\n" for entry in buffer))
+            self._file.flush()
+
+    def _run(self):
+        while not self._closed.wait(self._flush_interval_s):
+            try:
+                self.flush()
+            except Exception:
+                logger.warning("Could not write trace events", exc_info=True)
+
+    def close(self):
+        if self._closed.is_set():
+            return
+        self._closed.set()
+        self._flusher.join()
+        self.flush()
+        self._file.close()
+
+
+_recorder: Optional[TraceRecorder] = None
+_recorder_lock = threading.Lock()
+_env_checked = False
+
+
+def set_trace_recorder(recorder: Optional[TraceRecorder]):
+    global _recorder, _env_checked
+    with _recorder_lock:
+        _recorder = recorder
+        _env_checked = True
+
+
+def get_trace_recorder() -> Optional[TraceRecorder]:
+    """
+    Returns the recorder used by this process, or `None` if recording is not enabled.
+    """
+    global _recorder, _env_checked
+    if not _env_checked:
+        with _recorder_lock:
+            if not _env_checked:
+                path = os.environ.get(TRACE_PATH_ENV)
+                if path:
+                    _recorder = TraceRecorder(path)
+                    logger.info(f"Recording trace to {_recorder.path}")
+                _env_checked = True
+    return _recorder
+
+
+def read_trace(paths: List[str]) -> List[dict]:
+    """
+    Reads the events from the trace files (e.g. of all workers and syncer) and returns them ordered by time.
+    """
+    events = []
+    for path in paths:
+        with open(path) as fh:
+            events.extend(json.loads(line) for line in fh if line.strip())
+    return sorted(events, key=lambda event: event["t"])
@@ -1,3 +1,18 @@
 from setuptools import setup, find_packages
 
-setup(name="rlguard-lib", version="0.0.6", packages=find_packages(), install_requires=["kazoo", "redis"])
+setup(
+    name="rlguard-lib",
+    version="0.1.0",
+    packages=find_packages(),
+    # client libraries of the backends are optional (workers only import the one they use), but they are still
+    # installed by default for this release, so that upgrading doesn't break the existing installations; they will
+    # be moved to the extras only in the next one:
+    install_requires=["kazoo", "redis"],
+    extras_require={
+        "redis": ["redis"],
+        "zookeeper": ["kazoo"],
+        "planning": ["numpy"],
+        "requests": ["requests"],
+        "httpx": ["httpx"],
+    },
+)
@@ -0,0 +1,102 @@
+"""
+Run from the `lib` directory: `python -m pytest tests`.
+"""
+import threading
+import time
+
+import pytest
+
+from rlguard import (
+    ConcurrencyLimitException,
+    acquire_permit,
+    apply_for_request,
+    complete,
+    set_job_quota,
+    wait_for_capacity,
+)
+from rlguard.backends.memory import MemoryRepository
+
+RATE_LIMITS = [{"id": "PU_1", "type": "PU", "initial": 100, "capacity": 100, "nanos_between_refills": 10000000}]
+
+
+def make_repository(semaphore_limits=None):
+    repository = MemoryRepository()
+    repository.init_rate_limits(RATE_LIMITS, 60000)
+    repository.init_semaphores(semaphore_limits or {})
+    return repository
+
+
+def wait_in_thread(permit):
+    done = threading.Event()
+
+    def wait():
+        permit.wait()
+        done.set()
+
+    threading.Thread(target=wait, daemon=True).start()
+    return done
+
+
+def test_wait_takes_the_lease():
+    repository = make_repository({"CC_1": 1})
+    first = acquire_permit(1, repository)
+    second = acquire_permit(1, repository)
+    assert first.lease_id is None
+
+    first.wait()
+    assert first.lease_id is not None
+    assert first.semaphores == ["CC_1"]
+
+    # the only slot is held by the first request until it is completed:
+    done = wait_in_thread(second)
+    assert not done.wait(0.3)
+    complete(first, repository)
+    assert done.wait(2.0)
+    assert second.lease_id is not None
+
+
+def test_lease_is_taken_once():
+    repository = make_repository({"CC_1": 2})
+    permit = acquire_permit(1, repository)
+    wait_for_capacity(permit, repository)
+    lease_id = permit.lease_id
+    permit.wait()
+    assert permit.lease_id == lease_id
+    assert repository.acquire_lease({"CC_1": 2}, "other", 1000) is None
+
+
+def test_leases_expire():
+    repository = make_repository({"CC_1": 1})
+    first = acquire_permit(1, repository, lease_ttl_s=0.2)
+    first.wait()
+    second = acquire_permit(1, repository)
+
+    started_at = time.monotonic()
+    second.wait()
+    # the worker which held the slot has crashed, so its lease expired:
+    assert time.monotonic() - started_at == pytest.approx(0.2, abs=0.15)
+    assert second.lease_id is not None
+
+
+def test_job_concurrency():
+    repository = make_repository()
+    set_job_quota("a", 1.0, repository, max_concurrent=1)
+    first = acquire_permit(1, repository, job_id="a")
+    first.wait()
+    assert first.semaphores == ["CC@a"]
+
+    # other jobs are not limited:
+    other = acquire_permit(1, repository, job_id="b")
+    assert wait_in_thread(other).wait(1.0)
+    second = acquire_permit(1, repository, job_id="a")
+    assert not wait_in_thread(second).wait(0.3)
+
+
+def test_apply_for_request_refuses_concurrency_limits():
+    repository = make_repository({"CC_1": 1})
+    with pytest.raises(ConcurrencyLimitException):
+        apply_for_request(5, repository)
+    # nothing was charged:
+    assert repository.get_buckets_state() == {"PU_1": 100.0}
+
+    assert apply_for_request(5, make_repository()) == 0.0
@@ -0,0 +1,49 @@
+"""
+Run from the `lib` directory: `python -m pytest tests`.
+"""
+import pytest
+
+from rlguard import SyncerDownException, acquire_permit, acquire_permit_any
+from rlguard.backends.memory import MemoryRepository
+
+RATE_LIMITS = [{"id": "PU_1", "type": "PU", "initial": 10, "capacity": 10, "nanos_between_refills": 100000000}]
+
+
+class UnreachableRepository(MemoryRepository):
+    def get_backlog_state(self) -> dict:
+        raise ConnectionError("store is down")
+
+
+def make_repository(cls=MemoryRepository):
+    repository = cls()
+    repository.init_rate_limits(RATE_LIMITS, 60000)
+    return repository
+
+
+def test_least_loaded_endpoint_is_chosen():
+    busy, idle = make_repository(), make_repository()
+    acquire_permit(15, busy)
+
+    permit = acquire_permit_any(1, {"busy": busy, "idle": idle})
+
+    assert permit.endpoint == "idle"
+    assert idle.get_buckets_state() == {"PU_1": 9.0}
+
+
+def test_unreachable_endpoint_is_skipped():
+    busy = make_repository()
+    acquire_permit(15, busy)
+
+    permit = acquire_permit_any(1, {"unreachable": make_repository(UnreachableRepository), "busy": busy})
+
+    assert permit.endpoint == "busy"
+
+
+def test_endpoints_with_syncer_down_are_skipped():
+    down = make_repository()
+    down.signal_syncer_alive(-1)
+    permit = acquire_permit_any(1, {"down": down, "up": make_repository()})
+    assert permit.endpoint == "up"
+
+    with pytest.raises(SyncerDownException):
+        acquire_permit_any(1, {"down": down, "unreachable": make_repository(UnreachableRepository)})
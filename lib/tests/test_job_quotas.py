@@ -0,0 +1,64 @@
+"""
+Run from the `lib` directory: `python -m pytest tests`.
+"""
+from rlguard import acquire_permit, is_job_bucket_id, job_bucket_id, remove_job_quota, set_job_quota
+from rlguard.backends.memory import MemoryRepository
+
+RATE_LIMITS = [
+    {"id": "PU_1", "type": "PU", "initial": 100, "capacity": 100, "nanos_between_refills": 10000000},
+    {"id": "RQ_1", "type": "RQ", "initial": 10, "capacity": 10, "nanos_between_refills": 100000000},
+]
+
+
+def make_repository():
+    repository = MemoryRepository()
+    repository.init_rate_limits(RATE_LIMITS, 60000)
+    return repository
+
+
+def test_is_job_bucket_id():
+    assert is_job_bucket_id(job_bucket_id("PU_1", "b"), "b")
+    assert is_job_bucket_id(job_bucket_id("PU_1", "a@b"), "a@b")
+    assert not is_job_bucket_id(job_bucket_id("PU_1", "a@b"), "b")
+    assert not is_job_bucket_id(job_bucket_id("PU_1", "b"), "a@b")
+    assert not is_job_bucket_id("PU_1", "PU_1")
+
+
+def test_set_job_quota_starts_with_full_sub_buckets():
+    repository = make_repository()
+    set_job_quota("a", 0.5, repository, capacity_fraction=0.2)
+
+    state = repository.get_buckets_state()
+    assert state[job_bucket_id("PU_1", "a")] == 20.0
+    assert state[job_bucket_id("RQ_1", "a")] == 2.0
+
+    # updating the quota doesn't refill the sub-buckets:
+    acquire_permit(5, repository, job_id="a")
+    set_job_quota("a", 0.5, repository, capacity_fraction=0.3)
+    assert repository.get_buckets_state()[job_bucket_id("PU_1", "a")] == 15.0
+
+
+def test_job_sub_bucket_delays_only_the_job():
+    repository = make_repository()
+    set_job_quota("a", 0.1, repository)
+
+    permit = acquire_permit(15, repository, job_id="a")
+    # the job's sub-bucket (capacity 10, refilled at a tenth of the rate) is 5 PU short:
+    assert abs(permit.delay - 5 * 10000000 / 0.1 / 1e9) < 1e-9
+    assert acquire_permit(1, repository, job_id="b").delay == 0.0
+
+
+def test_remove_job_quota_only_removes_its_own_sub_buckets():
+    repository = make_repository()
+    set_job_quota("b", 0.5, repository)
+    set_job_quota("a@b", 0.5, repository)
+
+    remove_job_quota("b", repository)
+
+    assert repository.get_job_quota("b") is None
+    assert repository.get_job_quota("a@b") is not None
+    state = repository.get_buckets_state()
+    assert job_bucket_id("PU_1", "b") not in state
+    assert job_bucket_id("PU_1", "a@b") in state
+    assert job_bucket_id("RQ_1", "a@b") in state
+    assert state["PU_1"] == 100.0
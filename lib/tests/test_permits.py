@@ -0,0 +1,86 @@
+"""
+Run from the `lib` directory: `python -m pytest tests`.
+"""
+import pytest
+
+from rlguard import SyncerDownException, acquire_permit, refund, release
+from rlguard.backends.memory import MemoryRepository
+
+RATE_LIMITS = [
+    {"id": "PU_1", "type": "PU", "initial": 10, "capacity": 10, "nanos_between_refills": 100000000},
+    {"id": "RQ_1", "type": "RQ", "initial": 5, "capacity": 5, "nanos_between_refills": 200000000},
+]
+
+
+def make_repository():
+    repository = MemoryRepository()
+    repository.init_rate_limits(RATE_LIMITS, 60000)
+    return repository
+
+
+def test_permit_charges_the_buckets_by_type():
+    repository = make_repository()
+    permit = acquire_permit(4, repository)
+
+    assert permit.delay == 0.0
+    assert permit.charges == {"PU_1": 4.0, "RQ_1": 1.0}
+    assert permit.types == {"PU_1": "PU", "RQ_1": "RQ"}
+    assert repository.get_buckets_state() == {"PU_1": 6.0, "RQ_1": 4.0}
+
+
+def test_delay_is_the_longest_wait():
+    repository = make_repository()
+    permit = acquire_permit(13, repository)
+    # the PU bucket is 3 units short, each of them takes 100 ms to refill:
+    assert permit.delay == pytest.approx(0.3)
+    assert permit.deadline == pytest.approx(permit.issued_at + 0.3)
+
+
+def test_syncer_down():
+    repository = make_repository()
+    repository.signal_syncer_alive(-1)
+    with pytest.raises(SyncerDownException):
+        acquire_permit(1, repository)
+
+
+def test_release_returns_everything_once():
+    repository = make_repository()
+    permit = acquire_permit(4, repository)
+
+    release(permit, repository)
+    release(permit, repository)
+
+    assert permit.released
+    assert repository.get_buckets_state() == {"PU_1": 10.0, "RQ_1": 5.0}
+
+
+def test_refund_corrects_only_the_pu_buckets():
+    repository = make_repository()
+    permit = acquire_permit(4, repository)
+
+    refund(permit, 1.5, repository)
+    assert repository.get_buckets_state() == {"PU_1": 8.5, "RQ_1": 4.0}
+    assert permit.charges["PU_1"] == 1.5
+
+    # requests which used more than estimated are charged the difference:
+    refund(permit, 3.0, repository)
+    assert repository.get_buckets_state() == {"PU_1": 7.0, "RQ_1": 4.0}
+
+    # released permits are not refunded anymore:
+    release(permit, repository)
+    refund(permit, 1.0, repository)
+    assert repository.get_buckets_state() == {"PU_1": 10.0, "RQ_1": 5.0}
+
+
+def test_returned_capacity_is_published():
+    repository = make_repository()
+    subscription = repository.subscribe_capacity()
+    try:
+        permit = acquire_permit(4, repository)
+        refund(permit, 1.0, repository)
+        assert subscription.get(1.0) == {"PU_1": 3.0}
+        # taking more from the buckets is not worth waking anybody up for:
+        refund(permit, 2.0, repository)
+        assert subscription.get(0.05) is None
+    finally:
+        subscription.close()
@@ -0,0 +1,76 @@
+"""
+Run from the `lib` directory: `python -m pytest tests`.
+"""
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from rlguard import OutputFormat, calculate_processing_units  # noqa: E402
+from rlguard.backends.memory import MemoryRepository  # noqa: E402
+from rlguard.planning import (  # noqa: E402
+    calculate_processing_units_array,
+    plan_job,
+    plan_tile_grid,
+    tile_grid,
+)
+
+RATE_LIMITS = [
+    {"id": "PU_1", "type": "PU", "initial": 10, "capacity": 10, "nanos_between_refills": 100000000},
+    {"id": "RQ_1", "type": "RQ", "initial": 5, "capacity": 5, "nanos_between_refills": 10000000},
+]
+
+
+def make_repository():
+    repository = MemoryRepository()
+    repository.init_rate_limits(RATE_LIMITS, 60000)
+    return repository
+
+
+def test_array_matches_the_scalar_formula():
+    widths = np.array([16, 512, 1024, 2500])
+    formats = [OutputFormat.OTHER, OutputFormat.IMAGE_TIFF_DEPTH_32, OutputFormat.APPLICATION_OCTET_STREAM, None]
+    pu = calculate_processing_units_array([False, True, False, True], widths, 300, 4, formats, n_data_samples=2)
+    expected = [
+        calculate_processing_units(batch, int(width), 300, 4, output_format, 2)
+        for batch, width, output_format in zip([False, True, False, True], widths, formats)
+    ]
+    assert pu == pytest.approx(expected)
+
+
+def test_tile_grid_covers_the_area():
+    widths, heights = tile_grid(1000, 600, 512, 512)
+    assert sorted(zip(widths.tolist(), heights.tolist())) == [(488, 88), (488, 512), (512, 88), (512, 512)]
+    assert int((widths * heights).sum()) == 1000 * 600
+
+
+def test_tile_grid_of_empty_area():
+    widths, heights = tile_grid(0, 600, 512, 512)
+    assert len(widths) == len(heights) == 0
+    plan = plan_tile_grid(1000, 0, 512, 512, 3, OutputFormat.OTHER, make_repository())
+    assert plan.n_requests == 0
+    assert plan.duration_s == 0.0
+
+
+def test_tile_grid_of_invalid_sizes():
+    with pytest.raises(ValueError):
+        tile_grid(-1, 600, 512, 512)
+    with pytest.raises(ValueError):
+        tile_grid(1000, 600, 0, 512)
+
+
+def test_plan_names_the_bottleneck():
+    repository = make_repository()
+    plan = plan_job([1.0] * 20, repository)
+
+    assert plan.n_requests == 20
+    assert plan.total_processing_units == 20.0
+    assert plan.policy_durations_s == pytest.approx({"PU_1": 1.0, "RQ_1": 0.15})
+    assert plan.bottleneck_policy_id == "PU_1"
+    assert plan.duration_s == pytest.approx(1.0)
+
+
+def test_plan_of_tile_grid():
+    repository = make_repository()
+    plan = plan_tile_grid(1024, 1024, 512, 512, 3, OutputFormat.OTHER, repository)
+    assert plan.n_requests == 4
+    assert plan.total_processing_units == pytest.approx(4.0)
@@ -0,0 +1,31 @@
+"""
+Run from the `lib` directory: `python -m pytest tests`.
+"""
+import pytest
+
+from rlguard.process_api import estimate_process_request_pu, request_signature
+
+DEFAULT_PU = estimate_process_request_pu(None)
+
+
+@pytest.mark.parametrize(
+    "body",
+    [
+        b'{"evalscript": null}',
+        b'{"input": "..."}',
+        b'{"input": {"data": [1]}}',
+        b'{"output": {"width": "wide", "height": 256}}',
+        b'{"output": {"responses": "tiff"}}',
+        b"[1, 2]",
+    ],
+)
+def test_unexpected_shape(body):
+    assert request_signature(body) is None
+    assert estimate_process_request_pu(body) == DEFAULT_PU
+
+
+def test_signature_ignores_irrelevant_properties():
+    body = b'{"evalscript": "return [B04]", "output": {"width": 512, "height": 512}}'
+    other = b'{"evalscript": "return [B04]", "output": {"width": 512, "height": 512}, "id": 7}'
+    assert request_signature(body) is not None
+    assert request_signature(body) == request_signature(other)
@@ -0,0 +1,91 @@
+"""
+Run from the `lib` directory: `python -m pytest tests`.
+"""
+import pytest
+
+from rlguard import (
+    RATE_MULTIPLIER_DECREASE_COOLDOWN_MS,
+    RATE_MULTIPLIER_DECREASE_FACTOR,
+    RATE_MULTIPLIER_INCREASE_STEP,
+    RATE_MULTIPLIER_MIN,
+    acquire_permit,
+    report_429,
+    report_success,
+)
+from rlguard.backends.memory import MemoryRepository
+
+RATE_LIMITS = [{"id": "RQ_1", "type": "RQ", "initial": 0, "capacity": 10, "nanos_between_refills": 100000000}]
+
+
+def make_repository():
+    repository = MemoryRepository()
+    repository.init_rate_limits(RATE_LIMITS, 60000)
+    return repository
+
+
+def expire_cooldown(repository):
+    # pretends the last decrease happened long enough ago:
+    repository.update_rate_multiplier(lambda value, decreased_at_ms: (value, 0.0))
+
+
+def test_burst_of_429s_decreases_once():
+    repository = make_repository()
+    assert report_429(repository) == pytest.approx(RATE_MULTIPLIER_DECREASE_FACTOR)
+    assert report_429(repository) == pytest.approx(RATE_MULTIPLIER_DECREASE_FACTOR)
+
+    expire_cooldown(repository)
+    assert report_429(repository) == pytest.approx(RATE_MULTIPLIER_DECREASE_FACTOR**2)
+
+
+def test_cooldown_is_measured_from_the_last_decrease():
+    repository = make_repository()
+    report_429(repository)
+    _, decreased_at_ms = _state(repository)
+    assert decreased_at_ms > 0.0
+    repository.update_rate_multiplier(
+        lambda value, _: (value, decreased_at_ms - RATE_MULTIPLIER_DECREASE_COOLDOWN_MS / 2.0)
+    )
+    assert report_429(repository) == pytest.approx(RATE_MULTIPLIER_DECREASE_FACTOR)
+
+
+def test_decrease_is_bounded():
+    repository = make_repository()
+    for _ in range(100):
+        expire_cooldown(repository)
+        report_429(repository)
+    assert repository.get_rate_multiplier() == RATE_MULTIPLIER_MIN
+
+
+def test_successes_increase_additively_up_to_1():
+    repository = make_repository()
+    report_429(repository)
+    assert report_success(repository) == pytest.approx(RATE_MULTIPLIER_DECREASE_FACTOR + RATE_MULTIPLIER_INCREASE_STEP)
+
+    for _ in range(int(1.0 / RATE_MULTIPLIER_INCREASE_STEP)):
+        report_success(repository)
+    assert repository.get_rate_multiplier() == 1.0
+
+
+def test_successes_keep_the_cooldown():
+    repository = make_repository()
+    report_429(repository)
+    report_success(repository)
+    assert report_429(repository) == pytest.approx(RATE_MULTIPLIER_DECREASE_FACTOR + RATE_MULTIPLIER_INCREASE_STEP)
+
+
+def test_lower_multiplier_makes_delays_longer():
+    repository = make_repository()
+    assert acquire_permit(1, repository).delay == pytest.approx(0.1)
+    report_429(repository)
+    assert acquire_permit(1, repository).delay == pytest.approx(0.2 / RATE_MULTIPLIER_DECREASE_FACTOR)
+
+
+def _state(repository):
+    state = {}
+
+    def read(value, decreased_at_ms):
+        state.update(value=value, decreased_at_ms=decreased_at_ms)
+        return None
+
+    repository.update_rate_multiplier(read)
+    return state["value"], state["decreased_at_ms"]
@@ -0,0 +1,76 @@
+"""
+Run from the `lib` directory: `python -m pytest tests`.
+"""
+import pytest
+
+from rlguard import acquire_permit, report_response, set_job_quota
+from rlguard.backends.memory import MemoryRepository
+
+RATE_LIMITS = [
+    {"id": "PU_1", "type": "PU", "initial": 10, "capacity": 10, "nanos_between_refills": 100000000},
+    {"id": "RQ_1", "type": "RQ", "initial": 5, "capacity": 5, "nanos_between_refills": 200000000},
+]
+
+
+class Response:
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+def make_repository():
+    repository = MemoryRepository()
+    repository.init_rate_limits(RATE_LIMITS, 60000)
+    return repository
+
+
+def test_spent_pus_are_reconciled():
+    repository = make_repository()
+    permit = acquire_permit(4, repository)
+
+    report_response(permit, Response(200, {"x-processingunits-spent": "2.5"}), repository)
+
+    assert repository.get_buckets_state() == {"PU_1": 7.5, "RQ_1": 4.0}
+    assert permit.processing_units == 2.5
+
+
+def test_responses_without_usable_header_are_not_reconciled():
+    repository = make_repository()
+    for headers in [{}, {"x-processingunits-spent": "many"}]:
+        report_response(acquire_permit(4, repository), Response(200, headers), repository)
+    assert repository.get_buckets_state() == {"PU_1": 2.0, "RQ_1": 3.0}
+
+
+def test_429_pushes_the_buckets_into_debt():
+    repository = make_repository()
+    permit = acquire_permit(4, repository)
+
+    report_response(permit, Response(429, {"retry-after": "500"}), repository)
+
+    # nobody may start a request in the next 500 ms, whichever bucket they are delayed by:
+    assert repository.get_buckets_state() == pytest.approx({"PU_1": -5.0, "RQ_1": -2.5})
+    assert permit.released
+    # the rate multiplier was lowered too, so the refills are slower:
+    assert repository.get_rate_multiplier() == pytest.approx(0.7)
+    assert acquire_permit(0.001, repository).delay == pytest.approx(3.5 * 0.2 / 0.7)
+
+
+def test_429_returns_the_charges_of_job_sub_buckets():
+    repository = make_repository()
+    set_job_quota("a", 0.5, repository)
+    permit = acquire_permit(4, repository, job_id="a")
+
+    report_response(permit, Response(429, {"retry-after": "500"}), repository)
+
+    state = repository.get_buckets_state()
+    assert state["PU_1@a"] == 5.0
+    assert state["RQ_1@a"] == 2.5
+
+
+def test_429_without_retry_after_only_returns_the_charges():
+    repository = make_repository()
+    permit = acquire_permit(4, repository)
+
+    report_response(permit, Response(429), repository)
+
+    assert repository.get_buckets_state() == {"PU_1": 0.0, "RQ_1": 0.0}
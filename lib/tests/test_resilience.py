@@ -0,0 +1,83 @@
+"""
+Run from the `lib` directory: `python -m pytest tests`.
+"""
+import time
+
+from rlguard import acquire_permit, apply_for_request
+from rlguard.backends.memory import MemoryRepository
+from rlguard.resilience import CircuitBreaker, ResilientRepository
+
+RATE_LIMITS = [{"id": "RQ_1", "type": "RQ", "initial": 10, "capacity": 10, "nanos_between_refills": 100000000}]
+
+
+def _fail(*arguments):
+    raise ConnectionError("store is down")
+
+
+class FlakyRepository(MemoryRepository):
+    """
+    Fails every call while `down` is set, the same as an unreachable store would.
+    """
+
+    down = False
+
+    def __getattribute__(self, name):
+        if not name.startswith("_") and name != "down" and object.__getattribute__(self, "down"):
+            return _fail
+        return object.__getattribute__(self, name)
+
+
+class PermitIssuingRepository(FlakyRepository):
+    """
+    Issues whole permits itself (from its own buckets), as the permit server does.
+    """
+
+    _issuing = False
+
+    def issue_permit(self, processing_units, job_id, lease_ttl_s):
+        if self._issuing:
+            return None
+        self._issuing = True
+        try:
+            return acquire_permit(processing_units, self, job_id=job_id, lease_ttl_s=lease_ttl_s)
+        finally:
+            self._issuing = False
+
+
+def make_repositories(inner):
+    inner.init_rate_limits(RATE_LIMITS, 60000)
+    resilient = ResilientRepository(
+        inner, call_timeout_s=0.5, failure_threshold=2, reset_timeout_s=0.2, fleet_share=1.0
+    )
+    return inner, resilient
+
+
+def test_local_permits_and_resync():
+    inner, resilient = make_repositories(FlakyRepository())
+    apply_for_request(1, resilient)
+    assert resilient.breaker.state == CircuitBreaker.CLOSED
+    assert inner.get_buckets_state()["RQ_1"] == 9.0
+
+    inner.down = True
+    for _ in range(3):
+        apply_for_request(1, resilient)
+    assert resilient.breaker.state == CircuitBreaker.OPEN
+
+    inner.down = False
+    time.sleep(0.25)
+    apply_for_request(1, resilient)
+    assert resilient.breaker.state == CircuitBreaker.CLOSED
+    # the 3 units used locally were charged to the store when it recovered:
+    assert inner.get_buckets_state()["RQ_1"] == 5.0
+
+
+def test_local_permits_of_permit_issuing_store():
+    # `acquire_permit` never reads the policies through the wrapper, so they must have been seeded explicitly:
+    inner, resilient = make_repositories(PermitIssuingRepository())
+    apply_for_request(1, resilient)
+    assert inner.get_buckets_state()["RQ_1"] == 9.0
+
+    inner.down = True
+    for _ in range(3):
+        assert apply_for_request(1, resilient) >= 0.0
+    assert resilient.breaker.state == CircuitBreaker.OPEN
@@ -0,0 +1,74 @@
+"""
+Run from the `lib` directory: `python -m pytest tests`.
+"""
+import asyncio
+
+import pytest
+
+from rlguard import acquire_permit, take_lease
+from rlguard.backends.memory import MemoryRepository
+from rlguard.process_api import async_send_with_permits, send_with_permits
+
+RATE_LIMITS = [{"id": "PU_1", "type": "PU", "initial": 10, "capacity": 10, "nanos_between_refills": 100000000}]
+
+
+class Response:
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+def make_repository():
+    repository = MemoryRepository()
+    repository.init_rate_limits(RATE_LIMITS, 60000)
+    repository.init_semaphores({"CC_1": 1})
+    return repository
+
+
+def assert_nothing_leaked(repository):
+    assert repository.get_buckets_state() == {"PU_1": 10.0}
+    # the only slot is free again:
+    permit = acquire_permit(1, repository)
+    assert repository.acquire_lease(permit.semaphore_limits, "other", 1000) is None
+
+
+def fail():
+    raise ConnectionError("connection reset")
+
+
+def test_failed_send_releases_the_permit():
+    repository = make_repository()
+    with pytest.raises(ConnectionError):
+        send_with_permits(fail, lambda response: None, 4.0, repository)
+    assert_nothing_leaked(repository)
+
+
+def test_failed_async_send_releases_the_permit():
+    repository = make_repository()
+
+    async def send():
+        fail()
+
+    async def close(response):
+        pass
+
+    with pytest.raises(ConnectionError):
+        asyncio.run(async_send_with_permits(send, close, 4.0, repository))
+    assert_nothing_leaked(repository)
+
+
+def test_429_is_retried():
+    repository = make_repository()
+    responses = [Response(429, {"retry-after": "0"}), Response(200, {"x-processingunits-spent": "1"})]
+    closed = []
+
+    response = send_with_permits(lambda: responses.pop(0), closed.append, 4.0, repository)
+
+    assert response.status_code == 200
+    assert [r.status_code for r in closed] == [429]
+    # the 429 has emptied the bucket (the other workers are not allowed to retry earlier either):
+    assert repository.get_buckets_state() == {"PU_1": -1.0}
+    # the leases were released after each response:
+    permit = acquire_permit(1, repository)
+    take_lease(permit, repository)
+    assert permit.lease_id is not None
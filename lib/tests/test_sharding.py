@@ -0,0 +1,73 @@
+"""
+Run from the `lib` directory: `python -m pytest tests`.
+"""
+import pytest
+
+from rlguard import acquire_permit, job_bucket_id, set_job_quota
+from rlguard.backends.memory import MemoryRepository
+from rlguard.sharding import ShardedRepository
+
+RATE_LIMITS = [{"id": "PU_1", "type": "PU", "initial": 40, "capacity": 40, "nanos_between_refills": 100000000}]
+
+
+def make_repository(home_shard=0, n_shards=4):
+    repository = ShardedRepository([MemoryRepository() for _ in range(n_shards)], home_shard=home_shard)
+    repository.init_rate_limits(RATE_LIMITS, 60000)
+    return repository
+
+
+def shard_values(repository, counter_id="PU_1"):
+    return [shard.get_buckets_state().get(counter_id) for shard in repository.shards]
+
+
+def test_shards_hold_their_share():
+    repository = make_repository()
+    assert shard_values(repository) == [10.0] * 4
+    assert repository.get_buckets_state() == {"PU_1": 40.0}
+    assert repository.get_policy_capacities() == {"PU_1": 40.0}
+    assert repository.get_policy_refills() == {"PU_1": pytest.approx(100000000)}
+
+
+def test_permits_are_taken_from_the_home_shard():
+    repository = make_repository(home_shard=2)
+    permit = acquire_permit(4, repository)
+    assert permit.delay == 0.0
+    assert shard_values(repository) == [10.0, 10.0, 6.0, 10.0]
+
+
+def test_permit_is_taken_from_a_sibling_when_the_home_shard_runs_dry():
+    repository = make_repository(home_shard=0)
+    acquire_permit(8, repository)
+    permit = acquire_permit(8, repository)
+
+    assert permit.delay == 0.0
+    assert shard_values(repository) == [2.0, 2.0, 10.0, 10.0]
+
+
+def test_empty_shards_are_not_stolen_from():
+    repository = make_repository(home_shard=0)
+    for shard in repository.shards:
+        shard.increment_counter("PU_1", -10.0)
+    permit = acquire_permit(1, repository)
+    assert permit.delay > 0.0
+    assert shard_values(repository) == [-1.0, 0.0, 0.0, 0.0]
+
+
+def test_syncer_fills_all_shards():
+    repository = make_repository()
+    acquire_permit(8, repository)
+    assert repository.increment_counter("PU_1", 4.0) == 36.0
+    assert shard_values(repository) == [3.0, 11.0, 11.0, 11.0]
+
+
+def test_rebalance_levels_the_shards():
+    repository = make_repository(home_shard=1)
+    set_job_quota("a", 0.5, repository)
+    acquire_permit(8, repository, job_id="a")
+
+    totals = repository.rebalance()
+
+    assert totals == {"PU_1": 32.0, job_bucket_id("PU_1", "a"): 12.0}
+    assert shard_values(repository) == [8.0] * 4
+    # the job's sub-bucket was only filled and drawn from in the home shard:
+    assert shard_values(repository, job_bucket_id("PU_1", "a")) == [3.0] * 4
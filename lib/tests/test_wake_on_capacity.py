@@ -0,0 +1,74 @@
+"""
+Run from the `lib` directory: `python -m pytest tests`.
+"""
+import threading
+import time
+
+import pytest
+
+from rlguard import acquire_permit, release, wait_for_capacity
+from rlguard.backends.memory import MemoryRepository
+from rlguard.permit import Permit
+
+# a unit of PU takes a second to refill:
+RATE_LIMITS = [{"id": "PU_1", "type": "PU", "initial": 0, "capacity": 10, "nanos_between_refills": 1000000000}]
+
+
+def make_repository():
+    repository = MemoryRepository()
+    repository.init_rate_limits(RATE_LIMITS, 60000)
+    return repository
+
+
+def test_credits_move_the_deadline_forward():
+    now = time.monotonic()
+    permit = Permit(
+        delay=4.0,
+        processing_units=1.0,
+        deadline=now + 4.0,
+        issued_at=now,
+        waits_ns={"PU_1": 4e9, "RQ_1": 1e9},
+        refills_ns={"PU_1": 1e9, "RQ_1": 1e8},
+    )
+    permit.apply_credits({"PU_1": 2.0, "PU_2": 10.0})
+    assert permit.deadline == pytest.approx(now + 2.0)
+
+    # the other bucket still has to be waited for:
+    permit.apply_credits({"PU_1": 10.0})
+    assert permit.deadline == pytest.approx(now + 1.0)
+
+    # the deadline is never moved back:
+    permit.apply_credits({"PU_1": -10.0})
+    assert permit.deadline == pytest.approx(now + 1.0)
+
+
+def test_waiting_worker_wakes_up_when_capacity_is_released():
+    repository = make_repository()
+    first = acquire_permit(3, repository)
+    second = acquire_permit(0.5, repository)
+    assert second.delay == pytest.approx(3.5)
+
+    waited = {}
+
+    def wait():
+        started_at = time.monotonic()
+        wait_for_capacity(second, repository)
+        waited["s"] = time.monotonic() - started_at
+
+    thread = threading.Thread(target=wait)
+    thread.start()
+    # the first worker didn't perform its request after all:
+    time.sleep(0.1)
+    release(first, repository)
+    thread.join(5.0)
+
+    assert waited["s"] == pytest.approx(0.5, abs=0.2)
+
+
+def test_short_delays_are_slept_through():
+    repository = make_repository()
+    repository.increment_counter("PU_1", 0.9)
+    permit = acquire_permit(1, repository)
+    assert permit.delay == pytest.approx(0.1)
+    assert wait_for_capacity(permit, repository) < 0.05
+    assert time.monotonic() >= permit.deadline
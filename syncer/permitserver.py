@@ -0,0 +1,339 @@
+"""
+Permit server - an alternative to keeping the buckets in Redis (or ZooKeeper) and syncing them from a separate
+process. The buckets are kept in memory, synced with Sentinel Hub by the same functions syncer uses, and permits
+are issued to the workers over HTTP (see `rlguard.backends.permitserver` for the client):
+
+    CLIENT_ID=... CLIENT_SECRET=... PERMIT_SERVER_PORT=8001 python permitserver.py
+
+The server listens on `PERMIT_SERVER_HOST` (127.0.0.1 by default). If `PERMIT_SERVER_TOKEN` is set, the clients
+must send it as `Authorization: Bearer <token>`; serving on any other interface than loopback requires it.
+
+Each permit costs a single round trip. The server holds the buckets of a single endpoint (the first of
+`SENTINELHUB_ROOT_URLS`); the other settings of syncing are read from the same env vars as in syncer.
+
+Routes (JSON bodies, HTTP/1.1 keep-alive):
+
+    POST /acquire               {"processing_units", "job_id", "lease_ttl_s"} -> permit
+    POST /acquire_batch         {"processing_units": [...], "job_id", "lease_ttl_s"} -> {"permits": [...]}
+    POST /refund                {"credits": {counter id: units}}
+    POST /call/<method>         {"args": [...]} -> {"result": ...} (other methods of `Repository`)
+    GET  /rate_multiplier       -> {"value", "decreased_at_ms"}
+    POST /rate_multiplier       {"expected": [value, decreased_at_ms], "new": [value, decreased_at_ms]}
+    POST /subscriptions         -> {"id"}
+    POST /subscriptions/<id>    {"timeout_s"} -> {"credits"} (long polling)
+    DELETE /subscriptions/<id>
+    GET  /backlog               -> backlog of the policies (see `rlguard.get_backlog`)
+
+If `SNAPSHOT_PATH` is set, the state is saved to it every `SNAPSHOT_INTERVAL_SEC` and restored on start. The
+buckets themselves are reset to what Sentinel Hub reports as soon as syncing starts, but job quotas, leases and
+the rate multiplier survive the restart.
+"""
+import asyncio
+import dataclasses
+import hmac
+import ipaddress
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from rlguard import SyncerDownException, acquire_permit, acquire_permits, get_backlog
+from rlguard.backends.memory import MemoryRepository
+
+from syncer import CLIENT_ID, CLIENT_SECRET, SENTINELHUB_ROOT_URLS, sync_endpoint, sync_settings_from_env
+
+# methods of the repository which the clients can call through `/call/<method>` (updating the rate multiplier
+# and subscriptions need more than one call, so they have their own routes); the methods which only the syncer
+# uses (setting up the policies, the access token of Sentinel Hub...) are not exposed, the server syncs itself:
+CALLABLE_METHODS = {
+    "increment_counter",
+    "increment_counters",
+    "increment_counters_timed",
+    "acquire_lease",
+    "renew_lease",
+    "release_lease",
+    "get_semaphore_limits",
+    "get_counters",
+    "get_policy_types",
+    "get_policy_refills",
+    "get_policy_capacities",
+    "get_buckets_state",
+    "get_job_quota",
+    "get_job_quotas",
+    "save_job_quota",
+    "delete_job_quota",
+    "get_learned_cost",
+    "save_learned_cost",
+    "purge_learned_costs",
+    "get_rate_multiplier",
+    "publish_capacity",
+    "get_backlog_state",
+    "is_syncer_alive",
+}
+
+# subscriptions which were not polled for this long are assumed to be abandoned by their workers:
+SUBSCRIPTION_IDLE_S = 60.0
+# requests which wait (on the lock of the repository, or in a long poll) occupy a thread each:
+MAX_WORKERS = 256
+MAX_BODY_BYTES = 1024 * 1024
+
+
+class HttpError(Exception):
+    def __init__(self, status, error, message=""):
+        super().__init__(message)
+        self.status = status
+        self.error = error
+
+
+REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    401: "Unauthorized",
+    404: "Not Found",
+    413: "Payload Too Large",
+    500: "Internal Server Error",
+    503: "Service Unavailable",
+}
+
+
+def permit_to_json(permit):
+    # `deadline` and `issued_at` are on the monotonic clock of the server, so the client needs to know how long
+    # ago the permit was issued to translate them to its own clock:
+    return {**dataclasses.asdict(permit), "age_s": time.monotonic() - permit.issued_at}
+
+
+class PermitServer:
+    def __init__(self, repository: MemoryRepository, token: Optional[str] = None):
+        self.repository = repository
+        self.token = token
+        self._subscriptions = {}
+        self._subscriptions_lock = threading.Lock()
+
+    def handle(self, method, path, body):
+        """
+        Returns the (JSON-serializable) reply to the request, or raises `HttpError`.
+        """
+        parts = path.strip("/").split("/")
+        if method == "POST" and parts == ["acquire"]:
+            permit = acquire_permit(
+                body["processing_units"], self.repository, job_id=body.get("job_id"), lease_ttl_s=body["lease_ttl_s"]
+            )
+            return permit_to_json(permit)
+        if method == "POST" and parts == ["acquire_batch"]:
+            permits = acquire_permits(
+                body["processing_units"], self.repository, job_id=body.get("job_id"), lease_ttl_s=body["lease_ttl_s"]
+            )
+            return {"permits": [permit_to_json(permit) for permit in permits]}
+        if method == "POST" and parts == ["refund"]:
+            self.repository.return_capacity(body["credits"])
+            return {}
+        if method == "POST" and len(parts) == 2 and parts[0] == "call":
+            if parts[1] not in CALLABLE_METHODS:
+                raise HttpError(404, "unknown_method", f"Unknown method {parts[1]}")
+            return {"result": getattr(self.repository, parts[1])(*body.get("args", []))}
+        if parts == ["rate_multiplier"]:
+            if method == "GET":
+                return self._rate_multiplier_state()
+            if method == "POST":
+                return self._compare_and_set_rate_multiplier(body["expected"], body["new"])
+        if parts[0] == "subscriptions":
+            if method == "POST" and len(parts) == 1:
+                return {"id": self._subscribe()}
+            if method == "POST" and len(parts) == 2:
+                return {"credits": self._poll(parts[1], body.get("timeout_s", 0.0))}
+            if method == "DELETE" and len(parts) == 2:
+                self._unsubscribe(parts[1])
+                return {}
+        if method == "GET" and parts == ["backlog"]:
+            return {policy_id: dataclasses.asdict(b) for policy_id, b in get_backlog(self.repository).items()}
+        raise HttpError(404, "not_found", f"No route for {method} {path}")
+
+    def _rate_multiplier_state(self):
+        state = {}
+
+        def read(value, decreased_at_ms):
+            state.update(value=value, decreased_at_ms=decreased_at_ms)
+            return None
+
+        self.repository.update_rate_multiplier(read)
+        return state
+
+    def _compare_and_set_rate_multiplier(self, expected, new):
+        # the client computes the new value from what it has read, so it is only stored if nobody changed it since:
+        updated = []
+
+        def compare_and_set(value, decreased_at_ms):
+            if [value, decreased_at_ms] != list(expected):
+                return None
+            updated.append(True)
+            return tuple(new)
+
+        value = self.repository.update_rate_multiplier(compare_and_set)
+        return {"value": value, "updated": bool(updated)}
+
+    def _subscribe(self):
+        subscription_id = uuid.uuid4().hex
+        with self._subscriptions_lock:
+            self._subscriptions[subscription_id] = [self.repository.subscribe_capacity(), time.monotonic()]
+        return subscription_id
+
+    def _poll(self, subscription_id, timeout_s):
+        with self._subscriptions_lock:
+            entry = self._subscriptions.get(subscription_id)
+            if entry is None:
+                raise HttpError(404, "unknown_subscription", f"Unknown subscription {subscription_id}")
+            entry[1] = time.monotonic()
+        credits = entry[0].get(timeout_s)
+        entry[1] = time.monotonic()
+        return credits
+
+    def _unsubscribe(self, subscription_id):
+        with self._subscriptions_lock:
+            entry = self._subscriptions.pop(subscription_id, None)
+        if entry is not None:
+            entry[0].close()
+
+    def close_idle_subscriptions(self):
+        now = time.monotonic()
+        with self._subscriptions_lock:
+            idle = [sid for sid, (_, used_at) in self._subscriptions.items() if now - used_at > SUBSCRIPTION_IDLE_S]
+        for subscription_id in idle:
+            logging.info(f"Closing idle subscription {subscription_id}")
+            self._unsubscribe(subscription_id)
+
+    async def serve_connection(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    return
+                method, path, version = request_line.decode("latin-1").split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                status, reply = 200, None
+                content_length = int(headers.get("content-length", 0))
+                if content_length > MAX_BODY_BYTES:
+                    status, reply = 413, {"error": "too_large"}
+                elif not self.is_authorized(headers):
+                    # the body is skipped, so that the connection can still be used:
+                    if content_length:
+                        await reader.readexactly(content_length)
+                    status, reply = 401, {"error": "unauthorized", "message": "Missing or wrong token"}
+                else:
+                    raw_body = await reader.readexactly(content_length) if content_length else b""
+                    try:
+                        body = json.loads(raw_body) if raw_body else {}
+                        # handlers can block (on the lock of the repository, long polling):
+                        reply = await loop.run_in_executor(None, self.handle, method, path, body)
+                    except HttpError as ex:
+                        status, reply = ex.status, {"error": ex.error, "message": str(ex)}
+                    except SyncerDownException as ex:
+                        status, reply = 503, {"error": "syncer_down", "message": str(ex)}
+                    except (ValueError, KeyError, TypeError) as ex:
+                        status, reply = 400, {"error": "bad_request", "message": str(ex)}
+                    except Exception as ex:
+                        logging.exception(f"Failed to handle {method} {path}")
+                        status, reply = 500, {"error": "internal_error", "message": str(ex)}
+
+                keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                payload = json.dumps(reply).encode()
+                writer.write(
+                    (
+                        f"HTTP/1.1 {status} {REASONS[status]}\r\n"
+                        f"Content-Type: application/json\r\n"
+                        f"Content-Length: {len(payload)}\r\n"
+                        f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+                    ).encode("latin-1")
+                    + payload
+                )
+                await writer.drain()
+                if not keep_alive or status == 413:
+                    return
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError) as ex:
+            logging.debug(f"Closing connection: {ex}")
+        finally:
+            writer.close()
+
+    def is_authorized(self, headers):
+        if self.token is None:
+            return True
+        scheme, _, token = headers.get("authorization", "").partition(" ")
+        return scheme.lower() == "bearer" and hmac.compare_digest(token.strip().encode(), self.token.encode())
+
+    async def serve(self, host, port):
+        loop = asyncio.get_running_loop()
+        loop.set_default_executor(ThreadPoolExecutor(max_workers=MAX_WORKERS))
+        server = await asyncio.start_server(self.serve_connection, host, port)
+        logging.info(f"Serving permits on {host}:{port}.")
+        async with server:
+            while True:
+                await asyncio.sleep(SUBSCRIPTION_IDLE_S)
+                self.close_idle_subscriptions()
+
+
+def is_loopback(host):
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def save_snapshots(repository: MemoryRepository, path, interval_s):
+    while True:
+        time.sleep(interval_s)
+        try:
+            # written to a temporary file first, so that a crash doesn't leave a half-written snapshot behind:
+            with open(f"{path}.tmp", "w") as fh:
+                json.dump(repository.snapshot(), fh)
+            os.replace(f"{path}.tmp", path)
+        except Exception:
+            logging.warning(f"Could not save snapshot to {path}", exc_info=True)
+
+
+def main(argv):
+    if not CLIENT_ID or not CLIENT_SECRET:
+        raise Exception("Please supply CLIENT_ID and CLIENT_SECRET env vars!")
+
+    PERMIT_SERVER_HOST = os.environ.get("PERMIT_SERVER_HOST") or "127.0.0.1"
+    PERMIT_SERVER_PORT = int(os.environ.get("PERMIT_SERVER_PORT") or 8001)
+    PERMIT_SERVER_TOKEN = os.environ.get("PERMIT_SERVER_TOKEN") or None
+    SNAPSHOT_PATH = os.environ.get("SNAPSHOT_PATH")
+    SNAPSHOT_INTERVAL_SEC = float(os.environ.get("SNAPSHOT_INTERVAL_SEC") or 10)
+    if not PERMIT_SERVER_TOKEN and not is_loopback(PERMIT_SERVER_HOST):
+        raise Exception(f"Please supply PERMIT_SERVER_TOKEN env var to serve permits on {PERMIT_SERVER_HOST}!")
+    root_url = SENTINELHUB_ROOT_URLS[0]
+    if len(SENTINELHUB_ROOT_URLS) > 1:
+        logging.warning(f"Permit server only serves a single endpoint, using {root_url}.")
+
+    repository = MemoryRepository()
+    if SNAPSHOT_PATH and os.path.exists(SNAPSHOT_PATH):
+        with open(SNAPSHOT_PATH) as fh:
+            repository.restore(json.load(fh))
+        logging.info(f"Restored snapshot from {SNAPSHOT_PATH}.")
+    if SNAPSHOT_PATH:
+        threading.Thread(
+            target=save_snapshots, args=(repository, SNAPSHOT_PATH, SNAPSHOT_INTERVAL_SEC), daemon=True
+        ).start()
+
+    threading.Thread(
+        target=sync_endpoint, args=(root_url, repository), kwargs=sync_settings_from_env(), daemon=True
+    ).start()
+    asyncio.run(PermitServer(repository, PERMIT_SERVER_TOKEN).serve(PERMIT_SERVER_HOST, PERMIT_SERVER_PORT))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
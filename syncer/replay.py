@@ -0,0 +1,228 @@
+"""
+Replays recorded traces (see `rlguard.tracing`) with alternative settings of syncer, to test its tuning offline:
+
+    python replay.py [--min-fill-interval-ms MS] [--refresh-buckets-sec S] [--pacing-min-window-sec S ...]
+        [--shaping-max-burst-sec S] TRACE...
+
+The traces of the workers and of syncer are merged. Requests (`permit` events) are replayed at the times they were
+recorded, and their delays are calculated by `rlguard.acquire_permit` against buckets in a `MemoryRepository`. The
+buckets are filled, refreshed and paced by the same functions syncer uses, but on a simulated clock. Sentinel Hub is
+modelled as continuously refilled buckets with the recorded policies; a request which would exceed any of them when
+it is performed (after its delay) is counted as a 429.
+
+Requests arrive at the recorded times regardless of the delays they get (open loop), and the rate multiplier and job
+quotas are not replayed, so the results are an approximation - but they are good enough to compare the settings.
+"""
+import argparse
+import heapq
+import itertools
+import json
+import logging
+import sys
+
+from rlguard import PolicyType, acquire_permit
+from rlguard.backends.memory import MemoryRepository
+from rlguard.tracing import read_trace
+
+from syncer import (
+    MIN_FILL_INTERVAL_NS,
+    add_pacing_policies,
+    add_shaping_policies,
+    adjust_filling,
+    pending_units,
+    refresh_interval,
+    repository_fill_bucket,
+    update_pacing_policy,
+)
+
+# the simulated syncer never dies:
+ALIVE_MS = 365 * 24 * 3600 * 1000
+
+
+class SentinelHubModel:
+    """
+    The buckets as Sentinel Hub sees them - refilled continuously at the policies' rates.
+    """
+
+    def __init__(self, rate_limits, start_t):
+        self._policies = {policy["id"]: policy for policy in rate_limits}
+        self._levels = {policy["id"]: float(policy["initial"]) for policy in rate_limits}
+        self._t = start_t
+
+    def _refill(self, t):
+        for policy_id, policy in self._policies.items():
+            refilled = self._levels[policy_id] + (t - self._t) * 1000000000.0 / policy["nanos_between_refills"]
+            self._levels[policy_id] = min(refilled, float(policy["capacity"]))
+        self._t = max(self._t, t)
+
+    def levels(self, t):
+        self._refill(t)
+        return dict(self._levels)
+
+    def perform(self, t, processing_units) -> bool:
+        """
+        Returns False (429) if any of the policies doesn't allow the request.
+        """
+        self._refill(t)
+        charges = {
+            policy_id: float(processing_units) if policy["type"] == PolicyType.PROCESSING_UNITS.value else 1.0
+            for policy_id, policy in self._policies.items()
+        }
+        if any(self._levels[policy_id] < charge for policy_id, charge in charges.items()):
+            return False
+        for policy_id, charge in charges.items():
+            self._levels[policy_id] -= charge
+        return True
+
+
+def summarize(delays, n_429):
+    delays = sorted(delays)
+    if not delays:
+        return {"requests": 0, "429s": n_429}
+    return {
+        "requests": len(delays),
+        "429s": n_429,
+        "mean_delay_s": sum(delays) / len(delays),
+        "p50_delay_s": delays[len(delays) // 2],
+        "p95_delay_s": delays[min(int(len(delays) * 0.95), len(delays) - 1)],
+        "max_delay_s": delays[-1],
+    }
+
+
+def replay(events, min_fill_interval_ns=MIN_FILL_INTERVAL_NS, refresh_buckets_sec=None, pacing=None, shaping=None):
+    """
+    Replays the events (ordered by time) and returns the summaries of the recorded and of the replayed decisions.
+    """
+    recorded_rate_limits = next((event for event in events if event["event"] == "rate_limits"), None)
+    if recorded_rate_limits is None:
+        raise ValueError("The trace has no rate limits - the trace of syncer is needed too.")
+    permits = [event for event in events if event["event"] == "permit"]
+    if not permits:
+        raise ValueError("The trace has no permits - the traces of the workers are needed too.")
+
+    # virtual policies are added again (according to the settings), the real ones are filled as the settings say:
+    rate_limits = []
+    for policy in recorded_rate_limits["rate_limits"]:
+        if policy.get("virtual"):
+            continue
+        fill_interval_s, fill_quantity = adjust_filling(policy["nanos_between_refills"], min_fill_interval_ns)
+        rate_limits.append({**policy, "fill_interval_s": fill_interval_s, "fill_quantity": fill_quantity})
+    real_policies = list(rate_limits)
+    if pacing is not None:
+        rate_limits = add_pacing_policies(rate_limits, *pacing)
+    if shaping is not None:
+        rate_limits = add_shaping_policies(rate_limits, *shaping)
+
+    start_t = permits[0]["t"]
+    repository = MemoryRepository()
+    repository.init_rate_limits(rate_limits, ALIVE_MS)
+    sentinel_hub = SentinelHubModel(real_policies, start_t)
+
+    # the same priorities as in syncer's scheduler, with the requests going last:
+    PRIORITY_FILL, PRIORITY_REFRESH, PRIORITY_PACING, PRIORITY_REQUEST = 1, 2, 4, 6
+    queue = []
+    sequence = itertools.count()
+
+    def schedule(t, priority, action, *arguments):
+        heapq.heappush(queue, (t, priority, next(sequence), action, arguments))
+
+    # policy id -> [correction per fill, fills left], the same as in syncer:
+    corrections = {}
+
+    def fill_bucket(t, policy):
+        correction = 0.0
+        if policy["id"] in corrections:
+            correction, fills_left = corrections[policy["id"]]
+            if fills_left <= 1:
+                del corrections[policy["id"]]
+            else:
+                corrections[policy["id"]][1] = fills_left - 1
+        quantity = policy["fill_quantity"] + correction
+        repository_fill_bucket(policy["id"], quantity, policy["capacity"], ALIVE_MS, repository)
+        schedule(t + policy["fill_interval_s"], PRIORITY_FILL, fill_bucket, policy)
+
+    def refresh_buckets(t, interval_s):
+        # requests are performed as soon as their delay has passed, so only the waiting ones are pending:
+        actual_values = sentinel_hub.levels(t)
+        bucket_values = repository.get_buckets_state()
+        drifts = {}
+        for policy in real_policies:
+            bucket_value = bucket_values[policy["id"]]
+            drifts[policy["id"]] = actual_values[policy["id"]] - pending_units(bucket_value, 0.0) - bucket_value
+        relative_drift = max(abs(drifts[policy["id"]]) / float(policy["capacity"]) for policy in real_policies)
+        next_interval_s = refresh_interval(interval_s, refresh_buckets_sec, relative_drift, idle=False)
+        for policy in real_policies:
+            n_fills = max(int(next_interval_s / policy["fill_interval_s"]), 1)
+            corrections[policy["id"]] = [drifts[policy["id"]] / n_fills, n_fills]
+        schedule(t + next_interval_s, PRIORITY_REFRESH, refresh_buckets, next_interval_s)
+
+    def update_pacing(t, pacing_policy):
+        update_pacing_policy(pacing_policy, repository)
+        schedule(t + pacing_policy["update_interval_s"], PRIORITY_PACING, update_pacing, pacing_policy)
+
+    delays = []
+    n_429 = [0]
+
+    def request(t, processing_units):
+        permit = acquire_permit(processing_units, repository)
+        delays.append(permit.delay)
+        schedule(t + permit.delay, PRIORITY_REQUEST, perform, processing_units)
+
+    def perform(t, processing_units):
+        if not sentinel_hub.perform(t, processing_units):
+            n_429[0] += 1
+
+    for policy in rate_limits:
+        schedule(start_t + policy["fill_interval_s"], PRIORITY_FILL, fill_bucket, policy)
+        if "paces" in policy:
+            schedule(start_t + policy["update_interval_s"], PRIORITY_PACING, update_pacing, policy)
+    if refresh_buckets_sec is not None:
+        schedule(start_t + refresh_buckets_sec, PRIORITY_REFRESH, refresh_buckets, refresh_buckets_sec)
+    for permit in permits:
+        schedule(permit["t"], PRIORITY_REQUEST, request, permit["processing_units"])
+
+    # fills would go on forever - we stop once all of the requests are performed:
+    n_requests = len(permits)
+    n_performed = 0
+    while queue and n_performed < n_requests:
+        t, _, _, action, arguments = heapq.heappop(queue)
+        action(t, *arguments)
+        if action is perform:
+            n_performed += 1
+
+    recorded_429 = sum(1 for event in events if event["event"] == "response" and event["status_code"] == 429)
+    return {
+        "recorded": summarize([event["delay"] for event in permits], recorded_429),
+        "replayed": summarize(delays, n_429[0]),
+    }
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Replays recorded traces with alternative settings of syncer.")
+    parser.add_argument("traces", nargs="+", help="trace files of the workers and of syncer")
+    parser.add_argument("--min-fill-interval-ms", type=float, default=MIN_FILL_INTERVAL_NS / 1000000.0)
+    parser.add_argument("--refresh-buckets-sec", type=float, default=None)
+    parser.add_argument("--pacing-min-window-sec", type=float, default=None)
+    parser.add_argument("--pacing-horizon-sec", type=float, default=None)
+    parser.add_argument("--pacing-burst-sec", type=float, default=600)
+    parser.add_argument("--pacing-update-sec", type=float, default=60)
+    parser.add_argument("--shaping-max-burst-sec", type=float, default=None)
+    args = parser.parse_args(argv[1:])
+
+    if args.pacing_min_window_sec is not None:
+        pacing = (args.pacing_min_window_sec, args.pacing_horizon_sec, args.pacing_burst_sec, args.pacing_update_sec)
+    else:
+        pacing = None
+    results = replay(
+        read_trace(args.traces),
+        min_fill_interval_ns=args.min_fill_interval_ms * 1000000.0,
+        refresh_buckets_sec=args.refresh_buckets_sec,
+        pacing=pacing,
+        shaping=(args.shaping_max_burst_sec, {}) if args.shaping_max_burst_sec is not None else None,
+    )
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    logging.getLogger().setLevel(logging.WARNING)
+    main(sys.argv)
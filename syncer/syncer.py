@@ -1,18 +1,27 @@
 import redis
+import dataclasses
+import json
 import logging
 import math
 import os
 import sched
 import sys
+import threading
 import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
 
 import jwt
 import requests
 
 import kazoo.client
 from kazoo.client import KazooClient
-from rlguard import PolicyType
-from rlguard.repository import Repository, RedisRepository, ZooKeeperRepository
+from rlguard import PolicyType, get_backlog, job_bucket_id
+from rlguard.tracing import get_trace_recorder
+from rlguard.backends.redis import RedisRepository
+from rlguard.backends.zookeeper import ZooKeeperRepository
+from rlguard.repository import Repository
+from rlguard.sharding import ShardedRepository, redis_shards
 
 
 POLICY_TYPES_SHORT_NAMES = {
@@ -26,26 +35,57 @@ POLICY_TYPES_FULL_NAMES = {
 
 min_revisit_time_ms = None
 
+# permit rates are measured from the consumption of the buckets in this interval, and smoothed
+# (exponentially) over the window:
+PERMIT_RATE_INTERVAL_S = 1.0
+PERMIT_RATE_WINDOW_S = 10.0
+
+# expired learned costs (see `rlguard.costs`) are removed from the repository this often:
+LEARNED_COSTS_PURGE_S = 3600.0
+
+# only the policies with at most this long window are shaped by default - bursts of a few seconds worth of e.g.
+# the monthly quota would throttle the account to its monthly average (long windows can be paced instead):
+SHAPING_MAX_WINDOW_S = 3600.0
+
+# buckets are filled at most this often (100 ms sounds manageable):
+MIN_FILL_INTERVAL_NS = 100 * 1000 * 1000
+
+# the interval of refreshing the buckets adapts to the drift that was found (relative to the capacity of the
+# policy), within these factors of REFRESH_BUCKETS_SEC:
+REFRESH_INTERVAL_MIN_FACTOR = 0.25
+REFRESH_INTERVAL_MAX_FACTOR = 4.0
+REFRESH_DRIFT_HIGH = 0.05
+REFRESH_DRIFT_LOW = 0.01
+# Sentinel Hub doesn't know about the permitted requests until they are performed - this is how long (in s) they
+# are assumed to be in flight:
+REQUEST_LATENCY_SEC = float(os.environ.get("REQUEST_LATENCY_SEC") or 1.0)
+
 SENTINELHUB_ROOT_URL = os.environ.get("SENTINELHUB_ROOT_URL", "https://services.sentinel-hub.com")
+# data can be spread across several Sentinel Hub deployments, each with its own limits - we manage a separate
+# set of buckets for each of them:
+SENTINELHUB_ROOT_URLS = os.environ.get("SENTINELHUB_ROOT_URLS") or SENTINELHUB_ROOT_URL
+SENTINELHUB_ROOT_URLS = [url.strip().rstrip("/") for url in SENTINELHUB_ROOT_URLS.split(",") if url.strip()]
+
+# syncing of an endpoint which has failed is restarted after this long (doubled with each failure in a row):
+SYNC_RETRY_S = 5.0
+SYNC_RETRY_MAX_S = 300.0
 
 CLIENT_ID = os.environ.get("CLIENT_ID")
 CLIENT_SECRET = os.environ.get("CLIENT_SECRET")
 # Docker-compose doesn't strip double quotes when reading from .env; however running this file from
 # command line decodes the secret incorrectly if the quotes are absent. To avoid having two different
 # ways of writing .env files, we remove the quotes here if present:
-if CLIENT_SECRET.startswith('"') and CLIENT_SECRET.endswith('"'):
+if CLIENT_SECRET and CLIENT_SECRET.startswith('"') and CLIENT_SECRET.endswith('"'):
     CLIENT_SECRET = CLIENT_SECRET[1:-1]
-if not CLIENT_ID or not CLIENT_SECRET:
-    raise Exception("Please supply CLIENT_ID and CLIENT_SECRET env vars!")
 
 
 logging.basicConfig(level=os.environ.get("LOGLEVEL", "INFO").upper())
 kazoo.client.log.setLevel(logging.WARNING)
 
 
-def request_auth_token(client_id, client_secret):
+def request_auth_token(client_id, client_secret, root_url=SENTINELHUB_ROOT_URL):
     r = requests.post(
-        f"{SENTINELHUB_ROOT_URL}/oauth/token",
+        f"{root_url}/oauth/token",
         data={
             "grant_type": "client_credentials",
             "client_id": client_id,
@@ -71,9 +111,9 @@ def extract_expiration_time(auth_token):
     return data["exp"]
 
 
-def fetch_current_stats(auth_token, user_id):
+def fetch_current_stats(auth_token, user_id, root_url=SENTINELHUB_ROOT_URL):
     r = requests.get(
-        f"{SENTINELHUB_ROOT_URL}/aux/ratelimit/statistics/tokenCounts/{user_id}",
+        f"{root_url}/aux/ratelimit/statistics/tokenCounts/{user_id}",
         headers={"Authorization": f"Bearer {auth_token}"},
     )
     r.raise_for_status()
@@ -81,9 +121,9 @@ def fetch_current_stats(auth_token, user_id):
     return stats
 
 
-def fetch_rate_limits(user_id, auth_token):
+def fetch_rate_limits(user_id, auth_token, root_url=SENTINELHUB_ROOT_URL):
     r = requests.get(
-        f"{SENTINELHUB_ROOT_URL}/aux/ratelimit/contract",
+        f"{root_url}/aux/ratelimit/contract",
         params={
             "userId": f"eq:{user_id}",
         },
@@ -92,7 +132,7 @@ def fetch_rate_limits(user_id, auth_token):
     r.raise_for_status()
     contracts = r.json()["data"]
 
-    stats = fetch_current_stats(auth_token, user_id)
+    stats = fetch_current_stats(auth_token, user_id, root_url)
 
     rate_limits = []
     for contract in contracts:
@@ -120,40 +160,285 @@ def fetch_rate_limits(user_id, auth_token):
     return rate_limits
 
 
-def adjust_filling(nanos_between_refills):
+def adjust_filling(nanos_between_refills, min_interval_ns=MIN_FILL_INTERVAL_NS):
     """
     We know that we don't have a chance to run tasks with ns precision, so we adjust the
     filling interval to 100ms or more (and increment value accordingly).
     """
-    MIN_INTERVAL_NS = 100 * 1000 * 1000  # 100 ms sounds manageable
-    if nanos_between_refills >= MIN_INTERVAL_NS:
+    if nanos_between_refills >= min_interval_ns:
         fill_interval_s, fill_quantity = nanos_between_refills / 1000000000.0, 1
         return fill_interval_s, fill_quantity
     # we need to fix fill_quantity so that we can return big enough fill time:
-    n_at_once = math.ceil(MIN_INTERVAL_NS / nanos_between_refills)
+    n_at_once = math.ceil(min_interval_ns / nanos_between_refills)
     fill_interval_s = (nanos_between_refills * n_at_once) / 1000000000.0
     return fill_interval_s, n_at_once
 
 
 def repository_fill_bucket(field, incr_by, limit, min_revisit_time_ms, repository: Repository):
     """
-    Fills the rate-limiting bucket.
+    Fills the rate-limiting bucket. Returns the amount which was actually added to the bucket.
     """
     new_value = repository.increment_counter(field, float(incr_by))
+    added = float(incr_by)
 
     # Since we can't atomically check and increment conditionally, we increment, then
-    # check the new value, and decrement back if over the limit.
-    if int(new_value) > limit:
-        decr_by = int(new_value) - limit
+    # check the new value, and decrement back if over the limit (corrections of the drift are
+    # fractional, so the value is not truncated):
+    if float(new_value) > limit:
+        decr_by = float(new_value) - limit
         final_value = repository.increment_counter(field, -float(decr_by))
+        added -= decr_by
         logging.debug(f"Filled {field} to {final_value} (limit {limit} reached)")
     else:
         logging.debug(f"Filled {field} to {new_value} (limit {limit})")
 
     repository.signal_syncer_alive(min_revisit_time_ms)
+    return added
+
+
+def distribute_job_fills(fill_quantity, capacity, job_quotas, job_levels):
+    """
+    Splits the fill of a policy among the jobs' sub-buckets according to their refill fractions.
+
+    Jobs whose sub-bucket is (nearly) full can't use their share; instead of losing it, the surplus is
+    redistributed to the jobs which still have room, proportionally to their refill fractions.
+    """
+    rooms = {}
+    for job_id, quota in job_quotas.items():
+        rooms[job_id] = max(capacity * quota["capacity_fraction"] - job_levels.get(job_id, 0.0), 0.0)
+
+    fills = {job_id: 0.0 for job_id in job_quotas}
+    to_distribute = {job_id: fill_quantity * quota["refill_fraction"] for job_id, quota in job_quotas.items()}
+    # each pass either fills up a sub-bucket or distributes everything, so the number of passes is bounded:
+    for _ in range(len(job_quotas)):
+        surplus = 0.0
+        for job_id, amount in to_distribute.items():
+            accepted = min(amount, rooms[job_id] - fills[job_id])
+            fills[job_id] += accepted
+            surplus += amount - accepted
+        hungry = [job_id for job_id in job_quotas if rooms[job_id] - fills[job_id] > 0.0]
+        if surplus <= 0.0 or not hungry:
+            break
+        total_fraction = sum(job_quotas[job_id]["refill_fraction"] for job_id in hungry)
+        to_distribute = {job_id: surplus * job_quotas[job_id]["refill_fraction"] / total_fraction for job_id in hungry}
+    return {job_id: fill for job_id, fill in fills.items() if fill > 0.0}
+
+
+def repository_fill_job_buckets(policy_id, fill_quantity, capacity, job_quotas, repository: Repository):
+    """
+    Fills the sub-buckets of the jobs with the given quotas (as last read from the repository).
+    """
+    if not job_quotas:
+        return
+    counter_ids = {job_id: job_bucket_id(policy_id, job_id) for job_id in job_quotas}
+    levels = repository.get_counters(list(counter_ids.values()))
+    # the quotas might be out of date - jobs whose sub-buckets are gone were removed in the meantime:
+    job_quotas = {job_id: quota for job_id, quota in job_quotas.items() if counter_ids[job_id] in levels}
+    if not job_quotas:
+        return
+    job_levels = {job_id: levels[counter_ids[job_id]] for job_id in job_quotas}
+
+    fills = distribute_job_fills(float(fill_quantity), float(capacity), job_quotas, job_levels)
+    if fills:
+        repository.increment_counters({counter_ids[job_id]: fill for job_id, fill in fills.items()})
+        logging.debug(f"Filled job sub-buckets of {policy_id}: {fills}")
+
+
+def reset_job_buckets(rate_limits, repository: Repository):
+    """
+    Sets the sub-buckets of all jobs to full, the same as the policy buckets are (re)initialized.
+    """
+    job_quotas = repository.get_job_quotas()
+    if not job_quotas:
+        return
+    counter_ids = [job_bucket_id(policy["id"], job_id) for policy in rate_limits for job_id in job_quotas]
+    levels = repository.get_counters(counter_ids)
+    increments = {}
+    for policy in rate_limits:
+        for job_id, quota in job_quotas.items():
+            counter_id = job_bucket_id(policy["id"], job_id)
+            increments[counter_id] = policy["capacity"] * quota["capacity_fraction"] - levels.get(counter_id, 0.0)
+    repository.increment_counters(increments)
+    logging.info(f"Reset sub-buckets of {len(job_quotas)} job(s).")
+
+
+def publish_reset_capacity(rate_limits, previous_bucket_values, repository: Repository):
+    """
+    Lets the waiting workers know how much the buckets have grown when they were (re)initialized.
+    """
+    credits = {}
+    for policy in rate_limits:
+        if policy["id"] not in previous_bucket_values:
+            continue
+        incr_by = float(policy["initial"]) - float(previous_bucket_values[policy["id"]])
+        if incr_by > 0:
+            credits[policy["id"]] = incr_by
+    if credits:
+        repository.publish_capacity(credits)
+
+
+def pacing_rate(policy, bucket_value, horizon_s):
+    """
+    Returns the rate (units per second) at which the budget of the long-window policy should be spent.
+
+    Besides the refill rate (which can be spent indefinitely), whatever is left in the bucket is spread
+    evenly over the horizon - so the burn rate follows the remaining budget instead of allowing it to be
+    used up in a single burst.
+    """
+    refill_rate = 1000000000.0 / policy["nanos_between_refills"]
+    return refill_rate + max(bucket_value, 0.0) / horizon_s
+
+
+def add_pacing_policies(rate_limits, min_window_s, horizon_s, burst_s, update_interval_s):
+    """
+    Adds a virtual pacing bucket (of the same type) for each of the policies with a window of at least
+    `min_window_s`. Pacing buckets are decremented by workers the same as the real ones, but syncer fills
+    them at the pacing rate (see `pacing_rate`) and they hold at most `burst_s` seconds worth of it.
+    """
+    pacing_policies = []
+    for policy in rate_limits:
+        window_s = policy["capacity"] * policy["nanos_between_refills"] / 1000000000.0
+        if window_s < min_window_s:
+            continue
+        pacing_policy = {
+            "id": f"PACE_{policy['id']}",
+            "type": policy["type"],
+            "virtual": True,
+            "paces": policy["id"],
+            "horizon_s": min(horizon_s or window_s, window_s),
+            "burst_s": burst_s,
+            "update_interval_s": update_interval_s,
+        }
+        set_pacing_rate(pacing_policy, pacing_rate(policy, policy["initial"], pacing_policy["horizon_s"]), policy)
+        pacing_policy["initial"] = pacing_policy["capacity"]
+        logging.info(f"Pacing policy {policy['id']} (window {window_s}s) over {pacing_policy['horizon_s']}s")
+        pacing_policies.append(pacing_policy)
+    return rate_limits + pacing_policies
+
+
+def add_shaping_policies(rate_limits, max_burst_s, burst_overrides=None, max_window_s=SHAPING_MAX_WINDOW_S):
+    """
+    Adds a virtual shaping bucket (of the same type) for each of the real policies with a window of at most
+    `max_window_s`. Shaping buckets are refilled at the same rate as the policies, but hold at most `max_burst_s`
+    seconds worth of it (or as many seconds as `burst_overrides` says for the policy's sampling period, regardless
+    of its window), so that workers which start together are spread out instead of all getting delay 0 while the
+    real buckets are full. With 0 s, permits are evenly spaced.
+    """
+    burst_overrides = burst_overrides or {}
+    shaping_policies = []
+    for policy in rate_limits:
+        if policy.get("virtual"):
+            continue
+        window_s = policy["capacity"] * policy["nanos_between_refills"] / 1000000000.0
+        if policy["sampling_period"] in burst_overrides:
+            burst_s = burst_overrides[policy["sampling_period"]]
+        elif window_s <= max_window_s:
+            burst_s = max_burst_s
+        else:
+            burst_s = None
+        if burst_s is None:
+            continue
+        capacity = max(burst_s * 1000000000.0 / policy["nanos_between_refills"], 1.0)
+        if capacity >= policy["capacity"]:
+            # the policy doesn't allow bigger bursts anyway:
+            continue
+        shaping_policies.append(
+            {
+                "id": f"SHAPE_{policy['id']}",
+                "type": policy["type"],
+                "virtual": True,
+                "shapes": policy["id"],
+                "capacity": capacity,
+                "initial": capacity,
+                "fill_interval_s": policy["fill_interval_s"],
+                "fill_quantity": policy["fill_quantity"],
+                "nanos_between_refills": policy["nanos_between_refills"],
+            }
+        )
+        logging.info(f"Shaping policy {policy['id']} to bursts of at most {capacity} (of {policy['capacity']})")
+    return rate_limits + shaping_policies
+
+
+def set_pacing_rate(pacing_policy, rate, policy):
+    nanos_between_refills = int(1000000000.0 / rate)
+    fill_interval_s, fill_quantity = adjust_filling(nanos_between_refills)
+    pacing_policy["nanos_between_refills"] = nanos_between_refills
+    pacing_policy["fill_interval_s"] = fill_interval_s
+    pacing_policy["fill_quantity"] = fill_quantity
+    # the pacing bucket never holds more than the policy itself could:
+    pacing_policy["capacity"] = min(max(rate * pacing_policy["burst_s"], 1.0), policy["capacity"])
+
+
+def update_pacing_policy(pacing_policy, repository: Repository):
+    """
+    Recalculates the pacing rate (and with it the capacity of the pacing bucket) from the current value of the
+    paced bucket. Returns the new rate.
+    """
+    policy_id = pacing_policy["paces"]
+    bucket_value = repository.get_counters([policy_id]).get(policy_id, 0.0)
+    policy = {
+        "nanos_between_refills": float(repository.get_policy_refills()[policy_id]),
+        "capacity": repository.get_policy_capacities()[policy_id],
+    }
+    rate = pacing_rate(policy, bucket_value, pacing_policy["horizon_s"])
+    set_pacing_rate(pacing_policy, rate, policy)
+    repository.set_policy_refills({pacing_policy["id"]: pacing_policy["nanos_between_refills"]})
+    repository.set_policy_capacities({pacing_policy["id"]: pacing_policy["capacity"]})
+    cap_job_buckets(pacing_policy["id"], pacing_policy["capacity"], repository.get_job_quotas(), repository)
+    return rate
+
+
+def cap_job_buckets(policy_id, capacity, job_quotas, repository: Repository):
+    """
+    Lowers the sub-buckets of the jobs which hold more than their share of the policy's capacity (after the
+    capacity has been lowered). Fills never exceed the shares, but they don't take anything away either.
+    """
+    if not job_quotas:
+        return
+    capacities = {
+        job_bucket_id(policy_id, job_id): capacity * quota["capacity_fraction"] for job_id, quota in job_quotas.items()
+    }
+    levels = repository.get_counters(list(capacities.keys()))
+    corrections = {
+        counter_id: capacities[counter_id] - level
+        for counter_id, level in levels.items()
+        if level > capacities[counter_id]
+    }
+    if corrections:
+        repository.increment_counters(corrections)
+        logging.debug(f"Capped job sub-buckets of {policy_id}: {corrections}")
+
+
+def pending_units(bucket_value, permit_rate, latency_s=REQUEST_LATENCY_SEC):
+    """
+    Returns the units which were taken from the bucket by the permits whose requests Sentinel Hub hasn't seen yet:
+    the workers which are still waiting (the debt of the bucket) and the requests in flight.
+    """
+    return max(-bucket_value, 0.0) + permit_rate * latency_s
 
 
-def run_syncing(rate_limits, min_revisit_time_ms, repository: Repository, refresh_buckets_sec=None, auth_token=None):
+def refresh_interval(interval_s, base_interval_s, relative_drift, idle):
+    """
+    Returns the interval until the next refresh of the buckets: shorter if the buckets have drifted a lot since the
+    last refresh, longer if they haven't (or if there is no traffic which could make them drift).
+    """
+    if relative_drift > REFRESH_DRIFT_HIGH:
+        interval_s /= 2.0
+    elif relative_drift < REFRESH_DRIFT_LOW or idle:
+        interval_s *= 1.5
+    return min(
+        max(interval_s, base_interval_s * REFRESH_INTERVAL_MIN_FACTOR), base_interval_s * REFRESH_INTERVAL_MAX_FACTOR
+    )
+
+
+def run_syncing(
+    rate_limits,
+    min_revisit_time_ms,
+    repository: Repository,
+    refresh_buckets_sec=None,
+    auth_token=None,
+    root_url=SENTINELHUB_ROOT_URL,
+):
     """
     Runs a scheduler which fills the rate limiting buckets in Redis.
 
@@ -166,51 +451,187 @@ def run_syncing(rate_limits, min_revisit_time_ms, repository: Repository, refres
     scheduler = sched.scheduler(time.time, time.sleep)
     PRIORITY = 1
     PRIORITY_REFRESH_BUCKETS = 2
+    PRIORITY_PERMIT_RATES = 3
+    PRIORITY_PACING = 4
+    PRIORITY_REBALANCE = 5
+    PRIORITY_PURGE = 6
+
+    # amounts added to the buckets by syncer since the last measurement of the permit rates:
+    filled = {policy["id"]: 0.0 for policy in rate_limits}
+    # capacity returned by the workers in excess of what they took since the last measurement (negative):
+    returned = {}
+    permit_rates = {}
+    # policy id -> [correction per fill, fills left]; drift is corrected gradually until the next refresh:
+    corrections = {}
+    # job quotas are read again with the permit rates, instead of on every fill:
+    job_quotas = repository.get_job_quotas()
+    recorder = get_trace_recorder()
+    if recorder is not None:
+        recorder.record(
+            "rate_limits", endpoint=root_url, rate_limits=rate_limits, min_revisit_time_ms=min_revisit_time_ms
+        )
 
-    def fill_bucket(policy_id, fill_interval_s, fill_quantity, capacity, scheduled_at):
+    def fill_bucket(policy, scheduled_at):
+        # fill parameters are read from the policy each time, because pacing policies change them on the fly:
+        policy_id = policy["id"]
+        fill_interval_s = policy["fill_interval_s"]
+        fill_quantity = policy["fill_quantity"]
+        capacity = policy["capacity"]
         now = time.time()
         logging.debug(
             f"Filling: {policy_id} every {fill_interval_s}s with {fill_quantity}. Was scheduled at {scheduled_at:.3f}, {now - scheduled_at:.3f}s late."
         )
-        repository_fill_bucket(policy_id, fill_quantity, capacity, min_revisit_time_ms, repository)
+        # workers lower the rate multiplier when they get 429 responses, so we fill the buckets slower:
+        scaled_fill_quantity = fill_quantity * repository.get_rate_multiplier()
+        correction = 0.0
+        if policy_id in corrections:
+            correction, fills_left = corrections[policy_id]
+            if fills_left <= 1:
+                del corrections[policy_id]
+            else:
+                corrections[policy_id][1] = fills_left - 1
+        added = repository_fill_bucket(
+            policy_id, scaled_fill_quantity + correction, capacity, min_revisit_time_ms, repository
+        )
+        filled[policy_id] += added
+        # the workers which are waiting for capacity can start earlier (but only by what was actually added, the
+        # fill might have been capped at the capacity):
+        credit = min(correction, added)
+        if credit > 0:
+            repository.publish_capacity({policy_id: credit})
+        if recorder is not None:
+            recorder.record(
+                "fill",
+                endpoint=root_url,
+                policy_id=policy_id,
+                quantity=scaled_fill_quantity,
+                correction=correction,
+                added=added,
+                late_s=now - scheduled_at,
+            )
+        repository_fill_job_buckets(policy_id, scaled_fill_quantity, capacity, job_quotas, repository)
 
         # schedule next run, adjusting the time so that delay in running doesn't affect the sequence (much)
         adjusted_interval_s = max(scheduled_at + fill_interval_s - now, 0.001)
-        arguments = (
-            policy_id,
-            fill_interval_s,
-            fill_quantity,
-            capacity,
-            scheduled_at + fill_interval_s,
-        )
+        arguments = (policy, scheduled_at + fill_interval_s)
         scheduler.enter(adjusted_interval_s, PRIORITY, fill_bucket, argument=arguments)
 
-    def refresh_buckets(rate_limits, auth_token):
+    def refresh_buckets(rate_limits, auth_token, interval_s):
         try:
             if auth_token is None or will_auth_token_soon_expire(auth_token):
-                auth_token = request_auth_token(CLIENT_ID, CLIENT_SECRET)
+                auth_token = request_auth_token(CLIENT_ID, CLIENT_SECRET, root_url)
                 exp_time_s = extract_expiration_time(auth_token)
                 repository.save_access_token(auth_token, exp_time_s)
 
             user_id = extract_user_id(auth_token)
-            stats = fetch_current_stats(auth_token, user_id)
+            stats = fetch_current_stats(auth_token, user_id, root_url)
         except Exception as ex:
             logging.warning(f"Refreshing buckets failed! {str(ex)}")
+            scheduler.enter(
+                interval_s, PRIORITY_REFRESH_BUCKETS, refresh_buckets, argument=(rate_limits, auth_token, interval_s)
+            )
+            return
 
         bucket_values = repository.get_buckets_state()
 
+        drifts = {}
+        relative_drift = 0.0
         for policy in rate_limits:
+            # virtual policies (e.g. pacing) are not known to Sentinel Hub:
+            if policy.get("virtual"):
+                continue
             bucket_value = float(bucket_values[policy["id"]])
             actual_value = stats[POLICY_TYPES_FULL_NAMES[policy["type"]]][policy["sampling_period"]]
-            incr_by = actual_value - bucket_value
-            repository_fill_bucket(policy["id"], incr_by, policy["capacity"], min_revisit_time_ms, repository)
+            # permits which were issued, but whose requests were not performed yet, are not counted twice:
+            pending = pending_units(bucket_value, permit_rates.get(policy["id"], 0.0))
+            drift = actual_value - pending - bucket_value
+            drifts[policy["id"]] = drift
+            relative_drift = max(relative_drift, abs(drift) / float(policy["capacity"]))
+            if recorder is not None:
+                recorder.record(
+                    "refresh",
+                    endpoint=root_url,
+                    policy_id=policy["id"],
+                    bucket_value=bucket_value,
+                    actual_value=actual_value,
+                    pending=pending,
+                    drift=drift,
+                )
             logging.debug(
-                f"Refreshed policy type {POLICY_TYPES_FULL_NAMES[policy['type']]} {policy['sampling_period']}. Bucket value: {bucket_value}. Actual value: {actual_value}"
+                f"Refreshed policy type {POLICY_TYPES_FULL_NAMES[policy['type']]} {policy['sampling_period']}. Bucket value: {bucket_value}. Actual value: {actual_value}. Pending: {pending}"
             )
+
+        idle = all(permit_rates.get(policy_id, 0.0) <= 0.0 for policy_id in drifts)
+        next_interval_s = refresh_interval(interval_s, refresh_buckets_sec, relative_drift, idle)
+        # instead of a sudden jump of the delays, the drift is corrected gradually until the next refresh (which
+        # measures whatever wasn't corrected yet again):
+        for policy in rate_limits:
+            if policy["id"] in drifts:
+                n_fills = max(int(next_interval_s / policy["fill_interval_s"]), 1)
+                corrections[policy["id"]] = [drifts[policy["id"]] / n_fills, n_fills]
+        logging.debug(f"Drift is {relative_drift:.2%} of capacity, refreshing again in {next_interval_s:.1f}s")
         scheduler.enter(
-            refresh_buckets_sec, PRIORITY_REFRESH_BUCKETS, refresh_buckets, argument=(rate_limits, auth_token)
+            next_interval_s,
+            PRIORITY_REFRESH_BUCKETS,
+            refresh_buckets,
+            argument=(rate_limits, auth_token, next_interval_s),
         )
 
+    def measure_permit_rates(previous_values, measured_at, permit_rates):
+        """
+        Whatever was taken from the buckets (and not added by us) was consumed by the workers.
+
+        Capacity which the workers return (`release`, `refund`, 429s) is counted as negative consumption. It was
+        taken (and counted) in some earlier interval, so an interval in which more was returned than taken doesn't
+        pull the rate towards 0 - the surplus is carried over and offsets the consumption of the next intervals.
+        """
+        now = time.time()
+        bucket_values = {k: float(v) for k, v in repository.get_buckets_state().items()}
+        smoothing = 1.0 - math.exp(-(now - measured_at) / PERMIT_RATE_WINDOW_S)
+        for policy_id in filled:
+            if policy_id in previous_values and policy_id in bucket_values:
+                consumed = previous_values[policy_id] + filled[policy_id] - bucket_values[policy_id]
+                consumed += returned.pop(policy_id, 0.0)
+                if consumed < 0.0:
+                    returned[policy_id] = consumed
+                else:
+                    rate = consumed / (now - measured_at)
+                    permit_rates[policy_id] = permit_rates.get(policy_id, rate) * (1.0 - smoothing) + rate * smoothing
+            filled[policy_id] = 0.0
+        repository.save_permit_rates(permit_rates)
+        logging.debug(f"Permit rates: {permit_rates}")
+        job_quotas.clear()
+        job_quotas.update(repository.get_job_quotas())
+        scheduler.enter(
+            PERMIT_RATE_INTERVAL_S,
+            PRIORITY_PERMIT_RATES,
+            measure_permit_rates,
+            argument=(bucket_values, now, permit_rates),
+        )
+
+    def rebalance_shards(interval_s):
+        totals = repository.rebalance()
+        logging.debug(f"Rebalanced {len(repository.shards)} shards, totals: {totals}")
+        scheduler.enter(interval_s, PRIORITY_REBALANCE, rebalance_shards, argument=(interval_s,))
+
+    def update_pacing(pacing_policy):
+        rate_limit = update_pacing_policy(pacing_policy, repository)
+        if recorder is not None:
+            recorder.record("pacing", endpoint=root_url, policy_id=pacing_policy["id"], rate=rate_limit)
+        logging.debug(
+            f"Pacing {pacing_policy['paces']}: {rate_limit:.4f} units/s, up until {pacing_policy['capacity']}"
+        )
+        scheduler.enter(pacing_policy["update_interval_s"], PRIORITY_PACING, update_pacing, argument=(pacing_policy,))
+
+    def purge_learned_costs():
+        # not worth restarting the syncing for:
+        try:
+            repository.purge_learned_costs()
+            logging.debug("Purged expired learned costs")
+        except Exception:
+            logging.exception("Purging learned costs failed")
+        scheduler.enter(LEARNED_COSTS_PURGE_S, PRIORITY_PURGE, purge_learned_costs)
+
     # initialize the scheduler:
     now = time.time()
     for policy in rate_limits:
@@ -220,74 +641,259 @@ def run_syncing(rate_limits, min_revisit_time_ms, repository: Repository, refres
         capacity = policy["capacity"]
         logging.info(f"Rate limiting policy {policy_id}: {fill_quantity} every {fill_interval_s}s, up until {capacity}")
         scheduled_at = now + fill_interval_s
-        arguments = (
-            policy_id,
-            fill_interval_s,
-            fill_quantity,
-            capacity,
-            scheduled_at,
-        )
+        arguments = (policy, scheduled_at)
         scheduler.enter(fill_interval_s, PRIORITY, fill_bucket, argument=arguments)
+        if "paces" in policy:
+            scheduler.enter(policy["update_interval_s"], PRIORITY_PACING, update_pacing, argument=(policy,))
+
+    bucket_values = {k: float(v) for k, v in repository.get_buckets_state().items()}
+    scheduler.enter(
+        PERMIT_RATE_INTERVAL_S,
+        PRIORITY_PERMIT_RATES,
+        measure_permit_rates,
+        argument=(bucket_values, now, permit_rates),
+    )
+
+    scheduler.enter(LEARNED_COSTS_PURGE_S, PRIORITY_PURGE, purge_learned_costs)
+
+    if isinstance(repository, ShardedRepository):
+        # workers take their permits from their home shards, so the shards are leveled on every tick:
+        rebalance_interval_s = min(policy["fill_interval_s"] for policy in rate_limits)
+        scheduler.enter(rebalance_interval_s, PRIORITY_REBALANCE, rebalance_shards, argument=(rebalance_interval_s,))
+        logging.info(f"Rebalancing {len(repository.shards)} shards every {rebalance_interval_s}s.")
 
     if refresh_buckets_sec is not None:
         # Schedule refreshing buckets with values from sentinel hub
-        arguments = (rate_limits, auth_token)
+        arguments = (rate_limits, auth_token, refresh_buckets_sec)
         scheduler.enter(refresh_buckets_sec, PRIORITY_REFRESH_BUCKETS, refresh_buckets, argument=arguments)
-        logging.info(f"Refreshing buckets every {refresh_buckets_sec} seconds.")
+        logging.info(f"Refreshing buckets every {refresh_buckets_sec} seconds (adapting to the drift).")
 
     scheduler.run()
 
 
-def main(argv):
-    if len(argv) > 1 and argv[1] == "zookeeper":
-        ZOOKEEPER_HOSTS = os.environ.get("ZOOKEEPER_HOSTS", "127.0.0.1:2181")
-        zk = KazooClient(hosts=ZOOKEEPER_HOSTS)
-        zk.start()
+def start_backlog_server(port, repositories):
+    """
+    Serves the backlog of the policies (see `rlguard.get_backlog`) as JSON on `GET /backlog`, for autoscalers.
 
-        repository = ZooKeeperRepository(zk, key_base="/openeo/rlguard")
-    else:
-        REDIS_HOST = os.environ.get("REDIS_HOST", "127.0.0.1")
-        REDIS_PORT = int(os.environ.get("REDIS_PORT", 6379))
-        rds = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, decode_responses=True)
+    `repositories` maps endpoint names to their repositories; the backlog of each endpoint is served on
+    `GET /backlog/<endpoint>`, and `GET /backlog` serves the backlog of the first one.
+    """
+
+    class BacklogHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            path = self.path.rstrip("/").split("/")
+            if path[:2] != ["", "backlog"] or len(path) > 3:
+                self.send_error(404)
+                return
+            endpoint = path[2] if len(path) == 3 else next(iter(repositories))
+            repository = repositories.get(endpoint)
+            if repository is None:
+                self.send_error(404)
+                return
+            backlog = {policy_id: dataclasses.asdict(b) for policy_id, b in get_backlog(repository).items()}
+            body = json.dumps(backlog).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logging.debug(format % args)
+
+    server = ThreadingHTTPServer(("0.0.0.0", port), BacklogHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logging.info(f"Serving backlog on port {port}.")
+
+
+def endpoint_name(root_url):
+    """
+    Endpoints are named (and their buckets namespaced) by the hostname of their root URL.
+    """
+    return urlsplit(root_url).hostname
+
+
+def sync_endpoint(
+    root_url,
+    repository: Repository,
+    semaphore_limits,
+    pacing,
+    revisit_time_ms=None,
+    refresh_buckets_sec=None,
+    shaping=None,
+):
+    """
+    Fetches the rate limits of a single Sentinel Hub endpoint and keeps syncing its buckets (forever).
+
+    Each endpoint is synced in its own thread, so failures are retried (with exponential backoff) here - otherwise
+    the thread would die while the process (and the other endpoints) kept running.
+    """
+    failures = 0
+    while True:
+        try:
+            auth_token = request_auth_token(CLIENT_ID, CLIENT_SECRET, root_url)
+        except Exception as ex:
+            logging.warning(f"Could not fetch auth token from {root_url}, will retry in 5s. Error: {str(ex)}")
+            time.sleep(5)
+            continue
+
+        try:
+            user_id = extract_user_id(auth_token)
+            rate_limits = fetch_rate_limits(user_id, auth_token, root_url)
+            if pacing is not None:
+                rate_limits = add_pacing_policies(rate_limits, *pacing)
+            if shaping is not None:
+                rate_limits = add_shaping_policies(rate_limits, *shaping)
+            exp_time_s = extract_expiration_time(auth_token)
+
+            # we need a way for workers to know if we died - we do this by setting EXPIRE on `syncer_alive`
+            # key to twice the time we should refill the buckets in:
+            min_revisit_time_ms = revisit_time_ms or int(1000 * min([r["fill_interval_s"] for r in rate_limits])) * 2
+
+            previous_bucket_values = repository.get_buckets_state()
+            repository.init_rate_limits(rate_limits, min_revisit_time_ms)
+            repository.init_semaphores(semaphore_limits)
+            reset_job_buckets(rate_limits, repository)
+            publish_reset_capacity(rate_limits, previous_bucket_values, repository)
+            repository.save_access_token(auth_token, exp_time_s)
+            failures = 0
+
+            run_syncing(
+                rate_limits,
+                min_revisit_time_ms,
+                repository,
+                refresh_buckets_sec=refresh_buckets_sec,
+                auth_token=auth_token,
+                root_url=root_url,
+            )
+        except Exception:
+            retry_s = min(SYNC_RETRY_S * 2**failures, SYNC_RETRY_MAX_S)
+            failures += 1
+            logging.exception(f"Syncing of {root_url} has failed, will retry in {retry_s}s.")
+            time.sleep(retry_s)
+            continue
 
-        repository = RedisRepository(rds)
+        logging.info(f"Restarting syncing of {root_url}...")
 
+
+def sync_settings_from_env():
+    """
+    Returns the settings of syncing (keyword arguments of `sync_endpoint`) from env vars.
+    """
     REFRESH_BUCKETS_SEC = os.environ.get("REFRESH_BUCKETS_SEC")
     if REFRESH_BUCKETS_SEC:
         REFRESH_BUCKETS_SEC = int(REFRESH_BUCKETS_SEC)
     else:
         REFRESH_BUCKETS_SEC = None
 
+    # optional limit of requests in flight (for the whole account):
+    MAX_CONCURRENT_REQUESTS = os.environ.get("MAX_CONCURRENT_REQUESTS")
+    if MAX_CONCURRENT_REQUESTS:
+        MAX_CONCURRENT_REQUESTS = int(MAX_CONCURRENT_REQUESTS)
+        semaphore_limits = {f"{PolicyType.CONCURRENCY.value}_{MAX_CONCURRENT_REQUESTS}": MAX_CONCURRENT_REQUESTS}
+    else:
+        semaphore_limits = {}
+
+    # optional pacing of long-window policies (e.g. the monthly PU quota):
+    PACING_MIN_WINDOW_SEC = os.environ.get("PACING_MIN_WINDOW_SEC")
+    PACING_MIN_WINDOW_SEC = float(PACING_MIN_WINDOW_SEC) if PACING_MIN_WINDOW_SEC else None
+    PACING_HORIZON_SEC = os.environ.get("PACING_HORIZON_SEC")
+    PACING_HORIZON_SEC = float(PACING_HORIZON_SEC) if PACING_HORIZON_SEC else None
+    PACING_BURST_SEC = float(os.environ.get("PACING_BURST_SEC") or 600)
+    PACING_UPDATE_SEC = float(os.environ.get("PACING_UPDATE_SEC") or 60)
+    if PACING_MIN_WINDOW_SEC is not None:
+        pacing = (PACING_MIN_WINDOW_SEC, PACING_HORIZON_SEC, PACING_BURST_SEC, PACING_UPDATE_SEC)
+    else:
+        pacing = None
+
+    # optional shaping of bursts (all policies, and/or per sampling period, e.g. "PT1M:1,PT1H:30"):
+    SHAPING_MAX_BURST_SEC = os.environ.get("SHAPING_MAX_BURST_SEC")
+    SHAPING_MAX_BURST_SEC = float(SHAPING_MAX_BURST_SEC) if SHAPING_MAX_BURST_SEC else None
+    SHAPING_BURST_SEC_OVERRIDES = os.environ.get("SHAPING_BURST_SEC_OVERRIDES") or ""
+    SHAPING_BURST_SEC_OVERRIDES = {
+        period.strip(): float(burst_s)
+        for period, _, burst_s in (item.rpartition(":") for item in SHAPING_BURST_SEC_OVERRIDES.split(","))
+        if period.strip()
+    }
+    SHAPING_MAX_WINDOW_SEC = float(os.environ.get("SHAPING_MAX_WINDOW_SEC") or SHAPING_MAX_WINDOW_S)
+    if SHAPING_MAX_BURST_SEC is not None or SHAPING_BURST_SEC_OVERRIDES:
+        shaping = (SHAPING_MAX_BURST_SEC, SHAPING_BURST_SEC_OVERRIDES, SHAPING_MAX_WINDOW_SEC)
+    else:
+        shaping = None
+
     REVISIT_TIME_MSEC = os.environ.get("REVISIT_TIME_MSEC")
     if REVISIT_TIME_MSEC:
         REVISIT_TIME_MSEC = int(REVISIT_TIME_MSEC)
     else:
         REVISIT_TIME_MSEC = None
 
-    while True:
-        try:
-            auth_token = request_auth_token(CLIENT_ID, CLIENT_SECRET)
-        except Exception as ex:
-            logging.warning(f"Could not fetch auth token, will retry in 5s. Error: {str(ex)}")
-            time.sleep(5)
-            continue
+    return {
+        "semaphore_limits": semaphore_limits,
+        "pacing": pacing,
+        "revisit_time_ms": REVISIT_TIME_MSEC,
+        "refresh_buckets_sec": REFRESH_BUCKETS_SEC,
+        "shaping": shaping,
+    }
+
+
+def main(argv):
+    # credentials are checked here (and not when the module is imported), so that the tools (see `replay.py`) can
+    # use the functions of this module without them:
+    if not CLIENT_ID or not CLIENT_SECRET:
+        raise Exception("Please supply CLIENT_ID and CLIENT_SECRET env vars!")
+
+    # with a single endpoint, the buckets are not namespaced (as they were before multiple endpoints were supported):
+    multiple_endpoints = len(SENTINELHUB_ROOT_URLS) > 1
+    # optional splitting of the buckets into shards, for very high permit rates (see `rlguard.sharding`):
+    BUCKET_SHARDS = int(os.environ.get("BUCKET_SHARDS") or 1)
+    repositories = {}
+    if len(argv) > 1 and argv[1] == "zookeeper":
+        ZOOKEEPER_HOSTS = os.environ.get("ZOOKEEPER_HOSTS", "127.0.0.1:2181")
+        zk = KazooClient(hosts=ZOOKEEPER_HOSTS)
+        zk.start()
 
-        user_id = extract_user_id(auth_token)
-        rate_limits = fetch_rate_limits(user_id, auth_token)
-        exp_time_s = extract_expiration_time(auth_token)
+        for root_url in SENTINELHUB_ROOT_URLS:
+            key_base = f"/openeo/rlguard/{endpoint_name(root_url)}" if multiple_endpoints else "/openeo/rlguard"
+            if BUCKET_SHARDS > 1:
+                shards = [ZooKeeperRepository(zk, key_base=f"{key_base}/shard-{k}") for k in range(BUCKET_SHARDS)]
+                repositories[root_url] = ShardedRepository(shards, home_shard=0)
+            else:
+                repositories[root_url] = ZooKeeperRepository(zk, key_base=key_base)
+    else:
+        REDIS_HOST = os.environ.get("REDIS_HOST", "127.0.0.1")
+        REDIS_PORT = int(os.environ.get("REDIS_PORT", 6379))
+        rds = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, decode_responses=True)
 
-        # we need a way for workers to know if we died - we do this by setting EXPIRE on `syncer_alive`
-        # key to twice the time we should refill the buckets in:
-        min_revisit_time_ms = REVISIT_TIME_MSEC or int(1000 * min([r["fill_interval_s"] for r in rate_limits])) * 2
+        for root_url in SENTINELHUB_ROOT_URLS:
+            key_prefix = f"{endpoint_name(root_url)}:" if multiple_endpoints else ""
+            if BUCKET_SHARDS > 1:
+                shards = redis_shards(rds, BUCKET_SHARDS, key_prefix=key_prefix)
+                repositories[root_url] = ShardedRepository(shards, home_shard=0)
+            else:
+                repositories[root_url] = RedisRepository(rds, key_prefix=key_prefix)
 
-        repository.init_rate_limits(rate_limits, min_revisit_time_ms)
-        repository.save_access_token(auth_token, exp_time_s)
+    sync_settings = sync_settings_from_env()
 
-        run_syncing(
-            rate_limits, min_revisit_time_ms, repository, refresh_buckets_sec=REFRESH_BUCKETS_SEC, auth_token=auth_token
+    BACKLOG_PORT = os.environ.get("BACKLOG_PORT")
+    if BACKLOG_PORT:
+        start_backlog_server(
+            int(BACKLOG_PORT), {endpoint_name(url): repository for url, repository in repositories.items()}
         )
 
-        logging.info("Restarting...")
+    # each endpoint has its own limits, so it is synced independently of the others:
+    threads = []
+    for root_url, repository in repositories.items():
+        thread = threading.Thread(
+            target=sync_endpoint,
+            args=(root_url, repository),
+            kwargs=sync_settings,
+            name=endpoint_name(root_url),
+            daemon=True,
+        )
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,54 @@
+"""
+Run from the `syncer` directory, with the library on the path: `PYTHONPATH=../lib python -m pytest tests`.
+"""
+import pytest
+
+from rlguard import job_bucket_id, remove_job_quota, set_job_quota
+from rlguard.backends.memory import MemoryRepository
+from syncer import distribute_job_fills, repository_fill_job_buckets
+
+
+def test_fills_are_split_by_refill_fractions():
+    job_quotas = {
+        "a": {"refill_fraction": 0.75, "capacity_fraction": 1.0},
+        "b": {"refill_fraction": 0.25, "capacity_fraction": 1.0},
+    }
+    fills = distribute_job_fills(8.0, 100.0, job_quotas, {"a": 0.0, "b": 0.0})
+    assert fills == {"a": 6.0, "b": 2.0}
+
+
+def test_surplus_of_full_jobs_is_redistributed():
+    job_quotas = {
+        "a": {"refill_fraction": 0.5, "capacity_fraction": 0.1},
+        "b": {"refill_fraction": 0.25, "capacity_fraction": 1.0},
+        "c": {"refill_fraction": 0.25, "capacity_fraction": 1.0},
+    }
+    # "a" only has room for 1 of its 4, the other 3 go to "b" and "c" (in proportion to their fractions):
+    fills = distribute_job_fills(8.0, 100.0, job_quotas, {"a": 9.0, "b": 0.0, "c": 50.0})
+    assert fills["a"] == pytest.approx(1.0)
+    assert fills["b"] == pytest.approx(3.5)
+    assert fills["c"] == pytest.approx(3.5)
+
+
+def test_full_jobs_get_nothing():
+    job_quotas = {"a": {"refill_fraction": 0.5, "capacity_fraction": 0.5}}
+    assert distribute_job_fills(8.0, 100.0, job_quotas, {"a": 50.0}) == {}
+
+
+def test_removed_jobs_are_not_filled():
+    repository = MemoryRepository()
+    repository.init_rate_limits(
+        [{"id": "PU_1", "type": "PU", "initial": 100, "capacity": 100, "nanos_between_refills": 10000000}], 60000
+    )
+    set_job_quota("a", 0.5, repository)
+    set_job_quota("b", 0.5, repository)
+    repository.increment_counters({job_bucket_id("PU_1", "a"): -10.0, job_bucket_id("PU_1", "b"): -10.0})
+    job_quotas = repository.get_job_quotas()
+    remove_job_quota("b", repository)
+
+    # the quotas (as read before "b" was removed) are out of date:
+    repository_fill_job_buckets("PU_1", 8.0, 100.0, job_quotas, repository)
+
+    state = repository.get_buckets_state()
+    assert state[job_bucket_id("PU_1", "a")] == 44.0
+    assert job_bucket_id("PU_1", "b") not in state
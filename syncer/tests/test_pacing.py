@@ -0,0 +1,66 @@
+"""
+Run from the `syncer` directory, with the library on the path: `PYTHONPATH=../lib python -m pytest tests`.
+"""
+import pytest
+
+from rlguard import job_bucket_id, set_job_quota
+from rlguard.backends.memory import MemoryRepository
+from syncer import adjust_filling, add_pacing_policies, pacing_rate, update_pacing_policy
+
+MONTH_S = 744 * 3600
+
+
+def make_policy(policy_id, capacity, window_s, initial=None):
+    nanos_between_refills = int(window_s * 1000000000 / capacity)
+    fill_interval_s, fill_quantity = adjust_filling(nanos_between_refills)
+    return {
+        "id": policy_id,
+        "type": "PU",
+        "capacity": capacity,
+        "initial": capacity if initial is None else initial,
+        "fill_interval_s": fill_interval_s,
+        "fill_quantity": fill_quantity,
+        "nanos_between_refills": nanos_between_refills,
+        "sampling_period": f"PT{window_s // 60}M",
+    }
+
+
+def test_only_long_windows_are_paced():
+    rate_limits = [make_policy("PU_MINUTE", 2000, 60), make_policy("PU_MONTH", 1000000, MONTH_S)]
+    paced = add_pacing_policies(rate_limits, 86400, None, 600, 60)
+
+    pacing_policies = [policy for policy in paced if policy.get("virtual")]
+    assert [policy["paces"] for policy in pacing_policies] == ["PU_MONTH"]
+    # the remaining budget is spread over the rest of the window, plus whatever is refilled in the meantime:
+    rate = pacing_policies[0]["capacity"] / 600
+    assert rate == pytest.approx(2 * 1000000 / MONTH_S, rel=1e-3)
+
+
+def test_pacing_rate_follows_the_remaining_budget():
+    policy = make_policy("PU_MONTH", 1000000, MONTH_S)
+    refill_rate = 1000000 / MONTH_S
+    assert pacing_rate(policy, 500000, 3600) == pytest.approx(refill_rate + 500000 / 3600, rel=1e-6)
+    # when the budget is used up, only the refills can be spent:
+    assert pacing_rate(policy, -100, 3600) == pytest.approx(refill_rate, rel=1e-6)
+
+
+def test_update_lowers_the_capacities_of_pacing_buckets():
+    rate_limits = add_pacing_policies([make_policy("PU_MONTH", 1000000, MONTH_S)], 86400, None, 600, 60)
+    pacing_policy = rate_limits[1]
+    repository = MemoryRepository()
+    repository.init_rate_limits(rate_limits, 60000)
+    set_job_quota("a", 0.5, repository)
+    counter_id = job_bucket_id(pacing_policy["id"], "a")
+    initial_capacity = pacing_policy["capacity"]
+    assert repository.get_buckets_state()[counter_id] == pytest.approx(initial_capacity / 2)
+
+    # most of the month's budget is gone:
+    repository.increment_counter("PU_MONTH", -900000)
+    rate = update_pacing_policy(pacing_policy, repository)
+
+    assert pacing_policy["capacity"] == pytest.approx(rate * 600)
+    assert pacing_policy["capacity"] < initial_capacity
+    assert repository.get_policy_capacities()[pacing_policy["id"]] == pacing_policy["capacity"]
+    assert repository.get_policy_refills()[pacing_policy["id"]] == pacing_policy["nanos_between_refills"]
+    # the job's pacing sub-bucket doesn't hold more than its share of the new capacity:
+    assert repository.get_buckets_state()[counter_id] == pytest.approx(pacing_policy["capacity"] / 2)
@@ -0,0 +1,120 @@
+"""
+Run from the `syncer` directory, with the library on the path: `PYTHONPATH=../lib python -m pytest tests`.
+"""
+import asyncio
+import http.client
+import threading
+
+import pytest
+
+from permitserver import PermitServer
+from rlguard import acquire_permit
+from rlguard.backends.memory import MemoryRepository
+from rlguard.backends.permitserver import PermitServerError, PermitServerRepository
+
+TOKEN = "secret"
+RATE_LIMITS = [{"id": "PU_1", "type": "PU", "initial": 100, "capacity": 100, "nanos_between_refills": 100000000}]
+
+
+@pytest.fixture
+def server():
+    repository = MemoryRepository()
+    repository.init_rate_limits(RATE_LIMITS, 60000)
+    repository.signal_syncer_alive(60000)
+    permit_server = PermitServer(repository, TOKEN)
+
+    loop = asyncio.new_event_loop()
+    tcp_server = loop.run_until_complete(asyncio.start_server(permit_server.serve_connection, "127.0.0.1", 0))
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    yield permit_server, tcp_server.sockets[0].getsockname()[1]
+
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    tcp_server.close()
+    loop.run_until_complete(tcp_server.wait_closed())
+    loop.close()
+
+
+class DroppedConnection:
+    """
+    A pooled connection which the server closes after it has received the request.
+    """
+
+    sock = None
+    timeout = None
+
+    def __init__(self):
+        self.requests = []
+
+    def request(self, method, path, body, headers):
+        self.requests.append((method, path))
+
+    def getresponse(self):
+        raise http.client.RemoteDisconnected("Remote end closed connection without response")
+
+    def close(self):
+        pass
+
+
+def test_permits_are_issued_and_refunded(server):
+    permit_server, port = server
+    client = PermitServerRepository("127.0.0.1", port, token=TOKEN)
+
+    permit = acquire_permit(30, client)
+    assert permit.delay == 0.0
+    assert permit_server.repository.get_buckets_state() == {"PU_1": 70.0}
+
+    client.return_capacity({"PU_1": 30.0})
+    assert client.get_buckets_state() == {"PU_1": 100.0}
+
+
+@pytest.mark.parametrize("token", [None, "wrong"])
+def test_requests_without_the_token_are_refused(server, token):
+    permit_server, port = server
+    client = PermitServerRepository("127.0.0.1", port, token=token)
+
+    with pytest.raises(PermitServerError, match="refused"):
+        client.increment_counter("PU_1", -50.0)
+    assert permit_server.repository.get_buckets_state() == {"PU_1": 100.0}
+
+
+def test_syncer_methods_are_not_exposed(server):
+    permit_server, port = server
+    client = PermitServerRepository("127.0.0.1", port, token=TOKEN)
+    permit_server.repository.save_access_token("sentinel-hub-token", 2000000000)
+
+    with pytest.raises(PermitServerError, match="404"):
+        client._call("get_access_token")
+    with pytest.raises(PermitServerError, match="404"):
+        client._call("init_rate_limits", [], 60000)
+    with pytest.raises(PermitServerError):
+        client.get_access_token()
+
+
+def test_unexpected_errors_are_reported_as_500(server, monkeypatch):
+    permit_server, port = server
+    client = PermitServerRepository("127.0.0.1", port, token=TOKEN)
+
+    def fail():
+        raise RuntimeError("broken")
+
+    monkeypatch.setattr(permit_server.repository, "get_backlog_state", fail)
+    with pytest.raises(PermitServerError, match="500"):
+        client.get_backlog_state()
+    # the connection is still served:
+    assert client.get_buckets_state() == {"PU_1": 100.0}
+
+
+def test_only_idempotent_calls_are_retried_after_the_request_was_sent(server):
+    permit_server, port = server
+    client = PermitServerRepository("127.0.0.1", port, token=TOKEN)
+
+    dropped = DroppedConnection()
+    client._pool.put_nowait(dropped)
+    with pytest.raises(http.client.RemoteDisconnected):
+        client.increment_counters({"PU_1": -10.0})
+    assert dropped.requests == [("POST", "/call/increment_counters")]
+
+    client._pool.put_nowait(DroppedConnection())
+    assert client.get_buckets_state() == {"PU_1": 100.0}
@@ -0,0 +1,59 @@
+"""
+Run from the `syncer` directory, with the library on the path: `PYTHONPATH=../lib python -m pytest tests`.
+"""
+import pytest
+
+from rlguard.backends.memory import MemoryRepository
+from syncer import (
+    REFRESH_INTERVAL_MAX_FACTOR,
+    REFRESH_INTERVAL_MIN_FACTOR,
+    pending_units,
+    refresh_interval,
+    repository_fill_bucket,
+)
+
+RATE_LIMITS = [{"id": "PU_1", "type": "PU", "initial": 100, "capacity": 100, "nanos_between_refills": 100000000}]
+
+
+def test_pending_units_count_the_debt_and_the_requests_in_flight():
+    assert pending_units(50.0, 0.0, latency_s=1.0) == 0.0
+    assert pending_units(50.0, 20.0, latency_s=0.5) == 10.0
+    assert pending_units(-30.0, 20.0, latency_s=0.5) == 40.0
+
+
+def test_permits_in_flight_are_not_counted_as_drift():
+    # workers took 40 PUs, 10 of which Sentinel Hub hasn't seen yet:
+    bucket_value, actual_value = 60.0, 70.0
+    assert actual_value - pending_units(bucket_value, 10.0, latency_s=1.0) - bucket_value == 0.0
+
+
+@pytest.mark.parametrize(
+    "relative_drift, idle, expected_s",
+    [
+        (0.10, False, 30.0),
+        (0.10, True, 30.0),
+        (0.03, False, 60.0),
+        (0.001, False, 90.0),
+        (0.03, True, 90.0),
+    ],
+)
+def test_refresh_interval_adapts_to_the_drift(relative_drift, idle, expected_s):
+    assert refresh_interval(60.0, 60.0, relative_drift, idle) == expected_s
+
+
+def test_refresh_interval_is_bounded():
+    assert refresh_interval(60.0 * REFRESH_INTERVAL_MIN_FACTOR, 60.0, 0.5, False) == 60.0 * REFRESH_INTERVAL_MIN_FACTOR
+    assert refresh_interval(60.0 * REFRESH_INTERVAL_MAX_FACTOR, 60.0, 0.0, True) == 60.0 * REFRESH_INTERVAL_MAX_FACTOR
+
+
+def test_corrections_are_capped_at_the_capacity():
+    repository = MemoryRepository()
+    repository.init_rate_limits(RATE_LIMITS, 60000)
+    repository.increment_counter("PU_1", -10.0)
+
+    assert repository_fill_bucket("PU_1", 2.5, 100, 60000, repository) == 2.5
+    assert repository_fill_bucket("PU_1", 12.5, 100, 60000, repository) == 7.5
+    assert repository.get_buckets_state() == {"PU_1": 100.0}
+    # negative corrections (the buckets were fuller than Sentinel Hub says) are applied as they are:
+    assert repository_fill_bucket("PU_1", -4.25, 100, 60000, repository) == -4.25
+    assert repository.get_buckets_state() == {"PU_1": 95.75}
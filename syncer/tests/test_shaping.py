@@ -0,0 +1,49 @@
+"""
+Run from the `syncer` directory, with the library on the path: `PYTHONPATH=../lib python -m pytest tests`.
+"""
+from rlguard import acquire_permit
+from rlguard.backends.memory import MemoryRepository
+from syncer import add_shaping_policies, adjust_filling
+
+MONTH_S = 744 * 3600
+
+
+def make_policy(policy_id, capacity, window_s, sampling_period):
+    nanos_between_refills = int(window_s * 1000000000 / capacity)
+    fill_interval_s, fill_quantity = adjust_filling(nanos_between_refills)
+    return {
+        "id": policy_id,
+        "type": "PU",
+        "capacity": capacity,
+        "initial": capacity,
+        "fill_interval_s": fill_interval_s,
+        "fill_quantity": fill_quantity,
+        "nanos_between_refills": nanos_between_refills,
+        "sampling_period": sampling_period,
+    }
+
+
+def test_monthly_quota_is_not_shaped():
+    rate_limits = [make_policy("PU_MINUTE", 600, 60, "PT1M"), make_policy("PU_MONTH", 1000000, MONTH_S, "PT744H")]
+    shaped = add_shaping_policies(rate_limits, 1.0)
+
+    assert [policy["id"] for policy in shaped] == ["PU_MINUTE", "PU_MONTH", "SHAPE_PU_MINUTE"]
+    assert shaped[2]["capacity"] == 10.0
+
+
+def test_overrides_apply_to_any_window():
+    rate_limits = [make_policy("PU_MINUTE", 600, 60, "PT1M"), make_policy("PU_MONTH", 1000000, MONTH_S, "PT744H")]
+    shaped = add_shaping_policies(rate_limits, None, {"PT744H": 3600.0})
+
+    assert [policy["id"] for policy in shaped] == ["PU_MINUTE", "PU_MONTH", "SHAPE_PU_MONTH"]
+
+
+def test_shaping_spreads_a_burst():
+    rate_limits = add_shaping_policies([make_policy("PU_MINUTE", 600, 60, "PT1M")], 1.0)
+    repository = MemoryRepository()
+    repository.init_rate_limits(rate_limits, 60000)
+    repository.signal_syncer_alive(60000)
+
+    assert acquire_permit(10, repository).delay == 0.0
+    # the real bucket still holds 590 PUs, but the burst is used up:
+    assert acquire_permit(10, repository).delay > 0.9